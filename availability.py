@@ -0,0 +1,230 @@
+"""Propose free meeting times from the user's calendars.
+
+When an email asks for a meeting without saying when, the reply offers a few
+concrete slots so the sender can pick one instead of starting another round of
+emails. Busy time comes from the Calendar ``freebusy`` endpoint and is kept in
+a ``BusyIndex`` of sorted, merged intervals. The index is reused until its TTL
+runs out, extended by querying only the days it does not cover yet, and told
+about events created in the meantime, so a run makes a handful of freebusy
+calls rather than one per email.
+"""
+import bisect
+import datetime as dt
+import logging
+import threading
+import time
+from typing import Any, List, NamedTuple, Optional, Sequence, Tuple
+from dateutil import parser, tz
+from googleapiclient.errors import HttpError
+import calendar_utils
+from calendar_utils import DEFAULT_TIMEZONE, DEFAULT_DURATION_MINUTES
+from rate_limit import execute
+from schemas import MeetingDetails
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CALENDARS = ["primary"]
+PROPOSED_SLOTS = 3
+WORKDAY_START = dt.time(9)
+WORKDAY_END = dt.time(17)
+# Monday to Friday
+WORKDAYS = (0, 1, 2, 3, 4)
+SLOT_STEP_MINUTES = 30
+# how far ahead slots are proposed, and how soon the earliest one may start
+HORIZON_DAYS = 14
+MIN_NOTICE = dt.timedelta(hours=2)
+# events created elsewhere show up in proposals after at most this long
+BUSY_TTL_SECONDS = 300
+
+Interval = Tuple[dt.datetime, dt.datetime]
+
+
+class WorkingHours(NamedTuple):
+    timezone: str = DEFAULT_TIMEZONE
+    start: dt.time = WORKDAY_START
+    end: dt.time = WORKDAY_END
+    days: Tuple[int, ...] = WORKDAYS
+
+
+# set from the command line with configure()
+working_hours = WorkingHours()
+proposed_slots = PROPOSED_SLOTS
+calendars = list(CALENDARS)
+
+def configure(timezone: str = DEFAULT_TIMEZONE, start: dt.time = WORKDAY_START, end: dt.time = WORKDAY_END,
+              slot_count: int = PROPOSED_SLOTS, calendar_ids: Sequence[str] = CALENDARS):
+    global working_hours, proposed_slots, calendars
+    if tz.gettz(timezone) is None:
+        raise ValueError(f"unknown time zone {timezone!r}")
+    working_hours = WorkingHours(timezone, start, end, WORKDAYS)
+    # meetings whose email names no time zone are created, and held busy, in the user's
+    calendar_utils.set_default_timezone(timezone)
+    proposed_slots = slot_count
+    calendars = list(calendar_ids)
+
+
+def merge_intervals(intervals: List[Interval]) -> List[Interval]:
+    merged: List[Interval] = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def rfc3339(moment: dt.datetime) -> str:
+    return moment.astimezone(dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class BusyIndex:
+    """Sorted, merged busy intervals of ``calendar_ids`` between ``start`` and ``end``. Safe to share between threads."""
+
+    def __init__(self, calendar_ids: Optional[Sequence[str]] = None, ttl_seconds: float = BUSY_TTL_SECONDS):
+        self.calendar_ids = list(calendar_ids or calendars)
+        self.ttl_seconds = ttl_seconds
+        self.intervals: List[Interval] = []
+        self.start: Optional[dt.datetime] = None
+        self.end: Optional[dt.datetime] = None
+        self.fetched_at: Optional[float] = None
+        self.lock = threading.Lock()
+
+    def query(self, service: Any, start: dt.datetime, end: dt.datetime) -> List[Interval]:
+        body = {"timeMin": rfc3339(start), "timeMax": rfc3339(end), "items": [{"id": id} for id in self.calendar_ids]}
+        response = execute(service.freebusy().query(body=body), "calendar", "freebusy.query")
+        busy = []
+        for calendar_id, calendar in response.get("calendars", {}).items():
+            for error in calendar.get("errors", []):
+                logger.error(f"Error reading free/busy for calendar {calendar_id}: {error.get('reason')}")
+            busy.extend((parser.isoparse(block["start"]), parser.isoparse(block["end"])) for block in calendar.get("busy", []))
+        return busy
+
+    def ensure(self, service: Any, start: dt.datetime, end: dt.datetime) -> bool:
+        """Make the index cover ``start`` to ``end``; returns False when free/busy could not be read."""
+        with self.lock:
+            try:
+                if self.fetched_at is None or time.monotonic() - self.fetched_at > self.ttl_seconds or start < self.start:
+                    self.intervals = merge_intervals(self.query(service, start, end))
+                    self.start, self.end = start, end
+                    self.fetched_at = time.monotonic()
+                elif end > self.end:
+                    # only the days that came into the horizon since the last query
+                    self.intervals = merge_intervals(self.intervals + self.query(service, self.end, end))
+                    self.end = end
+            except HttpError as e:
+                logger.error(f"Error querying free/busy: {e}")
+                return False
+            return True
+
+    def add(self, start: dt.datetime, end: dt.datetime):
+        """Record an event created by this process, so later proposals avoid it before the next query."""
+        with self.lock:
+            self.intervals = merge_intervals(self.intervals + [(start, end)])
+
+    def next_conflict(self, start: dt.datetime, end: dt.datetime) -> Optional[dt.datetime]:
+        """The end of the busy block overlapping ``start``-``end``, or None when that time is free."""
+        with self.lock:
+            i = bisect.bisect_left(self.intervals, (start,))
+            # blocks are merged, so only the last one starting before ``start`` and the first one after can overlap
+            for busy_start, busy_end in self.intervals[max(i - 1, 0):i + 1]:
+                if busy_start < end and start < busy_end:
+                    return busy_end
+        return None
+
+
+def round_up(moment: dt.datetime, step_minutes: int) -> dt.datetime:
+    midnight = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    minutes = -(-(moment - midnight) // dt.timedelta(minutes=step_minutes)) * step_minutes
+    return midnight + dt.timedelta(minutes=minutes)
+
+
+def free_slots_on(index: BusyIndex, day: dt.date, duration: dt.timedelta, earliest: dt.datetime,
+                  hours: WorkingHours, limit: int) -> List[Interval]:
+    zone = tz.gettz(hours.timezone)
+    if day.weekday() not in hours.days:
+        return []
+    day_end = dt.datetime.combine(day, hours.end, tzinfo=zone)
+    candidate = round_up(max(dt.datetime.combine(day, hours.start, tzinfo=zone), earliest.astimezone(zone)),
+                         SLOT_STEP_MINUTES)
+    slots = []
+    while candidate + duration <= day_end and len(slots) < limit:
+        busy_until = index.next_conflict(candidate, candidate + duration)
+        if busy_until is None:
+            slots.append((candidate, candidate + duration))
+            candidate += duration
+        else:
+            candidate = round_up(busy_until.astimezone(zone), SLOT_STEP_MINUTES)
+    return slots
+
+
+def free_slots(index: BusyIndex, service: Any, duration_minutes: Optional[int] = None, count: Optional[int] = None,
+               on_date: Optional[dt.date] = None, now: Optional[dt.datetime] = None,
+               hours: Optional[WorkingHours] = None) -> List[Interval]:
+    """Up to ``count`` free slots of ``duration_minutes`` within working hours, earliest first.
+
+    Slots are spread one per day where possible. With ``on_date``, free time on
+    that day is offered first.
+    """
+    hours = hours or working_hours
+    count = proposed_slots if count is None else count
+    if count <= 0:
+        return []
+    zone = tz.gettz(hours.timezone)
+    now = (now or dt.datetime.now(dt.timezone.utc)).astimezone(zone)
+    earliest = now + MIN_NOTICE
+    horizon_end = dt.datetime.combine(now.date() + dt.timedelta(days=HORIZON_DAYS), dt.time(0), tzinfo=zone)
+    if not index.ensure(service, now, horizon_end):
+        return []
+    duration = dt.timedelta(minutes=duration_minutes or DEFAULT_DURATION_MINUTES)
+    slots: List[Interval] = []
+    if on_date is not None and now.date() <= on_date < horizon_end.date():
+        slots = free_slots_on(index, on_date, duration, earliest, hours, count)
+    days = [now.date() + dt.timedelta(days=offset) for offset in range(HORIZON_DAYS)]
+    # then the earliest slot of each day, and more per day if that was not enough
+    for per_day in (1, count):
+        for day in days:
+            for slot in free_slots_on(index, day, duration, earliest, hours, per_day):
+                if slot not in slots and len(slots) < count:
+                    slots.append(slot)
+        if len(slots) >= count:
+            break
+    return sorted(slots)
+
+
+def format_slot(slot: Interval) -> str:
+    start, end = slot
+    def clock(moment: dt.datetime) -> str:
+        return moment.strftime("%I:%M %p").lstrip("0")
+    return f"{start:%A, %B} {start.day}, {clock(start)} - {clock(end)} {start.tzname()}"
+
+
+def requested_date(meeting_details: MeetingDetails) -> Optional[dt.date]:
+    if meeting_details.date is None:
+        return None
+    try:
+        return parser.parse(meeting_details.date).date()
+    except (ValueError, OverflowError):
+        return None
+
+
+def propose_slots(index: BusyIndex, service: Any, meeting_details: MeetingDetails,
+                  now: Optional[dt.datetime] = None) -> List[str]:
+    """Free times to offer in reply to a meeting request that did not say when, formatted for the email."""
+    slots = free_slots(index, service, meeting_details.duration, on_date=requested_date(meeting_details), now=now)
+    if slots:
+        logger.info(f"Proposing {len(slots)} free slots")
+    return [format_slot(slot) for slot in slots]
+
+
+def record_event(index: BusyIndex, meeting_details: MeetingDetails):
+    """Mark the time of an event created from ``meeting_details`` as busy in ``index``."""
+    try:
+        start = parser.parse(meeting_details.date + ' ' + meeting_details.start_time)
+    except (TypeError, ValueError, OverflowError):
+        return
+    if start.tzinfo is None:
+        default = calendar_utils.default_timezone
+        start = start.replace(tzinfo=tz.gettz(meeting_details.timezone or default) or tz.gettz(default))
+    index.add(start, start + dt.timedelta(minutes=meeting_details.duration or DEFAULT_DURATION_MINUTES))
@@ -0,0 +1,227 @@
+"""End-to-end throughput of main.run_workflow against fake Gmail, Calendar and OpenAI services.
+
+The fakes serve a synthetic inbox from ``benchmarks.fakes.make_corpus`` with
+configurable latency, jitter and transient error rate. The run reports
+emails/sec, p50/p95 latency of each workflow stage, API requests per email and
+peak Python memory (traced with ``tracemalloc``, which itself adds some
+overhead), and writes them as JSON so runs on different commits can be
+compared. Run from the repository root:
+
+    python benchmarks/bench_e2e.py --messages 500 --llm-latency-ms 300 --error-rate 0.02
+    python benchmarks/bench_e2e.py --messages 500 --baseline benchmarks/results/e2e-<commit>.json
+"""
+import argparse
+import collections
+import contextlib
+import datetime as dt
+import functools
+import json
+import logging
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, Iterator, List
+from unittest.mock import patch
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.fakes import FakeCalendar, FakeGmail, FakeOpenAI, make_corpus, transient_google_error, transient_openai_error  # noqa: E402
+import main  # noqa: E402
+import metrics  # noqa: E402
+import normalize  # noqa: E402
+import prefilter  # noqa: E402
+import rate_limit  # noqa: E402
+import workflow  # noqa: E402
+
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "results")
+# workflow functions timed as stages; each sample is one call for one email
+STAGES = {
+    "normalize": "format_plaintext_email",
+    "prefilter": "prefilter_email",
+    "classify": "is_meeting_request",
+    "extract": "extract_meeting_details",
+    "calendar": "create_calendar_event",
+    "availability": "propose_slots",
+    "compose": "compose_availability_email",
+    "reply": "send_reply_email",
+}
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """Nearest-rank percentile of ``samples``, ``q`` in [0, 100]."""
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = collections.defaultdict(list)
+
+    def wrap(self, stage: str, fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.samples[stage].append(time.perf_counter() - start)
+        return timed
+
+    def wrap_iterator(self, stage: str, fn: Callable[..., Iterator]) -> Callable[..., Iterator]:
+        """Time how long the workflow waits for each item, which is where batched fetches show up."""
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            iterator = iter(fn(*args, **kwargs))
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                self.samples[stage].append(time.perf_counter() - start)
+                yield item
+        return timed
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        return {stage: {"count": len(samples), "p50_ms": percentile(samples, 50) * 1000,
+                        "p95_ms": percentile(samples, 95) * 1000, "total_s": sum(samples)}
+                for stage, samples in self.samples.items() if samples}
+
+
+def git_commit() -> Any:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_e2e(args: argparse.Namespace) -> Dict[str, Any]:
+    corpus = make_corpus(args.messages, args.meeting_ratio, args.seed)
+    google_options = dict(jitter=args.google_jitter_ms / 1000, error_rate=args.error_rate, seed=args.seed)
+    gmail = FakeGmail(args.messages, args.google_latency_ms / 1000, corpus=corpus, **google_options)
+    calendar = FakeCalendar(args.google_latency_ms / 1000, **google_options)
+    llm = FakeOpenAI(args.llm_latency_ms / 1000, jitter=args.llm_jitter_ms / 1000, error_rate=args.error_rate,
+                     seed=args.seed)
+    timer = StageTimer()
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(patch("main.get_gmail_service", return_value=gmail))
+        stack.enter_context(patch("main.get_calendar_service", return_value=calendar))
+        stack.enter_context(patch("llm_calls.client", llm))
+        # retries keep the production backoff shape, scaled down to the fakes' latency
+        stack.enter_context(patch("rate_limit.BACKOFF_BASE_SECONDS", args.backoff_ms / 1000))
+        if args.header_rules:
+            # what a deployment without a trained model runs; no labels are written
+            stack.enter_context(patch("prefilter.active", prefilter.Prefilter()))
+            stack.enter_context(patch("prefilter.labels_path", None))
+        stack.enter_context(patch("workflow.iter_unread_emails", timer.wrap_iterator("fetch", workflow.iter_unread_emails)))
+        for stage, name in STAGES.items():
+            stack.enter_context(patch(f"workflow.{name}", timer.wrap(stage, getattr(workflow, name))))
+        # load what the workflow imports lazily, so peak memory measures the emails rather than the libraries
+        transient_google_error()
+        transient_openai_error()
+        normalize.get_encoding()
+        metrics.reset()
+        tracemalloc.start()
+        start = time.perf_counter()
+        processed = main.run_workflow("Benchmark User", processed_label=args.processed_label,
+                                      collapse_threads=not args.no_thread_dedup)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    apis = {"gmail": gmail.report(), "calendar": calendar.report(), "openai": llm.report()}
+    return {
+        "benchmark": "e2e",
+        "commit": git_commit(),
+        "timestamp": dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "corpus": dict(collections.Counter(message["kind"] for message in corpus)),
+        "emails": processed,
+        "elapsed_s": elapsed,
+        "emails_per_second": processed / elapsed if elapsed else 0.0,
+        "stages": timer.report(),
+        "apis": apis,
+        "requests_per_email": {name: sum(api["requests"].values()) / max(processed, 1) for name, api in apis.items()},
+        "round_trips_per_email": {name: api["round_trips"] / max(processed, 1) for name, api in apis.items()},
+        "marked_read": len(gmail.marked_read),
+        "events_created": len(calendar.event_ids),
+        "replies_sent": gmail.sent,
+        "peak_memory_mb": peak / 2**20,
+        # the workflow's own counters, including retries and OpenAI token usage
+        "metrics": metrics.snapshot(),
+    }
+
+
+def print_results(results: Dict[str, Any]):
+    print(f"emails={results['emails']} elapsed={results['elapsed_s']:.2f}s emails/sec={results['emails_per_second']:.1f} "
+          f"peak_memory={results['peak_memory_mb']:.1f}MB")
+    print(f"marked_read={results['marked_read']} events_created={results['events_created']} "
+          f"replies_sent={results['replies_sent']}")
+    for stage, stats in results["stages"].items():
+        print(f"  {stage:<12} n={stats['count']:<5} p50={stats['p50_ms']:8.2f}ms p95={stats['p95_ms']:8.2f}ms")
+    for name, api in results["apis"].items():
+        print(f"  {name:<12} requests/email={results['requests_per_email'][name]:.2f} "
+              f"round_trips/email={results['round_trips_per_email'][name]:.2f} errors={api['errors']}")
+
+
+def compare(baseline: Dict[str, Any], results: Dict[str, Any]):
+    """Print the change from ``baseline``; throughput up and everything else down is better."""
+    def change(label, old, new):
+        if old:
+            print(f"  {label:<32} {old:10.2f} -> {new:10.2f} ({(new - old) / old:+.0%})")
+
+    print(f"compared with {baseline.get('commit') or 'baseline'}:")
+    change("emails/sec", baseline["emails_per_second"], results["emails_per_second"])
+    change("peak memory MB", baseline["peak_memory_mb"], results["peak_memory_mb"])
+    for stage, stats in results["stages"].items():
+        if stage in baseline["stages"]:
+            change(f"{stage} p95 ms", baseline["stages"][stage]["p95_ms"], stats["p95_ms"])
+    for name, value in results["requests_per_email"].items():
+        change(f"{name} requests/email", baseline["requests_per_email"].get(name, 0), value)
+    if baseline.get("config") != results["config"]:
+        print("  note: the runs used different settings")
+
+
+def run_benchmark():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--messages", type=int, default=200)
+    arg_parser.add_argument("--meeting-ratio", type=float, default=0.2)
+    arg_parser.add_argument("--seed", type=int, default=0, help="Seed for the corpus, jitter and injected errors.")
+    arg_parser.add_argument("--google-latency-ms", type=float, default=20.0)
+    arg_parser.add_argument("--google-jitter-ms", type=float, default=10.0)
+    arg_parser.add_argument("--llm-latency-ms", type=float, default=100.0)
+    arg_parser.add_argument("--llm-jitter-ms", type=float, default=50.0)
+    arg_parser.add_argument("--error-rate", type=float, default=0.0, help="Share of API requests failing with a transient 5xx.")
+    arg_parser.add_argument("--backoff-ms", type=float, default=20.0, help="Base retry backoff used instead of the production one.")
+    arg_parser.add_argument("--processed-label", type=str, default=None)
+    arg_parser.add_argument("--header-rules", action="store_true", help="Apply the prefilter's header rules, as without a trained model.")
+    arg_parser.add_argument("--no-thread-dedup", action="store_true", help="Process every message instead of the newest per thread.")
+    arg_parser.add_argument("--output", type=str, default=None, help="Results file; defaults to benchmarks/results/e2e-<commit>.json.")
+    arg_parser.add_argument("--baseline", type=str, default=None, help="Results file from an earlier run to compare against.")
+    args = arg_parser.parse_args()
+    # retry warnings would drown the report; errors are still shown
+    logging.disable(logging.WARNING)
+    # the fakes have no quota; throttling would only measure the configured limits
+    rate_limit.disable_limits()
+
+    results = run_e2e(args)
+    print_results(results)
+    output = args.output or os.path.join(RESULTS_DIR, f"e2e-{(results['commit'] or 'unknown')[:12]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,71 @@
+"""Compare throughput of the serial run_workflow loop with the concurrent pipeline.
+
+Gmail, Calendar and OpenAI are replaced by in-process fakes with fixed per-call
+latency. Run from the repository root:
+
+    python benchmarks/bench_pipeline.py --messages 200 --google-latency-ms 30 --llm-latency-ms 300
+"""
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
+import sys
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fakes import FakeAsyncOpenAI, FakeCalendar, FakeGmail, FakeOpenAI  # noqa: E402
+import main  # noqa: E402
+import pipeline  # noqa: E402
+import rate_limit  # noqa: E402
+
+
+def run_serial(gmail: FakeGmail, calendar: FakeCalendar, llm: FakeOpenAI):
+    with patch("main.get_gmail_service", return_value=gmail), \
+         patch("main.get_calendar_service", return_value=calendar), \
+         patch("llm_calls.client", llm), \
+         contextlib.suppress(SystemExit):
+        main.run_workflow("Benchmark User")
+
+
+def run_pipelined(gmail: FakeGmail, calendar: FakeCalendar, llm: FakeAsyncOpenAI):
+    services = SimpleNamespace(gmail=lambda: gmail, calendar=lambda: calendar)
+    with patch("pipeline.get_session", return_value=services), \
+         patch("llm_calls.async_client", llm):
+        asyncio.run(pipeline.run_workflow_async("Benchmark User"))
+
+
+def measure(label: str, fn, llm_class, args) -> float:
+    gmail = FakeGmail(args.messages, args.google_latency_ms / 1000, meeting_ratio=args.meeting_ratio)
+    calendar = FakeCalendar(args.google_latency_ms / 1000)
+    llm = llm_class(args.llm_latency_ms / 1000)
+    start = time.perf_counter()
+    fn(gmail, calendar, llm)
+    elapsed = time.perf_counter() - start
+    rate = args.messages / elapsed
+    print(f"{label:<10} elapsed={elapsed:.2f}s emails/sec={rate:.1f} "
+          f"gmail_calls={gmail.round_trips} calendar_calls={calendar.round_trips} llm_calls={llm.round_trips}")
+    return rate
+
+
+def run_benchmark():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--messages", type=int, default=100)
+    arg_parser.add_argument("--meeting-ratio", type=float, default=0.2)
+    arg_parser.add_argument("--google-latency-ms", type=float, default=20.0)
+    arg_parser.add_argument("--llm-latency-ms", type=float, default=100.0)
+    args = arg_parser.parse_args()
+    logging.disable(logging.INFO)
+    # the fakes have no quota; throttling would only measure the configured limits
+    rate_limit.disable_limits()
+
+    serial = measure("serial", run_serial, FakeOpenAI, args)
+    pipelined = measure("pipeline", run_pipelined, FakeAsyncOpenAI, args)
+    print(f"pipeline speedup: {pipelined / serial:.1f}x")
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,88 @@
+"""Measure the time from process start to the first Gmail API call.
+
+Each run is a fresh interpreter working against a temporary token.json, with
+httplib2 answering the first request locally. ``eager`` reproduces the previous
+startup (OpenAI clients built at import, credentials loaded and a service built
+separately for Calendar and Gmail); ``session`` is the current path through
+``oauth_utils.get_session``. Run from the repository root:
+
+    python benchmarks/bench_startup.py --runs 5
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ("eager", "session")
+
+
+def write_token(directory: str):
+    expiry = dt.datetime.now(dt.timezone.utc).replace(tzinfo=None) + dt.timedelta(hours=1)
+    token = {"token": "benchmark", "refresh_token": "benchmark", "client_id": "benchmark",
+             "client_secret": "benchmark", "token_uri": "https://oauth2.googleapis.com/token",
+             "expiry": expiry.isoformat() + "Z"}
+    with open(os.path.join(directory, "token.json"), "w") as f:
+        json.dump(token, f)
+
+
+def child(mode: str):
+    """Start the app the way ``mode`` does and print the wall-clock time of the first API call."""
+    import httplib2
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        print(time.time(), flush=True)
+        sys.exit(0)
+
+    httplib2.Http.request = request
+    if mode == "eager":
+        import openai
+        openai.OpenAI(api_key="benchmark")
+        openai.AsyncOpenAI(api_key="benchmark")
+        import main  # noqa: F401
+        from googleapiclient.discovery import build
+        from oauth_utils import load_credentials
+        build("calendar", "v3", credentials=load_credentials())
+        gmail_service = build("gmail", "v1", credentials=load_credentials())
+    else:
+        import main
+        main.get_calendar_service()
+        gmail_service = main.get_gmail_service()
+    gmail_service.users().messages().list(userId="me", labelIds=["UNREAD"], maxResults=100).execute()
+
+
+def time_to_first_call(mode: str, directory: str) -> float:
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    env.pop("OPENAI_API_KEY", None)
+    start = time.time()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", mode], cwd=directory, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return float(output.split()[-1]) - start
+
+
+def run_benchmark():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--runs", type=int, default=5)
+    arg_parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+    if args.child:
+        child(args.child)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_token(directory)
+        medians = {}
+        for mode in MODES:
+            times = [time_to_first_call(mode, directory) for _ in range(args.runs)]
+            medians[mode] = statistics.median(times)
+            print(f"{mode:<8} first_api_call p50={medians[mode] * 1000:.0f}ms min={min(times) * 1000:.0f}ms")
+    print(f"startup speedup: {medians['eager'] / medians['session']:.1f}x")
+
+
+if __name__ == "__main__":
+    run_benchmark()
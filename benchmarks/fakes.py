@@ -0,0 +1,360 @@
+"""In-process stand-ins for the Gmail, Calendar and OpenAI clients used by the benchmarks.
+
+Every fake counts its round-trips and the requests it serves per method, sleeps
+``latency`` seconds (plus up to ``jitter`` more) per round-trip, and fails a
+share ``error_rate`` of requests with a transient 5xx, so sequential and
+concurrent strategies can be compared without network access.
+"""
+import asyncio
+import base64
+import collections
+import datetime as dt
+import email.message
+import email.policy
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+from dateutil import parser
+
+from schemas import IsMeetingRequest, MeetingDetails
+
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
+TOPICS = ["the Q4 budget", "the launch plan", "hiring for the data team", "the vendor contract", "onboarding",
+          "the quarterly roadmap", "the customer escalation", "the design review"]
+NAMES = ["Alex Kim", "Sam Rivera", "Jordan Lee", "Taylor Brooks", "Morgan Chen", "Casey Patel", "Riley Novak"]
+SIGNATURE = "\n\nBest,\n{name}\nSenior Manager | Example Corp\n+1 555 0100"
+DISCLAIMER = ("\n\nCONFIDENTIALITY NOTICE: This email and any attachments are confidential and intended solely "
+              "for the addressee. If you have received this email in error, please notify the sender.")
+# meeting requests with a time can be scheduled; the others get an availability reply
+TIMED_MEETING_BODIES = [
+    "Hi,\n\nCan we meet on {day} at {hour}pm to go over {topic}? It should take about 30 minutes.",
+    "Hello,\n\nWould {day} at {hour}:30am work for a call about {topic}? I can send a dial-in.",
+]
+UNTIMED_MEETING_BODIES = [
+    "Hi,\n\nCould we find some time next week to talk about {topic}? Let me know what works for you.",
+    "Hey,\n\nI'd like to set up a meeting about {topic}. When are you free?",
+]
+CONVERSATION_BODIES = [
+    "Thanks for sending this over. I've reviewed {topic} and left a few comments in the doc.",
+    "Quick update on {topic}: we're on track and I'll share the numbers by {day}.",
+    "I looked into {topic} and I think we should hold off until next quarter.",
+]
+NEWSLETTER_HTML = ("<html><head><style>td {{font-family: Arial}}</style></head><body><table><tr><td>"
+                   "<h1>This week at Example News</h1>" + "<p>{paragraph}</p>" * 6 +
+                   "<p><a href='https://news.example.com/unsubscribe'>Unsubscribe</a></p></td></tr></table></body></html>")
+NOTIFICATION_BODY = "Your {topic} report for {day} is ready. Sign in to view it.\n\nThis is an automated message, please do not reply."
+NEWSLETTER_PARAGRAPH = ("Here is what happened this week across the industry, with analysis of {topic} and "
+                        "what it means for teams like yours. Read the full story on our website.")
+
+
+def make_message(i: int, kind: str, rng: random.Random, quoted: Optional[str] = None) -> email.message.EmailMessage:
+    name = rng.choice(NAMES)
+    fields = {"day": rng.choice(DAYS), "hour": rng.randint(1, 11), "topic": rng.choice(TOPICS), "name": name}
+    msg = email.message.EmailMessage()
+    address = name.lower().replace(" ", ".") + "@example.com"
+    msg['From'] = f"{name} <{address}>"
+    msg['To'] = "me@example.com"
+    msg['Date'] = f"{rng.choice(['Mon', 'Tue', 'Wed', 'Thu', 'Fri'])}, {10 + i % 18} Oct 2023 {8 + i % 10:02d}:{i % 60:02d}:00 -0400"
+    msg['Message-ID'] = f"<{i}@example.com>"
+    if kind == "newsletter":
+        msg.replace_header('From', "Example News <news@news.example.com>")
+        msg['Subject'] = f"Weekly digest #{i}"
+        msg['List-Unsubscribe'] = "<https://news.example.com/unsubscribe>"
+        msg.set_content(NEWSLETTER_HTML.format(paragraph=NEWSLETTER_PARAGRAPH.format(**fields)), subtype="html")
+        return msg
+    if kind == "notification":
+        msg.replace_header('From', "Example Reports <no-reply@reports.example.com>")
+        msg['Subject'] = f"Your report is ready ({i})"
+        msg['Auto-Submitted'] = "auto-generated"
+        msg.set_content(NOTIFICATION_BODY.format(**fields))
+        return msg
+    templates = {"timed_meeting": TIMED_MEETING_BODIES, "untimed_meeting": UNTIMED_MEETING_BODIES,
+                 "conversation": CONVERSATION_BODIES}[kind]
+    body = rng.choice(templates).format(**fields) + SIGNATURE.format(**fields)
+    if rng.random() < 0.3:
+        body += DISCLAIMER
+    msg['Subject'] = ("Meeting about " if kind != "conversation" else "Re: ") + fields["topic"]
+    if quoted is not None:
+        body += f"\n\nOn {msg['Date']} {name} <{address}> wrote:\n" + "\n".join("> " + line for line in quoted.split("\n"))
+    msg.set_content(body)
+    return msg
+
+
+def make_corpus(count: int, meeting_ratio: float = 0.2, seed: int = 0) -> List[Dict[str, str]]:
+    """Generate ``count`` Gmail messages resembling a work inbox, in the ``messages.get(format="raw")`` shape.
+
+    About ``meeting_ratio`` of them are meeting requests, most with a date and
+    time. The rest are newsletters (HTML only, with ``List-Unsubscribe``),
+    automated notifications and ordinary conversation. Some messages reply to
+    an earlier one in the same thread and quote it, signature and all.
+    """
+    rng = random.Random(seed)
+    other = 1 - meeting_ratio
+    kinds = ["timed_meeting", "untimed_meeting", "conversation", "newsletter", "notification"]
+    weights = [meeting_ratio * 0.7, meeting_ratio * 0.3, other * 0.4, other * 0.35, other * 0.25]
+    corpus = []
+    threads: List[Dict[str, Any]] = []
+    for i in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        thread = None
+        if kind in ("timed_meeting", "untimed_meeting", "conversation") and threads and rng.random() < 0.3:
+            thread = rng.choice(threads)
+        msg = make_message(i, kind, rng, quoted=thread["body"] if thread else None)
+        if thread is None:
+            thread = {"id": f"t{i}", "body": ""}
+            threads.append(thread)
+        thread["body"] = msg.get_content() if msg.get_content_type() == "text/plain" else ""
+        corpus.append({"id": str(i), "threadId": thread["id"], "kind": kind,
+                       "raw": base64.urlsafe_b64encode(msg.as_bytes()).decode('ASCII')})
+    return corpus
+
+
+def metadata_response(message: Dict[str, str], headers: Optional[List[str]] = None) -> Dict[str, Any]:
+    """The ``messages.get(format="metadata")`` view of a corpus message."""
+    msg = email.message_from_bytes(base64.urlsafe_b64decode(message["raw"]), policy=email.policy.default)
+    wanted = {header.lower() for header in headers} if headers is not None else None
+    body = msg.get_body(("plain", "html"))
+    snippet = " ".join((body.get_content() if body is not None else "").split())[:200]
+    return {"id": message["id"], "threadId": message["threadId"], "snippet": snippet,
+            "payload": {"mimeType": msg.get_content_type(),
+                        "headers": [{"name": name, "value": str(value)} for name, value in msg.items()
+                                    if wanted is None or name.lower() in wanted]}}
+
+
+def transient_google_error() -> Exception:
+    import httplib2
+    from googleapiclient.errors import HttpError
+    return HttpError(httplib2.Response({"status": 503}), b'{"error": {"message": "backendError"}}')
+
+
+def transient_openai_error() -> Exception:
+    import httpx
+    import openai
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    return openai.InternalServerError("server error", response=httpx.Response(500, request=request), body=None)
+
+
+class CallCounter:
+    def __init__(self, latency: float, jitter: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.round_trips = 0
+        # requests served per method, counting each part of a batch request
+        self.requests: Dict[str, int] = collections.Counter()
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def delay(self) -> float:
+        with self.lock:
+            self.round_trips += 1
+            return self.latency + self.rng.uniform(0, self.jitter)
+
+    def round_trip(self):
+        time.sleep(self.delay())
+
+    def serve(self, method: str) -> Optional[Exception]:
+        """Count one request and return the transient error it fails with, if it does."""
+        with self.lock:
+            self.requests[method] += 1
+            if self.rng.random() < self.error_rate:
+                self.errors += 1
+                return self.error()
+        return None
+
+    def error(self) -> Exception:
+        return transient_google_error()
+
+    def report(self) -> Dict[str, Any]:
+        return {"round_trips": self.round_trips, "requests": dict(self.requests), "errors": self.errors}
+
+
+class FakeRequest:
+    def __init__(self, counter: CallCounter, method: str, response):
+        self.counter = counter
+        self.method = method
+        self.response = response
+
+    def execute(self):
+        self.counter.round_trip()
+        error = self.counter.serve(self.method)
+        if error is not None:
+            raise error
+        return self.response()
+
+
+class FakeBatch:
+    def __init__(self, counter: CallCounter, callback):
+        self.counter = counter
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.counter.round_trip()
+        for request_id, request in self.requests:
+            error = self.counter.serve(request.method)
+            self.callback(request_id, None if error else request.response(), error)
+
+
+class FakeGmail(CallCounter):
+    """Implements users.messages list/get/modify/batchModify/send, labels and batch requests over a synthetic inbox."""
+
+    def __init__(self, count: int, latency: float, meeting_ratio: float = 0.0, corpus: Optional[List[Dict[str, str]]] = None,
+                 **options: Any):
+        super().__init__(latency, **options)
+        self.corpus = {message["id"]: message for message in (corpus or make_corpus(count, meeting_ratio))}
+        self.marked_read = set()
+        self.sent = 0
+        self.labels_created: List[Dict[str, str]] = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def list(self, userId, labelIds=None, maxResults=100, pageToken=None):
+        ids = list(self.corpus)
+        start = int(pageToken or 0)
+        page = ids[start:start + maxResults]
+
+        def response():
+            result = {"messages": [{"id": i, "threadId": self.corpus[i]["threadId"]} for i in page]}
+            if start + maxResults < len(ids):
+                result["nextPageToken"] = str(start + maxResults)
+            return result
+        return FakeRequest(self, "messages.list", response)
+
+    def get(self, userId, id, format, metadataHeaders=None):
+        message = self.corpus[id]
+        if format == "metadata":
+            return FakeRequest(self, "messages.get", lambda: metadata_response(message, metadataHeaders))
+        return FakeRequest(self, "messages.get", lambda: {"id": id, "threadId": message["threadId"], "raw": message["raw"]})
+
+    def modify(self, userId, id, body):
+        def response():
+            self.marked_read.add(id)
+            return {"id": id}
+        return FakeRequest(self, "messages.modify", response)
+
+    def batchModify(self, userId, body):
+        def response():
+            self.marked_read.update(body["ids"])
+            return {}
+        return FakeRequest(self, "messages.batchModify", response)
+
+    def send(self, userId, body):
+        def response():
+            with self.lock:
+                self.sent += 1
+            return {"id": "sent"}
+        return FakeRequest(self, "messages.send", response)
+
+    def labels(self):
+        return SimpleNamespace(list=self.list_labels, create=self.create_label)
+
+    def list_labels(self, userId):
+        return FakeRequest(self, "labels.list", lambda: {"labels": list(self.labels_created)})
+
+    def create_label(self, userId, body):
+        def response():
+            label = {"id": f"Label_{len(self.labels_created) + 1}", "name": body["name"]}
+            self.labels_created.append(label)
+            return label
+        return FakeRequest(self, "labels.create", response)
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+
+class FakeCalendar(CallCounter):
+    def __init__(self, latency: float, **options: Any):
+        super().__init__(latency, **options)
+        self.event_ids = set()
+
+    def events(self):
+        return self
+
+    def insert(self, calendarId, body):
+        def response():
+            with self.lock:
+                self.event_ids.add(body.get("id"))
+            return {"htmlLink": "https://calendar.example.com/event"}
+        return FakeRequest(self, "events.insert", response)
+
+    def freebusy(self):
+        return SimpleNamespace(query=self.query_freebusy)
+
+    def query_freebusy(self, body):
+        def response():
+            # a one-hour meeting every other hour of the requested window
+            start = parser.isoparse(body["timeMin"]).replace(minute=0, second=0)
+            end = parser.isoparse(body["timeMax"])
+            busy = []
+            while start < end:
+                busy.append({"start": start.isoformat(), "end": (start + dt.timedelta(hours=1)).isoformat()})
+                start += dt.timedelta(hours=2)
+            return {"calendars": {item["id"]: {"busy": busy} for item in body["items"]}}
+        return FakeRequest(self, "freebusy.query", response)
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+
+def _fake_parse_response(messages, response_format):
+    text = messages[-1]["content"]
+    if response_format is IsMeetingRequest:
+        parsed = IsMeetingRequest(is_meeting_request=bool(re.search(r"\bmeet|\bcall\b|free\?", text)))
+    else:
+        # the corpus only gives a time as "<hour>pm" or "<hour>:30am"
+        timed = re.search(r"\b(\d{1,2})(?::30)?[ap]m\b", text)
+        parsed = MeetingDetails(summary="Meeting", agenda=None, date="2023-10-11" if timed else None,
+                                start_time=f"{int(timed.group(1)):02d}:00" if timed else None, duration=30,
+                                location=None, timezone=None, attendees=[])
+    prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(parsed=parsed, content="Which times work for you?"))],
+                           usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=20, total_tokens=prompt_tokens + 20))
+
+
+class FakeOpenAI(CallCounter):
+    """Synchronous client exposing beta.chat.completions.parse and chat.completions.create."""
+
+    def __init__(self, latency: float, **options: Any):
+        super().__init__(latency, **options)
+        completions = SimpleNamespace(parse=self.parse, create=self.create)
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        self.chat = SimpleNamespace(completions=completions)
+
+    def error(self) -> Exception:
+        return transient_openai_error()
+
+    def respond(self, method, messages, response_format):
+        error = self.serve(method)
+        if error is not None:
+            raise error
+        return _fake_parse_response(messages, response_format)
+
+    def parse(self, model, messages, response_format):
+        self.round_trip()
+        return self.respond("chat.completions.parse", messages, response_format)
+
+    def create(self, model, messages):
+        self.round_trip()
+        return self.respond("chat.completions.create", messages, None)
+
+
+class FakeAsyncOpenAI(FakeOpenAI):
+    async def parse(self, model, messages, response_format):
+        await asyncio.sleep(self.delay())
+        return self.respond("chat.completions.parse", messages, response_format)
+
+    async def create(self, model, messages):
+        await asyncio.sleep(self.delay())
+        return self.respond("chat.completions.create", messages, None)
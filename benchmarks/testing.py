@@ -0,0 +1,49 @@
+"""Emails, meeting details and a batch request shared by the unit tests in ``tests/``."""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from schemas import MeetingDetails
+
+MEETING_BODY = "Can we meet tomorrow at 10am?"
+
+
+def make_email(i: int = 0, body: str = MEETING_BODY, **headers: str) -> Dict[str, str]:
+    """An email dict as the fetchers return it, numbered ``i``; ``headers`` override or add fields."""
+    return {
+        "Id": str(i),
+        "ThreadId": f"t{i}",
+        "From": f"sender{i}@example.com",
+        "To": "me@example.com",
+        "Subject": f"Subject {i}",
+        "Date": "Tue, 10 Oct 2023 09:00:00 -0400",
+        "Message-ID": f"<{i}@example.com>",
+        "Body": body,
+        **headers,
+    }
+
+
+def make_details(date: Optional[str] = "2023-10-11", start_time: Optional[str] = "10:00", duration: int = 30,
+                 attendees: Optional[List[str]] = None) -> MeetingDetails:
+    return MeetingDetails(summary="Sync", agenda=None, date=date, start_time=start_time, duration=duration,
+                          location=None, timezone=None, attendees=attendees or [])
+
+
+class FakeBatch:
+    """Stands in for BatchHttpRequest, answering each sub-request with ``respond(request_id, request)``.
+
+    An exception returned by ``respond`` is handed to the callback as that sub-request's error.
+    """
+
+    def __init__(self, callback: Callable, respond: Callable[[str, Any], Any] = lambda request_id, request: {"id": request_id}):
+        self.callback = callback
+        self.respond = respond
+        self.requests: List[Tuple[Optional[str], Any]] = []
+
+    def add(self, request: Any, request_id: Optional[str] = None) -> None:
+        self.requests.append((request_id, request))
+
+    def execute(self) -> None:
+        for request_id, request in self.requests:
+            response = self.respond(request_id, request)
+            if isinstance(response, Exception):
+                self.callback(request_id, None, response)
+            else:
+                self.callback(request_id, response, None)
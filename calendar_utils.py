@@ -1,19 +1,57 @@
 import datetime as dt
+import hashlib
 import logging
 from dateutil import parser
-from typing import Any
+from typing import Any, Dict, List, Optional, Set, Tuple
 from schemas import MeetingDetails
 from googleapiclient.errors import HttpError
+from rate_limit import execute, execute_batch
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def create_calendar_event(service: Any, meeting_details: MeetingDetails):
+# Calendar allows up to 1,000 calls per batch; smaller batches fail less as a unit
+BATCH_SIZE = 50
+# event ids must be 5-1024 characters from base32hex (0-9, a-v)
+EVENT_ID_PREFIX = "sched"
+# used when an email does not say which time zone its meeting is in and --timezone is not given
+DEFAULT_TIMEZONE = "America/New_York"
+# used when an email does not say how long its meeting is
+DEFAULT_DURATION_MINUTES = 60
+
+# the user's time zone, set from --timezone with set_default_timezone()
+default_timezone = DEFAULT_TIMEZONE
+
+def set_default_timezone(timezone: str):
+    global default_timezone
+    default_timezone = timezone
+
+def add_email_participants(meeting_details: MeetingDetails, msg_dict: Dict[str, str]):
+    if msg_dict['To'] not in meeting_details.attendees: # recipient is attendee
+        meeting_details.attendees.append(msg_dict['To'])
+    if msg_dict['From'] not in meeting_details.attendees: # sender is attendee. note: not always true if secretary scheduling for others
+        meeting_details.attendees.append(msg_dict['From'])
+
+def event_id_for(msg_dict: Dict[str, str], meeting_details: MeetingDetails) -> str:
+    """Deterministic Calendar event id for the meeting ``msg_dict`` asks for.
+
+    Derived from the email's thread (falling back to the root of its References
+    chain, then its Message-ID) and the meeting's start, so reruns and other
+    emails in the same thread about the same meeting map to the same event.
+    Event ids may only use base32hex characters, which hex digits satisfy.
+    """
+    references = msg_dict.get('References', '').split()
+    thread_key = msg_dict.get('ThreadId') or (references[0] if references else None) or msg_dict.get('Message-ID') or msg_dict['Id']
+    start_time = parser.parse(meeting_details.date + ' ' + meeting_details.start_time).isoformat()
+    digest = hashlib.sha1(f"{thread_key}|{start_time}".encode("utf-8")).hexdigest()
+    return EVENT_ID_PREFIX + digest
+
+def build_event(meeting_details: MeetingDetails, event_id: Optional[str] = None) -> Dict[str, Any]:
     start_time = parser.parse(meeting_details.date + ' ' + meeting_details.start_time).isoformat()
     if meeting_details.duration is not None:
         end_time = (dt.datetime.fromisoformat(start_time) + dt.timedelta(minutes=meeting_details.duration)).isoformat()
-    else: # default 1 hour
-        end_time = (dt.datetime.fromisoformat(start_time) + dt.timedelta(minutes=60)).isoformat()
+    else:
+        end_time = (dt.datetime.fromisoformat(start_time) + dt.timedelta(minutes=DEFAULT_DURATION_MINUTES)).isoformat()
     start = {'dateTime': start_time}
     end = {'dateTime': end_time}
     logger.info(f"start_time: {start_time}, end_time: {end_time}")
@@ -21,8 +59,8 @@ def create_calendar_event(service: Any, meeting_details: MeetingDetails):
         start['timeZone'] = meeting_details.timezone
         end['timeZone'] = meeting_details.timezone
     else:
-        start['timeZone'] = 'America/New_York'
-        end['timeZone'] = 'America/New_York'
+        start['timeZone'] = default_timezone
+        end['timeZone'] = default_timezone
     if meeting_details.summary is None:
         meeting_details.summary = "Meeting"
     event = {
@@ -33,9 +71,56 @@ def create_calendar_event(service: Any, meeting_details: MeetingDetails):
         'end': end,
         'attendees': [{"email": email} for email in meeting_details.attendees]
     }
+    if event_id is not None:
+        event['id'] = event_id
+    return event
+
+def is_duplicate_event_error(e: HttpError) -> bool:
+    # inserting an id that already exists (or existed and was deleted) returns 409
+    return e.resp.status == 409
+
+def create_calendar_event(service: Any, meeting_details: MeetingDetails, event_id: Optional[str] = None) -> bool:
+    """Insert the event, returning True once it exists in the calendar.
+
+    With ``event_id`` set, an event created by an earlier run counts as success
+    rather than being inserted twice.
+    """
+    event = build_event(meeting_details, event_id)
     try:
-        event = service.events().insert(calendarId='primary', body=event).execute()
+        event = execute(service.events().insert(calendarId='primary', body=event), "calendar", "events.insert")
         logger.info(f"Calendar event created: {event.get('htmlLink')}") 
+        return True
     except HttpError as e:
+        if event_id is not None and is_duplicate_event_error(e):
+            logger.info(f"Calendar event {event_id} already exists. Skipping")
+            return True
         logger.error(f"Error creating calendar event: {e}")
-        return
+        return False
+
+def create_calendar_events(service: Any, events: List[Tuple[MeetingDetails, str]], batch_size: int = BATCH_SIZE) -> Set[str]:
+    """Insert several events through the Calendar batch endpoint.
+
+    ``events`` pairs meeting details with their deterministic event ids. Returns
+    the ids that now exist in the calendar, including ones created by earlier runs.
+    """
+    created = set()
+
+    def callback(request_id, response, exception):
+        if exception is None:
+            created.add(request_id)
+        elif isinstance(exception, HttpError) and is_duplicate_event_error(exception):
+            logger.info(f"Calendar event {request_id} already exists. Skipping")
+            created.add(request_id)
+        else:
+            logger.error(f"Error creating calendar event {request_id}: {exception}")
+
+    for start in range(0, len(events), batch_size):
+        chunk = events[start:start + batch_size]
+        requests = [(event_id, service.events().insert(calendarId='primary', body=build_event(meeting_details, event_id)))
+                    for meeting_details, event_id in chunk]
+        try:
+            execute_batch(service, requests, callback, "calendar", "events.insert")
+        except HttpError as e:
+            logger.error(f"Error creating batch of {len(chunk)} calendar events: {e}")
+    logger.info(f"Created or found {len(created)} of {len(events)} calendar events")
+    return created
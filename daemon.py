@@ -0,0 +1,96 @@
+import logging
+import signal
+import threading
+from typing import Any, Optional
+from oauth_utils import get_session
+from availability import BusyIndex
+from gmail_utils import make_label_batcher, MAX_BATCH_MODIFY_IDS, FLUSH_SECONDS
+from llm_calls import log_cache_summary
+from metrics import export_metrics, log_metrics_summary
+from normalize import log_normalize_summary
+from journal import acknowledge, log_journal_summary
+from invites import log_extraction_summary
+from prefilter import log_prefilter_summary
+from workflow import process_emails
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MIN_POLL_SECONDS = 15.0
+MAX_POLL_SECONDS = 300.0
+
+
+class AdaptivePoller:
+    """Poll interval that tightens to ``min_interval`` when mail arrives and backs off while the inbox is quiet."""
+
+    def __init__(self, min_interval: float = MIN_POLL_SECONDS, max_interval: float = MAX_POLL_SECONDS, backoff: float = 2.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+
+    def next_interval(self, processed: int) -> float:
+        if processed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        return self.interval
+
+
+def install_stop_handlers(stop: threading.Event):
+    def handler(signum, frame):
+        logger.info(f"Received {signal.Signals(signum).name}. Stopping after the current email")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
+
+
+def run_daemon(username: str, min_interval: float = MIN_POLL_SECONDS, max_interval: float = MAX_POLL_SECONDS,
+               processed_label: Optional[str] = None, flush_size: int = MAX_BATCH_MODIFY_IDS,
+               flush_seconds: float = FLUSH_SECONDS, stop: Optional[threading.Event] = None, **fetch_options: Any) -> int:
+    """Process mail until SIGTERM/SIGINT (or ``stop``), keeping credentials and clients warm between polls.
+
+    Credentials are loaded once and refreshed ahead of expiry, the Google services
+    are built once, and the OpenAI clients stay alive for the life of the process.
+    ``fetch_options`` are passed on to ``process_emails``; ``incremental=True`` keeps
+    each quiet poll down to a single history call.
+    """
+    if stop is None:
+        stop = threading.Event()
+        install_stop_handlers(stop)
+    session = get_session()
+    calendar_service = session.calendar()
+    gmail_service = session.gmail()
+    poller = AdaptivePoller(min_interval, max_interval)
+    # busy times stay cached across polls until their TTL runs out
+    busy_index = BusyIndex()
+    total = 0
+    with make_label_batcher(gmail_service, processed_label, flush_size, flush_seconds, acknowledge) as read_marker:
+        while not stop.is_set():
+            processed = 0
+            try:
+                session.refresh_if_expiring()
+                processed = process_emails(username, calendar_service, gmail_service, read_marker, stop=stop,
+                                           busy_index=busy_index, **fetch_options)
+            except Exception:
+                # keep polling: a transient failure should not take the daemon down
+                logger.exception("Error processing mailbox")
+            total += processed
+            # emails handled but still unread would be listed and handled again by the next poll
+            read_marker.flush()
+            export_metrics()
+            interval = poller.next_interval(processed)
+            if processed:
+                logger.info(f"processed {processed} emails ({total} since start). next poll in {interval:.0f}s")
+            stop.wait(interval)
+    logger.info(f"daemon stopped. processed {total} emails")
+    log_cache_summary()
+    log_prefilter_summary()
+    log_normalize_summary()
+    log_journal_summary()
+    log_extraction_summary()
+    log_metrics_summary()
+    export_metrics()
+    return total
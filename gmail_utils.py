@@ -1,71 +1,663 @@
 import email
+import email.errors
+import email.header
+import email.message
 import base64
+import html
+import json
 import logging
+import os
 import re
+import threading
+import time
+from collections.abc import MutableMapping
 from dateutil import parser
-from typing import Any, List, Dict
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 from googleapiclient.errors import HttpError
+import metrics
+from normalize import html_to_text, normalize_email, normalize_thread
+from rate_limit import execute, execute_batch
 
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def get_unread_emails(service: Any) -> List[Dict[str, str]]:
-    try:
-        results = service.users().messages().list(userId="me", labelIds=["UNREAD"]).execute()
-        messages = results.get("messages", [])
-    except HttpError as e:
-        logger.error(f"Error getting unread emails: {e}")
-        return []
+# Gmail accepts up to 100 calls per batch but recommends staying at or below 50
+BATCH_SIZE = 50
+# messages.list returns at most 500 ids per page
+PAGE_SIZE = 100
+# messages.batchModify accepts at most 1,000 ids per call
+MAX_BATCH_MODIFY_IDS = 1000
+# how long a processed email may wait before its read state is flushed
+FLUSH_SECONDS = 30.0
+# where incremental sync keeps the last processed mailbox history id
+SYNC_STATE_FILE = "sync_state.json"
+# how many incremental runs a message that could not be handled is listed again
+MAX_SYNC_RETRIES = 5
+# the headers anything downstream reads; the rest of what Gmail returns is not kept
+HEADERS = ("From", "To", "Subject", "Date", "Message-ID", "In-Reply-To", "References",
+           "List-Unsubscribe", "List-Id", "Precedence", "Auto-Submitted")
+CALENDAR_TYPES = ('text/calendar', 'application/ics')
 
-    msg_dicts = []
-    for message in messages:
+
+# EmailRecord keys and the slots holding them
+RECORD_FIELDS = {"Id": "id", "ThreadId": "thread_id", "InternalDate": "internal_date", "Snippet": "snippet",
+                 **{header: header.lower().replace('-', '_') for header in HEADERS},
+                 "Earlier": "earlier", "Superseded": "superseded", "Body": "body", "Calendar": "calendar"}
+
+
+class EmailRecord(MutableMapping):
+    """One Gmail message, read like the dicts ``parse_raw_email`` returns.
+
+    Built from the ``metadata`` format: ids, Gmail's snippet and the ``HEADERS``
+    used downstream, held in slots instead of a dict of every header. ``Body``
+    and ``Calendar`` are only downloaded and decoded by ``loader`` the first
+    time either is read; iterating over the record never triggers that.
+    """
+    __slots__ = tuple(RECORD_FIELDS.values()) + ("mime_type", "loader")
+
+    def __init__(self, message_id: str, loader: Optional["MessageLoader"] = None):
+        for slot in self.__slots__:
+            setattr(self, slot, None)
+        self.id = message_id
+        self.loader = loader
+
+    @classmethod
+    def from_metadata(cls, message: Dict[str, Any], loader: Optional["MessageLoader"] = None) -> "EmailRecord":
+        record = cls(message['id'], loader)
+        record.thread_id = message.get('threadId')
+        record.internal_date = message.get('internalDate')
+        record.snippet = html.unescape(message.get('snippet', ''))
+        payload = message.get('payload', {})
+        record.mime_type = payload.get('mimeType')
+        names = {header.lower(): header for header in HEADERS}
+        for header in payload.get('headers', []):
+            name = names.get(header['name'].lower())
+            if name is not None and name not in record:
+                record[name] = header['value']
+        return record
+
+    def load(self, service: Any = None):
+        """Download the body now, with ``service`` if given (e.g. the calling thread's own)."""
+        if self.loader is not None:
+            self.loader.load(self, service)
+
+    def may_have_calendar(self) -> bool:
+        # a single text/plain or text/html part cannot carry an invite
+        return self.mime_type is None or self.mime_type.startswith('multipart/') or self.mime_type in CALENDAR_TYPES
+
+    def __getitem__(self, key: str) -> Any:
+        slot = RECORD_FIELDS[key]
+        if slot in ('body', 'calendar') and self.loader is not None:
+            if slot == 'calendar' and not self.may_have_calendar():
+                raise KeyError(key)
+            self.load()
+        value = getattr(self, slot)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any):
+        setattr(self, RECORD_FIELDS[key], value)
+
+    def __delitem__(self, key: str):
+        if getattr(self, RECORD_FIELDS[key]) is None:
+            raise KeyError(key)
+        setattr(self, RECORD_FIELDS[key], None)
+
+    def __iter__(self) -> Iterator[str]:
+        for key, slot in RECORD_FIELDS.items():
+            if getattr(self, slot) is not None:
+                yield key
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"EmailRecord({self.id!r}, loaded={self.loader is None})"
+
+
+def thread_records(msg_dict: Dict[str, str]) -> List[Dict[str, str]]:
+    return [msg_dict, *msg_dict.get('Earlier', [])]
+
+
+def is_loaded(msg_dict: Dict[str, str]) -> bool:
+    """Whether the bodies of ``msg_dict`` and of its thread's earlier messages have been downloaded."""
+    return all(not isinstance(record, EmailRecord) or record.loader is None for record in thread_records(msg_dict))
+
+
+def load_body(msg_dict: Dict[str, str], service: Any = None):
+    """Download the bodies of ``msg_dict`` and its thread's earlier messages, with ``service`` if given."""
+    for record in thread_records(msg_dict):
+        if isinstance(record, EmailRecord):
+            record.load(service)
+
+
+class MessageLoader:
+    """Downloads the raw MIME of one fetched chunk of ``EmailRecord`` s on demand.
+
+    The first record read pulls in, through the same batch request, its
+    thread's earlier messages and every other record of the chunk for which
+    ``needs_body`` is true (all of them without it), so a chunk normally costs
+    one more round-trip, and mail the caller expects to reject by its headers
+    alone is never downloaded.
+    """
+
+    def __init__(self, service: Any, batch_size: int = BATCH_SIZE,
+                 needs_body: Optional[Callable[[EmailRecord], bool]] = None):
+        self.service = service
+        self.batch_size = batch_size
+        self.needs_body = needs_body
+        self.records: List[EmailRecord] = []
+        self.lock = threading.Lock()
+
+    def load(self, record: EmailRecord, service: Any = None):
+        service = service or self.service
+        errors = {}
+        with self.lock:
+            if record.loader is None:
+                return
+            earlier = record.earlier or []
+            wanted = {record.id: record}
+            wanted.update((other.id, other) for other in earlier if isinstance(other, EmailRecord) and other.loader is self)
+            for other in self.records:
+                if len(wanted) >= self.batch_size:
+                    break
+                if other.loader is self and other.id not in wanted and (self.needs_body is None or self.needs_body(other)):
+                    wanted[other.id] = other
+            responses = {}
+
+            def callback(request_id, response, exception):
+                if exception is not None:
+                    logger.error(f"Error getting email body for message {request_id}: {exception}")
+                    errors[request_id] = exception
+                    return
+                responses[request_id] = response
+
+            requests = [(message_id, service.users().messages().get(userId="me", id=message_id, format="raw"))
+                        for message_id in wanted]
+            with metrics.span("fetch_body"):
+                # a long thread's earlier messages can take more than one batch request
+                for start in range(0, len(requests), self.batch_size):
+                    part = requests[start:start + self.batch_size]
+                    try:
+                        execute_batch(service, part, callback, "gmail", "messages.get")
+                    except HttpError as e:
+                        logger.error(f"Error getting batch of {len(part)} email bodies: {e}")
+                        errors.update((message_id, e) for message_id, _ in part)
+            for message_id, wanted_record in wanted.items():
+                if message_id not in responses:
+                    continue
+                mime_str = decode_raw_email(responses[message_id]['raw'])
+                if mime_str is None:
+                    continue
+                # the headers came with the metadata; only the body and invite are read from the raw message
+                wanted_record.body = get_mime_body(mime_str)
+                wanted_record.calendar = get_calendar_part(mime_str)
+                wanted_record.loader = None
+                metrics.count("messages_downloaded_total", format="raw")
+            self.records = [other for other in self.records if other.loader is self]
+        if record.loader is not None:
+            raise errors.get(record.id) or ValueError(f"Email {record.id} could not be decoded")
+
+
+def get_unread_emails(service: Any, batch_size: int = BATCH_SIZE) -> List[Dict[str, str]]:
+    return list(iter_unread_emails(service, max_in_flight=batch_size))
+
+
+def iter_unread_emails(service: Any, page_size: int = PAGE_SIZE, max_in_flight: int = BATCH_SIZE,
+                       collapse_threads: bool = False,
+                       needs_body: Optional[Callable[[EmailRecord], bool]] = None) -> Iterator[Dict[str, str]]:
+    """Yield every unread message, following ``nextPageToken`` across pages.
+
+    Pages are listed lazily and bodies are fetched ``max_in_flight`` at a time,
+    so at most one page of ids and one batch of bodies are held in memory and
+    the first message is available as soon as its batch returns. With
+    ``collapse_threads``, every page is listed first and only the newest message
+    of each thread is yielded (see ``iter_thread_emails``). ``needs_body`` tells
+    which messages to download alongside the first body read (see ``MessageLoader``).
+    """
+    if collapse_threads:
+        messages = [message for page in iter_unread_pages(service, page_size) for message in page]
+        yield from iter_thread_emails(service, messages, max_in_flight, needs_body)
+        return
+    for page in iter_unread_pages(service, page_size):
+        yield from iter_fetched_emails(service, [message['id'] for message in page], max_in_flight, needs_body)
+
+
+def iter_unread_pages(service: Any, page_size: int = PAGE_SIZE) -> Iterator[List[Dict[str, str]]]:
+    """Yield each page of unread messages as ``{"id", "threadId"}`` dicts."""
+    page_token = None
+    while True:
         try:
-            msg_headers = service.users().messages().get(userId="me", id=message['id'], format="metadata").execute()
-            msg_body = service.users().messages().get(userId="me", id=message['id'], format="raw").execute()
+            results = execute(service.users().messages().list(
+                userId="me", labelIds=["UNREAD"], maxResults=page_size, pageToken=page_token
+            ), "gmail", "messages.list")
+        except HttpError as e:
+            logger.error(f"Error getting unread emails: {e}")
+            return
+        yield results.get("messages", [])
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            return
 
-            msg_dict = {header['name']: header['value'] for header in msg_headers["payload"]["headers"]}
-            msg_dict['Body'] = get_email_body(msg_body['raw'])
-            msg_dict['Id'] = message['id']
-            msg_dicts.append(msg_dict)
+
+def iter_new_emails(service: Any, state_path: str = SYNC_STATE_FILE, page_size: int = PAGE_SIZE,
+                    max_in_flight: int = BATCH_SIZE, before_checkpoint: Optional[Callable[[], None]] = None,
+                    collapse_threads: bool = False, failed: Optional[Set[str]] = None,
+                    needs_body: Optional[Callable[[EmailRecord], bool]] = None) -> Iterator[Dict[str, str]]:
+    """Yield messages added to the inbox since the ``historyId`` saved in ``state_path``.
+
+    Without a saved history id, or once Gmail reports it as expired, this falls
+    back to a full resync of unread mail. The new history id is only saved after
+    every message has been consumed, so an interrupted run resumes from the
+    previous checkpoint instead of losing mail. Consumers that process messages
+    concurrently can pass ``before_checkpoint`` to wait for in-flight work first.
+    Messages that could not be fetched, and the ids the consumer adds to
+    ``failed``, are saved with the checkpoint and listed again by the next run,
+    up to ``MAX_SYNC_RETRIES`` times. ``collapse_threads`` and ``needs_body`` work
+    as for ``iter_unread_emails``.
+    """
+    state = load_sync_state(state_path)
+    start_history_id = state.get("historyId")
+    retries = state.get("retry", {})
+    messages, history_id = None, None
+    if start_history_id is not None:
+        try:
+            messages, history_id = list_history_messages(service, start_history_id, page_size)
         except HttpError as e:
-            logger.error(f"Error getting email headers or body for message {message['id']}: {e}")
+            if e.resp.status != 404:
+                logger.error(f"Error listing mailbox history: {e}")
+                return
+            logger.warning(f"History id {start_history_id} has expired. Falling back to a full resync")
+
+    if messages is None:
+        try:
+            # read the checkpoint before listing so mail arriving mid-sync is picked up next time
+            history_id = execute(service.users().getProfile(userId="me"), "gmail", "getProfile")["historyId"]
+        except HttpError as e:
+            logger.error(f"Error getting mailbox profile: {e}")
+            return
+        messages = [message for page in iter_unread_pages(service, page_size) for message in page]
+    else:
+        logger.info(f"Found {len(messages)} new messages since history id {start_history_id}")
+    listed = {message['id'] for message in messages}
+    messages += [{"id": message_id} for message_id in retries if message_id not in listed]
+    if len(messages) > len(listed):
+        logger.info(f"Retrying {len(messages) - len(listed)} messages an earlier run could not handle")
+
+    handled = set()
+    if collapse_threads:
+        msg_dicts = iter_thread_emails(service, messages, max_in_flight, needs_body)
+    else:
+        msg_dicts = iter_fetched_emails(service, [message['id'] for message in messages], max_in_flight, needs_body)
+    for msg_dict in msg_dicts:
+        handled.add(msg_dict['Id'])
+        handled.update(msg_dict.get('Superseded', []))
+        yield msg_dict
+
+    if before_checkpoint is not None:
+        before_checkpoint()
+    state = {"historyId": history_id}
+    unhandled = {message['id'] for message in messages} - handled | (failed or set())
+    for message_id in unhandled:
+        if retries.get(message_id, 0) >= MAX_SYNC_RETRIES:
+            logger.warning(f"Giving up on message {message_id} after {MAX_SYNC_RETRIES} retries")
             continue
-    return msg_dicts
+        state.setdefault("retry", {})[message_id] = retries.get(message_id, 0) + 1
+    save_sync_state(state_path, state)
 
 
-def get_email_body(encoded_message: Any) -> str:
+def list_history_messages(service: Any, start_history_id: str,
+                          page_size: int = PAGE_SIZE) -> Tuple[List[Dict[str, str]], str]:
+    """Return inbox messages (``{"id", "threadId"}``) added after ``start_history_id`` and the mailbox's current history id.
+
+    Raises ``HttpError`` (status 404) when ``start_history_id`` is too old to be replayed.
+    """
+    messages = []
+    seen = set()
+    page_token = None
+    while True:
+        results = execute(service.users().history().list(
+            userId="me", startHistoryId=start_history_id, historyTypes=["messageAdded"],
+            labelId="INBOX", maxResults=page_size, pageToken=page_token
+        ), "gmail", "history.list")
+        for record in results.get("history", []):
+            for added in record.get("messagesAdded", []):
+                message = added["message"]
+                label_ids = message.get("labelIds", [])
+                # skip our own replies and drafts
+                if "SENT" in label_ids or "DRAFT" in label_ids or message["id"] in seen:
+                    continue
+                seen.add(message["id"])
+                messages.append({"id": message["id"], "threadId": message.get("threadId", message["id"])})
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            return messages, results["historyId"]
+
+
+def load_sync_state(path: str) -> Dict[str, str]:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.error(f"Error reading sync state from {path}: {e}")
+        return {}
+
+
+def save_sync_state(path: str, state: Dict[str, str]):
+    # write then rename so a crash never leaves a truncated state file behind
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def fetch_emails(service: Any, message_ids: List[str], batch_size: int = BATCH_SIZE,
+                 needs_body: Optional[Callable[[EmailRecord], bool]] = None) -> List[Dict[str, str]]:
+    return list(iter_fetched_emails(service, message_ids, batch_size, needs_body))
+
+
+def iter_fetched_emails(service: Any, message_ids: List[str], batch_size: int = BATCH_SIZE,
+                        needs_body: Optional[Callable[[EmailRecord], bool]] = None) -> Iterator[Dict[str, str]]:
+    """Fetch message metadata through the Gmail batch endpoint, as ``EmailRecord`` s.
+
+    Each chunk of ``batch_size`` messages costs a single round-trip for the
+    ``HEADERS`` and snippets. Bodies are only downloaded if something reads
+    them, a chunk at a time (see ``MessageLoader``). Failed sub-requests are
+    logged and skipped without affecting the rest.
+    """
+    for start in range(0, len(message_ids), batch_size):
+        yield from fetch_records(service, message_ids[start:start + batch_size],
+                                 MessageLoader(service, batch_size, needs_body))
+
+
+def fetch_records(service: Any, message_ids: List[str], loader: MessageLoader) -> List[EmailRecord]:
+    """Fetch the metadata of ``message_ids``, ``loader.batch_size`` per request, as records sharing ``loader``."""
+    records = []
+    for start in range(0, len(message_ids), loader.batch_size):
+        chunk = message_ids[start:start + loader.batch_size]
+        responses = {}
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                logger.error(f"Error getting email headers or body for message {request_id}: {exception}")
+                return
+            responses[request_id] = response
+
+        requests = [(message_id, service.users().messages().get(userId="me", id=message_id, format="metadata",
+                                                                metadataHeaders=list(HEADERS)))
+                    for message_id in chunk]
+        try:
+            execute_batch(service, requests, callback, "gmail", "messages.get")
+        except HttpError as e:
+            logger.error(f"Error getting batch of {len(chunk)} emails: {e}")
+
+        fetched = [EmailRecord.from_metadata(responses[message_id], loader)
+                   for message_id in chunk if message_id in responses]
+        metrics.count("messages_downloaded_total", len(fetched), format="metadata")
+        records.extend(fetched)
+    loader.records.extend(records)
+    return records
+
+
+def iter_thread_emails(service: Any, messages: List[Dict[str, str]], batch_size: int = BATCH_SIZE,
+                       needs_body: Optional[Callable[[EmailRecord], bool]] = None) -> Iterator[Dict[str, str]]:
+    """Fetch ``messages`` (``{"id", "threadId"}``) and yield only the newest message of each thread.
+
+    The thread's other messages are collapsed into it: they are kept, oldest
+    first, under ``Earlier`` so their text can be given to the LLM as context,
+    and their ids are listed under ``Superseded`` so they can be marked as read
+    along with it. Threads are fetched whole, ``batch_size`` messages at a time,
+    and a thread's messages always share one ``MessageLoader``.
+    """
+    threads: Dict[str, List[str]] = {}
+    for message in messages:
+        threads.setdefault(message.get("threadId", message["id"]), []).append(message["id"])
+    if len(threads) < len(messages):
+        logger.info(f"{len(messages)} messages are in {len(threads)} threads. Processing the newest of each")
+    chunk: List[List[str]] = []
+    chunk_size = 0
+    for i, thread in enumerate(threads.values()):
+        chunk.append(thread)
+        chunk_size += len(thread)
+        if chunk_size < batch_size and i < len(threads) - 1:
+            continue
+        loader = MessageLoader(service, batch_size, needs_body)
+        fetched = {msg_dict['Id']: msg_dict for msg_dict in
+                   fetch_records(service, [message_id for ids in chunk for message_id in ids], loader)}
+        for ids in chunk:
+            # a message that could not be fetched stays unread for the next run
+            thread_emails = [fetched[message_id] for message_id in ids if message_id in fetched]
+            if thread_emails:
+                yield collapse_thread(thread_emails)
+        chunk, chunk_size = [], 0
+
+
+def message_time(msg_dict: Dict[str, str]) -> float:
+    if 'InternalDate' in msg_dict:
+        return int(msg_dict['InternalDate']) / 1000
+    try:
+        return parser.parse(msg_dict['Date']).timestamp()
+    except (KeyError, ValueError, OverflowError):
+        return 0.0
+
+
+def collapse_thread(msg_dicts: List[Dict[str, str]]) -> Dict[str, str]:
+    if len(msg_dicts) == 1:
+        return msg_dicts[0]
+    ordered = sorted(msg_dicts, key=message_time)
+    latest = ordered[-1]
+    latest['Earlier'] = ordered[:-1]
+    latest['Superseded'] = [msg_dict['Id'] for msg_dict in ordered[:-1]]
+    return latest
+
+
+def decode_raw_email(encoded_message: Any) -> Optional[email.message.Message]:
     try:
-        mime_str = email.message_from_bytes(base64.urlsafe_b64decode(encoded_message.encode('ASCII')))
+        return email.message_from_bytes(base64.urlsafe_b64decode(encoded_message.encode('ASCII')))
     except (base64.binascii.Error, UnicodeDecodeError) as e:
         logger.error(f"Error decoding email body: {e}")
+        return None
+
+
+def parse_raw_email(encoded_message: Any) -> Optional[Dict[str, str]]:
+    mime_str = decode_raw_email(encoded_message)
+    if mime_str is None:
+        return None
+    msg_dict = {name: decode_header_value(value) for name, value in mime_str.items()}
+    msg_dict['Body'] = get_mime_body(mime_str)
+    calendar = get_calendar_part(mime_str)
+    if calendar is not None:
+        msg_dict['Calendar'] = calendar
+    return msg_dict
+
+
+def decode_header_value(value: Any) -> str:
+    # the metadata format returned decoded, unfolded values; do the same for raw headers
+    value = re.sub(r'\r?\n[ \t]+', ' ', str(value))
+    if '=?' not in value:
+        return value
+    try:
+        return str(email.header.make_header(email.header.decode_header(value)))
+    except (email.errors.HeaderParseError, LookupError, UnicodeDecodeError):
+        return value
+
+
+def get_email_body(encoded_message: Any) -> str:
+    mime_str = decode_raw_email(encoded_message)
+    if mime_str is None:
         return ""
+    return get_mime_body(mime_str)
+
 
+def get_mime_body(mime_str: email.message.Message) -> str:
+    """The text/plain body, or the text of the text/html body for HTML-only emails."""
     try:
-        if mime_str.is_multipart():
-            for part in mime_str.walk():
-                if part.get_content_type() == 'text/plain':
-                    body = part.get_payload(decode=True).decode(part.get_content_charset())
-                    return body
-        else:
-            if mime_str.get_content_type() == 'text/plain':
-                body = mime_str.get_payload(decode=True).decode(mime_str.get_content_charset())
-                return body
-    except (AttributeError, UnicodeDecodeError) as e:
+        html_part = None
+        for part in mime_str.walk():
+            if part.get_content_type() == 'text/plain':
+                return part.get_payload(decode=True).decode(part.get_content_charset() or 'utf-8')
+            if part.get_content_type() == 'text/html' and html_part is None:
+                html_part = part
+        if html_part is not None:
+            return html_to_text(html_part.get_payload(decode=True).decode(html_part.get_content_charset() or 'utf-8'))
+    except (AttributeError, UnicodeDecodeError, LookupError) as e:
         logger.error(f"Error getting email body: {e}")
         return ""
     
     return ""
 
+
+def get_calendar_part(mime_str: email.message.Message) -> Optional[str]:
+    """The ICS text of the first calendar invite in the email, if any."""
+    try:
+        for part in mime_str.walk():
+            if part.get_content_type() in CALENDAR_TYPES:
+                return part.get_payload(decode=True).decode(part.get_content_charset() or 'utf-8')
+    except (AttributeError, UnicodeDecodeError, LookupError) as e:
+        logger.error(f"Error getting calendar invite: {e}")
+    return None
+
+def format_plaintext_email(msg_dict: Dict[str, str]) -> str:
+    # the body is stripped of quotes, signatures and disclaimers and trimmed to the token budget
+    plaintext_email = "\n".join([
+        'From: ' + msg_dict['From'],
+        'To: ' + msg_dict['To'],
+        # 'Date: ' + msg_dict['Date'],
+        'Subject: ' + msg_dict['Subject'],
+        "\n" + normalize_email(msg_dict)
+    ])
+    if msg_dict.get('Earlier'):
+        plaintext_email += "\n\nEarlier unread messages in this thread:\n\n" + normalize_thread(msg_dict['Earlier'])
+    return plaintext_email
+
+def format_email_date(msg_dict: Dict[str, str]) -> str:
+    timestamp = parser.parse(msg_dict['Date'])
+    return timestamp.strftime("%a, %d %b, %Y")
+
 def mark_email_as_read(service: Any, id: str):
     try:
-        service.users().messages().modify(userId="me", id=id, body={"removeLabelIds": ["UNREAD"]}).execute()
+        execute(service.users().messages().modify(userId="me", id=id, body={"removeLabelIds": ["UNREAD"]}), "gmail", "messages.modify")
         logger.info(f"Marked email with Message ID: {id} as read.")
     except HttpError as e:
         logger.error(f"Error marking email with Message ID: {id} as read: {e}")
 
-def send_reply_email(service: Any, msg_dict: Dict[str, str], reply: str):
+def get_or_create_label(service: Any, name: str) -> Optional[str]:
+    try:
+        labels = execute(service.users().labels().list(userId="me"), "gmail", "labels.list").get("labels", [])
+        for label in labels:
+            if label["name"] == name:
+                return label["id"]
+        label = execute(service.users().labels().create(
+            userId="me", body={"name": name, "labelListVisibility": "labelShow", "messageListVisibility": "show"}
+        ), "gmail", "labels.create")
+        logger.info(f"Created label {name}")
+        return label["id"]
+    except HttpError as e:
+        logger.error(f"Error getting or creating label {name}: {e}")
+        return None
+
+class LabelUpdateBatcher:
+    """Marks processed emails as read in bulk with ``messages.batchModify``.
+
+    Ids passed to ``add`` are flushed once ``max_ids`` are pending (Gmail's limit
+    is 1,000 per call) or the oldest has waited ``max_age_seconds``, and on
+    ``close``. The age limit is kept by a timer, so it holds even when no
+    further email arrives. ``add_label_ids`` are applied in the same call, e.g.
+    a label marking the emails as handled by the scheduler. ``on_flush`` is
+    called with the ids of each successful call. Safe to share between threads.
+    """
+
+    def __init__(self, service: Any, max_ids: int = MAX_BATCH_MODIFY_IDS, max_age_seconds: float = FLUSH_SECONDS,
+                 add_label_ids: Optional[List[str]] = None, on_flush: Optional[Callable[[List[str]], None]] = None):
+        self.service = service
+        self.max_ids = min(max_ids, MAX_BATCH_MODIFY_IDS)
+        self.max_age_seconds = max_age_seconds
+        self.add_label_ids = add_label_ids or []
+        self.on_flush = on_flush
+        self.pending: List[str] = []
+        self.oldest: Optional[float] = None
+        self.timer: Optional[threading.Timer] = None
+        # guards ``pending``; ``send_lock`` keeps batchModify calls in order without blocking add()
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.flushed = 0
+
+    def add(self, message_id: str):
+        with self.lock:
+            if not self.pending:
+                self.oldest = time.monotonic()
+                self.timer = threading.Timer(self.max_age_seconds, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+            self.pending.append(message_id)
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        with self.lock:
+            due = len(self.pending) >= self.max_ids or (
+                self.pending and time.monotonic() - self.oldest >= self.max_age_seconds)
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            self.oldest = None
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        with self.send_lock:
+            for start in range(0, len(pending), self.max_ids):
+                ids = pending[start:start + self.max_ids]
+                body = {"ids": ids, "removeLabelIds": ["UNREAD"]}
+                if self.add_label_ids:
+                    body["addLabelIds"] = self.add_label_ids
+                try:
+                    with metrics.span("mark_read"):
+                        execute(self.service.users().messages().batchModify(userId="me", body=body), "gmail", "messages.batchModify")
+                    self.flushed += len(ids)
+                    logger.info(f"Marked {len(ids)} emails as read.")
+                    if self.on_flush is not None:
+                        self.on_flush(ids)
+                except HttpError as e:
+                    # they stay unread and are picked up again by the next run
+                    logger.error(f"Error marking {len(ids)} emails as read: {e}")
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self) -> "LabelUpdateBatcher":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def mark_handled(read_marker: LabelUpdateBatcher, msg_dict: Dict[str, str]):
+    """Queue ``msg_dict`` to be marked as read, along with the thread messages collapsed into it."""
+    read_marker.add(msg_dict['Id'])
+    superseded = msg_dict.get('Superseded', [])
+    for message_id in superseded:
+        read_marker.add(message_id)
+    if superseded:
+        metrics.count("emails_total", len(superseded), outcome="superseded")
+
+def make_label_batcher(service: Any, processed_label: Optional[str] = None, max_ids: int = MAX_BATCH_MODIFY_IDS,
+                       max_age_seconds: float = FLUSH_SECONDS,
+                       on_flush: Optional[Callable[[List[str]], None]] = None) -> LabelUpdateBatcher:
+    label_ids = []
+    if processed_label is not None:
+        label_id = get_or_create_label(service, processed_label)
+        if label_id is not None:
+            label_ids.append(label_id)
+    return LabelUpdateBatcher(service, max_ids=max_ids, max_age_seconds=max_age_seconds, add_label_ids=label_ids,
+                              on_flush=on_flush)
+
+def send_reply_email(service: Any, msg_dict: Dict[str, str], reply: str) -> bool:
     message = email.message.EmailMessage() # maybe use pydantic schema
     message['To'] = msg_dict['From']
     message['From'] = msg_dict['To']
@@ -87,12 +679,29 @@ def send_reply_email(service: Any, msg_dict: Dict[str, str], reply: str):
         encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
     except (UnicodeEncodeError) as e:
         logger.error(f"Error encoding email: {e}")
-        return
+        return False
 
     try:
         create_message = {"raw": encoded_message}
-        send_message = service.users().messages().send(userId="me", body=create_message).execute()
+        if msg_dict.get('ThreadId'):
+            # keeps the reply in the email's thread in our own mailbox too, where reply_was_sent looks for it
+            create_message['threadId'] = msg_dict['ThreadId']
+        send_message = execute(service.users().messages().send(userId="me", body=create_message), "gmail", "messages.send")
         logger.info(f'Sent email with Message ID: {send_message["id"]}')
+        return True
     except HttpError as e:
         logger.error(f"Error sending email: {e}")
-        return
\ No newline at end of file
+        return False
+
+
+def reply_was_sent(service: Any, msg_dict: Dict[str, str]) -> bool:
+    """Whether our mailbox holds a sent reply to ``msg_dict``, e.g. from a run that stopped while sending it."""
+    if not msg_dict.get('ThreadId'):
+        return False
+    thread = execute(service.users().threads().get(userId="me", id=msg_dict['ThreadId'], format="metadata",
+                                                   metadataHeaders=["In-Reply-To"]), "gmail", "threads.get")
+    for message in thread.get('messages', []):
+        headers = {header['name'].lower(): header['value'] for header in message.get('payload', {}).get('headers', [])}
+        if 'SENT' in message.get('labelIds', []) and headers.get('in-reply-to') == msg_dict.get('Message-ID'):
+            return True
+    return False
@@ -0,0 +1,394 @@
+"""Read meeting details straight from calendar invites and explicit dates, without the LLM.
+
+Emails carrying a ``text/calendar`` part (an ICS invite) are meeting requests
+by definition, and their ``VEVENT`` says exactly when and where: DTSTART with
+its TZID, DTEND or DURATION, LOCATION, ORGANIZER and ATTENDEEs map directly
+onto ``MeetingDetails``. For other meeting requests, a body naming exactly one
+explicit date (``2024-03-12``, ``March 12``, ``12 March 2024``) and one clock
+time (``2:30 PM``, ``14:30``, ``2-3pm``), with an optional duration and time
+zone, is parsed with regular expressions when a sentence asking to meet names
+both. Anything less clear cut, such as two candidate times, a relative date
+like "tomorrow", a date already past, or an all-day invite, is left to
+``extract_meeting_details``.
+"""
+import datetime as dt
+import logging
+import re
+from typing import Dict, List, Optional, Tuple
+from dateutil import parser, tz
+from metrics import count
+from normalize import normalize_body
+from schemas import MeetingDetails
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ICS = "ics"
+TEXT = "text"
+LLM = "llm"
+
+# Outlook names its zones the Windows way; the ones most invites use
+WINDOWS_TIMEZONES = {
+    "Eastern Standard Time": "America/New_York",
+    "Central Standard Time": "America/Chicago",
+    "Mountain Standard Time": "America/Denver",
+    "US Mountain Standard Time": "America/Phoenix",
+    "Pacific Standard Time": "America/Los_Angeles",
+    "Alaskan Standard Time": "America/Anchorage",
+    "Hawaiian Standard Time": "Pacific/Honolulu",
+    "GMT Standard Time": "Europe/London",
+    "W. Europe Standard Time": "Europe/Berlin",
+    "Romance Standard Time": "Europe/Paris",
+    "Central Europe Standard Time": "Europe/Budapest",
+    "India Standard Time": "Asia/Kolkata",
+    "China Standard Time": "Asia/Shanghai",
+    "Tokyo Standard Time": "Asia/Tokyo",
+    "AUS Eastern Standard Time": "Australia/Sydney",
+    "UTC": "UTC",
+}
+# abbreviations written after a time in an email body
+TIMEZONE_ABBREVIATIONS = {
+    "ET": "America/New_York", "EST": "America/New_York", "EDT": "America/New_York",
+    "CT": "America/Chicago", "CST": "America/Chicago", "CDT": "America/Chicago",
+    "MT": "America/Denver", "MST": "America/Denver", "MDT": "America/Denver",
+    "PT": "America/Los_Angeles", "PST": "America/Los_Angeles", "PDT": "America/Los_Angeles",
+    "UTC": "UTC", "GMT": "UTC", "BST": "Europe/London", "CET": "Europe/Paris", "CEST": "Europe/Paris",
+}
+
+stats = {ICS: 0, TEXT: 0, LLM: 0, "emails": 0, "without_llm": 0}
+
+
+# ICS invites
+
+def unfold_ics(text: str) -> List[str]:
+    # long content lines are folded by a line break followed by a space or tab
+    return re.sub(r'\r?\n[ \t]', '', text).splitlines()
+
+
+def parse_ics_line(line: str) -> Tuple[str, Dict[str, str], str]:
+    """Split ``NAME;PARAM=VALUE:value`` into its name, parameters and value."""
+    head, _, value = line.partition(':')
+    # a colon inside a quoted parameter (e.g. CN="Doe: Jane") belongs to the head
+    while head.count('"') % 2 and value:
+        more, _, value = value.partition(':')
+        head += ':' + more
+    name, *params = head.split(';')
+    parameters = {}
+    for param in params:
+        key, _, param_value = param.partition('=')
+        parameters[key.upper()] = param_value.strip('"')
+    return name.upper(), parameters, value
+
+
+def unescape_ics(value: str) -> str:
+    return re.sub(r'\\([\\;,nN])', lambda m: '\n' if m.group(1) in 'nN' else m.group(1), value)
+
+
+def ics_timezone(tzid: str) -> Optional[str]:
+    tzid = WINDOWS_TIMEZONES.get(tzid, tzid)
+    return tzid if tz.gettz(tzid) is not None else None
+
+
+def parse_ics_datetime(value: str, parameters: Dict[str, str]) -> Optional[Tuple[dt.datetime, Optional[str]]]:
+    """The start as naive local time and its zone name; None for all-day dates and unknown zones."""
+    if parameters.get('VALUE') == 'DATE' or 'T' not in value:
+        return None
+    try:
+        moment = dt.datetime.strptime(value.rstrip('Z')[:15], "%Y%m%dT%H%M%S")
+    except ValueError:
+        return None
+    if value.endswith('Z'):
+        return moment, "UTC"
+    if 'TZID' in parameters:
+        zone = ics_timezone(parameters['TZID'])
+        if zone is None:
+            return None
+        return moment, zone
+    # floating time: the attendee's own zone
+    return moment, None
+
+
+def parse_ics_duration(value: str) -> Optional[int]:
+    match = re.fullmatch(r'\+?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?', value)
+    if match is None or not any(match.groups()):
+        return None
+    weeks, days, hours, minutes, seconds = (int(group or 0) for group in match.groups())
+    return ((weeks * 7 + days) * 24 + hours) * 60 + minutes + seconds // 60
+
+
+def calendar_address(value: str) -> str:
+    return re.sub(r'^mailto:', '', value, flags=re.IGNORECASE)
+
+
+def parse_ics(text: str) -> Optional[MeetingDetails]:
+    """Meeting details from an ICS invite holding a single timed event, or None."""
+    method = None
+    events: List[List[Tuple[str, Dict[str, str], str]]] = []
+    event = None
+    # components nested in the event, like a VALARM, whose properties are not the event's own
+    nested = 0
+    for line in unfold_ics(text):
+        if not line.strip():
+            continue
+        name, parameters, value = parse_ics_line(line)
+        if name == 'METHOD':
+            method = value.strip().upper()
+        elif name == 'BEGIN' and event is not None:
+            nested += 1
+        elif name == 'BEGIN' and value.strip().upper() == 'VEVENT':
+            event = []
+        elif name == 'END' and event is not None and nested:
+            nested -= 1
+        elif name == 'END' and value.strip().upper() == 'VEVENT' and event is not None:
+            events.append(event)
+            event = None
+        elif event is not None and not nested:
+            event.append((name, parameters, value))
+    # a cancellation or an attendee's reply is not a request, and several events leave it unclear which is meant
+    if method not in (None, 'REQUEST', 'PUBLISH') or len(events) != 1:
+        return None
+    properties: Dict[str, Tuple[Dict[str, str], str]] = {}
+    attendees = []
+    for name, parameters, value in events[0]:
+        if name in ('ATTENDEE', 'ORGANIZER'):
+            address = calendar_address(value)
+            if address and address not in attendees:
+                attendees.append(address)
+        elif name not in properties:
+            properties[name] = (parameters, value)
+    if 'DTSTART' not in properties:
+        return None
+    start = parse_ics_datetime(properties['DTSTART'][1], properties['DTSTART'][0])
+    if start is None:
+        return None
+    start_time, zone = start
+    duration = None
+    if 'DURATION' in properties:
+        duration = parse_ics_duration(properties['DURATION'][1])
+    elif 'DTEND' in properties:
+        end = parse_ics_datetime(properties['DTEND'][1], properties['DTEND'][0])
+        if end is not None:
+            end_time = end[0]
+            if end[1] != zone and end[1] is not None and zone is not None:
+                end_time = end_time.replace(tzinfo=tz.gettz(end[1])).astimezone(tz.gettz(zone)).replace(tzinfo=None)
+            duration = int((end_time - start_time).total_seconds() // 60)
+    if duration is not None and duration <= 0:
+        return None
+
+    def text_property(name: str) -> Optional[str]:
+        return unescape_ics(properties[name][1]).strip() or None if name in properties else None
+
+    return MeetingDetails(summary=text_property('SUMMARY'), agenda=text_property('DESCRIPTION'),
+                          date=start_time.strftime("%Y-%m-%d"), start_time=start_time.strftime("%H:%M"),
+                          duration=duration, location=text_property('LOCATION'), timezone=zone, attendees=attendees)
+
+
+def parse_invite(email_dict: Dict[str, str]) -> Optional[MeetingDetails]:
+    if not email_dict.get('Calendar'):
+        return None
+    return parse_ics(email_dict['Calendar'])
+
+
+# explicit dates in the text
+
+MONTHS = {name: number for number, names in enumerate([
+    ("jan", "january"), ("feb", "february"), ("mar", "march"), ("apr", "april"), ("may",), ("jun", "june"),
+    ("jul", "july"), ("aug", "august"), ("sep", "sept", "september"), ("oct", "october"), ("nov", "november"),
+    ("dec", "december")], start=1) for name in names}
+MONTH = r'(?P<month>' + '|'.join(sorted(MONTHS, key=len, reverse=True)) + r')\.?'
+ORDINAL = r'(?:st|nd|rd|th)?'
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+WEEKDAY = r'(?:(?P<weekday>' + '|'.join(WEEKDAYS) + r'|mon|tue|tues|wed|thu|thur|thurs|fri|sat|sun)\.?,?\s+(?:the\s+)?)?'
+
+DATE_PATTERNS = [
+    re.compile(r'\b(?P<year>\d{4})-(?P<month>\d{1,2})-(?P<day>\d{1,2})\b'),
+    re.compile(r'\b' + WEEKDAY + MONTH + r'\s+(?P<day>\d{1,2})' + ORDINAL + r'\b(?:,?\s+(?P<year>\d{4})\b)?', re.IGNORECASE),
+    re.compile(r'\b' + WEEKDAY + r'(?P<day>\d{1,2})' + ORDINAL + r'\s+(?:of\s+)?' + MONTH + r'\b(?:,?\s+(?P<year>\d{4})\b)?', re.IGNORECASE),
+    re.compile(r'\b(?P<first>\d{1,2})/(?P<second>\d{1,2})/(?P<year>\d{4})\b'),
+]
+MERIDIEM = r'(?P<{name}>[ap])\.?\s?m\b\.?'
+CLOCK = r'(?P<{name}_hour>\d{{1,2}})(?::(?P<{name}_minute>[0-5]\d))?\s*(?:' + MERIDIEM + r')?'
+TIME_RANGE = re.compile(
+    r'(?<![\d:/.-])' + CLOCK.format(name='start').replace('(?P<start>', '(?P<start_meridiem>')
+    + r'(?:\s*(?:-|–|to|until)\s*' + CLOCK.format(name='end').replace('(?P<end>', '(?P<end_meridiem>') + r')?'
+    r'(?:\s*(?P<zone>' + '|'.join(TIMEZONE_ABBREVIATIONS) + r')\b)?',
+    re.IGNORECASE)
+NOON = re.compile(r'\b(?:at\s+)?noon\b', re.IGNORECASE)
+DURATION = re.compile(
+    r'\b(?P<amount>\d+(?:\.\d+)?|an?|one|two|half an?)[\s-]*(?P<unit>hours?|hrs?|minutes?|mins?)\b', re.IGNORECASE)
+# dates that only make sense relative to when the email was sent
+RELATIVE_DATE = re.compile(r'\b(?:today|tonight|tomorrow|next\s+(?:week|' + '|'.join(WEEKDAYS) + r')|this\s+(?:week|'
+                           + '|'.join(WEEKDAYS) + r'))\b', re.IGNORECASE)
+WORD_AMOUNTS = {"a": 1, "an": 1, "one": 1, "two": 2, "half a": 0.5, "half an": 0.5}
+# a date and time are only taken as the meeting's when a sentence naming both asks for one
+MEETING_WORDING = re.compile(r'\b(?:meet|meeting|call|chat|sync|schedule|catch up|talk|discuss|how about|works|'
+                             r'work for|available|free)\b', re.IGNORECASE)
+SENTENCE_END = re.compile(r'[.!?]+(?=\s+[A-Z])|\n')
+
+
+def find_dates(text: str, sent: dt.date) -> Optional[List[dt.date]]:
+    """Every explicit date in ``text``, in the year it was ``sent`` unless it names one.
+
+    None when one of them is not a real date or is written ambiguously.
+    """
+    dates = []
+    spans = []
+    for pattern in DATE_PATTERNS:
+        for match in pattern.finditer(text):
+            if any(start < match.end() and match.start() < end for start, end in spans):
+                continue
+            spans.append(match.span())
+            groups = match.groupdict()
+            if 'first' in groups:
+                first, second = int(groups['first']), int(groups['second'])
+                # 03/04/2024 is March 4 in the US and April 3 elsewhere
+                if first <= 12 and second <= 12 and first != second:
+                    return None
+                month, day = (first, second) if first <= 12 else (second, first)
+            else:
+                month = int(groups['month']) if groups['month'].isdigit() else MONTHS[groups['month'].lower().rstrip('.')]
+                day = int(groups['day'])
+            try:
+                if groups.get('year'):
+                    date = dt.date(int(groups['year']), month, day)
+                else:
+                    date = dt.date(sent.year, month, day)
+            except ValueError:
+                return None
+            weekday = groups.get('weekday')
+            if weekday and not WEEKDAYS[date.weekday()].startswith(weekday.lower()[:3]):
+                # "Tuesday, March 12" in a year where March 12 is a Wednesday
+                return None
+            dates.append(date)
+    return dates
+
+
+def find_times(text: str) -> List[Tuple[dt.time, Optional[int], Optional[str]]]:
+    """Every clock time in ``text`` with the length of the range it starts, if any, and its time zone."""
+    times = []
+    for match in TIME_RANGE.finditer(text):
+        groups = match.groupdict()
+        start_meridiem, end_meridiem = groups['start_meridiem'], groups['end_meridiem']
+        if groups['end_hour'] is not None and end_meridiem is None and start_meridiem is None and groups['end_minute'] is None:
+            continue
+        # "2-3pm": the start takes the meridiem of the end
+        if start_meridiem is None and groups['end_hour'] is not None:
+            start_meridiem = end_meridiem
+        if start_meridiem is None and groups['start_minute'] is None:
+            # a bare number is not a time
+            continue
+        start = clock_time(groups['start_hour'], groups['start_minute'], start_meridiem)
+        if start is None:
+            continue
+        duration = None
+        if groups['end_hour'] is not None:
+            end = clock_time(groups['end_hour'], groups['end_minute'], end_meridiem or start_meridiem)
+            if end is None:
+                continue
+            duration = (dt.datetime.combine(dt.date.min, end) - dt.datetime.combine(dt.date.min, start)).seconds // 60
+        zone = TIMEZONE_ABBREVIATIONS.get(groups['zone'].upper()) if groups['zone'] else None
+        times.append((start, duration, zone))
+    for _ in NOON.finditer(text):
+        times.append((dt.time(12), None, None))
+    return times
+
+
+def clock_time(hour: str, minute: Optional[str], meridiem: Optional[str]) -> Optional[dt.time]:
+    hour, minute = int(hour), int(minute or 0)
+    if meridiem is not None:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if meridiem.lower() == 'p' else 0)
+    elif hour > 23:
+        return None
+    return dt.time(hour, minute)
+
+
+def find_durations(text: str) -> List[int]:
+    durations = []
+    for match in DURATION.finditer(text):
+        amount = match.group('amount').lower()
+        value = WORD_AMOUNTS[amount] if amount in WORD_AMOUNTS else float(amount)
+        minutes = value * 60 if match.group('unit').lower().startswith('h') else value
+        durations.append(int(minutes))
+    return durations
+
+
+def parse_explicit(text: str, sent: dt.date) -> Optional[MeetingDetails]:
+    """Details from a text naming exactly one date and one time; None when that is not clear cut.
+
+    The date and time must share a sentence that talks about meeting, and the
+    date may not be before ``sent``; a deadline or a past event is not a slot.
+    """
+    if RELATIVE_DATE.search(text):
+        return None
+    dates = find_dates(text, sent)
+    if not dates or len(set(dates)) > 1 or dates[0] < sent:
+        return None
+    times = find_times(text)
+    if len({start for start, _, _ in times}) != 1:
+        return None
+    if not any(MEETING_WORDING.search(sentence) and find_dates(sentence, sent) and find_times(sentence)
+               for sentence in SENTENCE_END.split(text)):
+        return None
+    zones = {zone for _, _, zone in times if zone is not None}
+    if len(zones) > 1:
+        return None
+    durations = {duration for _, duration, _ in times if duration is not None} | set(find_durations(text))
+    if len(durations) > 1:
+        return None
+    return MeetingDetails(summary=None, agenda=None, date=dates[0].strftime("%Y-%m-%d"),
+                          start_time=times[0][0].strftime("%H:%M"), duration=durations.pop() if durations else None,
+                          location=None, timezone=zones.pop() if zones else None, attendees=[])
+
+
+def parse_email_text(email_dict: Dict[str, str]) -> Optional[MeetingDetails]:
+    try:
+        sent = parser.parse(email_dict['Date']).date()
+    except (KeyError, ValueError, OverflowError):
+        return None
+    subject = re.sub(r'^(?:(?:re|fwd?):\s*)+', '', email_dict.get('Subject', ''), flags=re.IGNORECASE)
+    # quoted history and signatures carry dates of their own
+    details = parse_explicit(subject + "\n" + normalize_body(email_dict['Body'], 0).text, sent)
+    if details is not None:
+        details.summary = subject or None
+    return details
+
+
+# bookkeeping
+
+def parse_locally(email_dict: Dict[str, str]) -> Optional[MeetingDetails]:
+    return parse_invite(email_dict) or parse_email_text(email_dict)
+
+
+def extract_locally(email_dict: Dict[str, str]) -> Optional[MeetingDetails]:
+    """Meeting details from the email's invite or explicit date and time, or None when the LLM should extract them."""
+    details = parse_invite(email_dict)
+    source = ICS
+    if details is None:
+        details = parse_email_text(email_dict)
+        source = TEXT
+    if details is not None:
+        record_extraction(source)
+        logger.info(f"Read meeting details of email {email_dict.get('Id', '')} from its {'invite' if source == ICS else 'text'}")
+    return details
+
+
+def record_extraction(source: str):
+    stats[source] += 1
+    count("extractions_total", source=source)
+
+
+def record_email(used_llm: bool):
+    stats["emails"] += 1
+    if not used_llm:
+        stats["without_llm"] += 1
+        count("emails_without_llm_total")
+
+
+def log_extraction_summary():
+    if stats["emails"]:
+        logger.info(f"Extraction: {stats[ICS]} invites and {stats[TEXT]} explicit dates read locally, "
+                    f"{stats[LLM]} sent to the LLM. {stats['without_llm']} of {stats['emails']} emails "
+                    f"({stats['without_llm'] / stats['emails']:.0%}) were handled without an LLM call")
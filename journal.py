@@ -0,0 +1,185 @@
+"""Record how far each email got, so a run that dies part way can pick up where it stopped.
+
+Every email moves through ``fetched -> classified -> extracted -> acted ->
+acknowledged``; its row in the journal holds the furthest stage reached along
+with the classification, extracted meeting details and reply draft produced
+on the way. A rerun reads those back instead of calling the LLM again, and
+skips the calendar event or reply of an email that was already acted on,
+only marking it as read. Emails the classifier turns down go straight from
+``classified`` to ``acted``. A reply is recorded as ``sending`` right before
+it is sent, so a rerun knows to check whether it went out. A failed calendar
+insert or send keeps the email below ``acted`` so the next run tries again.
+Gmail message ids are only unique within a mailbox, so rows are keyed by
+mailbox and id; a roster sets the mailbox with ``set_mailbox`` before each
+account's pass.
+"""
+import logging
+import sqlite3
+import threading
+import time
+from typing import List, NamedTuple, Optional
+from schemas import IsMeetingRequest, MeetingDetails
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILE = "journal.sqlite3"
+# acknowledged emails are forgotten after this long
+RETENTION_SECONDS = 30 * 24 * 60 * 60
+
+FETCHED = "fetched"
+CLASSIFIED = "classified"
+EXTRACTED = "extracted"
+SENDING = "sending"
+ACTED = "acted"
+ACKNOWLEDGED = "acknowledged"
+STAGES = [FETCHED, CLASSIFIED, EXTRACTED, SENDING, ACTED, ACKNOWLEDGED]
+
+
+class JournalEntry(NamedTuple):
+    stage: str
+    verdict: Optional[IsMeetingRequest] = None
+    details: Optional[MeetingDetails] = None
+    reply: Optional[str] = None
+    outcome: Optional[str] = None
+
+    @property
+    def acted(self) -> bool:
+        return STAGES.index(self.stage) >= STAGES.index(ACTED)
+
+
+class ProcessingJournal:
+    """Per-email progress and intermediate results, kept in SQLite.
+
+    Writes are committed one by one in WAL mode, so a crash loses at most the
+    transition in progress. A stage is only ever moved forward. Safe to share
+    between threads, and between processes on the same file. Every method
+    takes the ``mailbox`` the email belongs to; single-account runs use "".
+    """
+
+    def __init__(self, path: str = JOURNAL_FILE, retention_seconds: float = RETENTION_SECONDS):
+        self.path = path
+        self.retention_seconds = retention_seconds
+        self.lock = threading.Lock()
+        self.stats = {"resumed": 0, "skipped_actions": 0}
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # each transition is its own commit; WAL only needs a full sync at checkpoints
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(emails)")]
+        # journals from before mailboxes were told apart hold a single account's emails
+        unscoped = bool(columns) and "mailbox" not in columns
+        if unscoped:
+            self.conn.execute("ALTER TABLE emails RENAME TO emails_unscoped")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS emails ("
+            "mailbox TEXT NOT NULL, id TEXT NOT NULL, thread_id TEXT, stage TEXT NOT NULL, verdict TEXT, details TEXT, "
+            "reply TEXT, outcome TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (mailbox, id))"
+        )
+        if unscoped:
+            self.conn.execute("INSERT INTO emails SELECT '', * FROM emails_unscoped")
+            self.conn.execute("DROP TABLE emails_unscoped")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS emails_updated_at ON emails (updated_at)")
+        self.conn.execute("DELETE FROM emails WHERE stage = ? AND updated_at < ?",
+                          (ACKNOWLEDGED, time.time() - retention_seconds))
+        self.conn.commit()
+
+    def get(self, email_id: str, mailbox: str = "") -> Optional[JournalEntry]:
+        with self.lock:
+            row = self.conn.execute("SELECT stage, verdict, details, reply, outcome FROM emails WHERE mailbox = ? AND id = ?",
+                                    (mailbox, email_id)).fetchone()
+        if row is None:
+            return None
+        stage, verdict, details, reply, outcome = row
+        return JournalEntry(stage,
+                            IsMeetingRequest.model_validate_json(verdict) if verdict is not None else None,
+                            MeetingDetails.model_validate_json(details) if details is not None else None,
+                            reply, outcome)
+
+    def record(self, email_id: str, stage: str, thread_id: Optional[str] = None,
+               verdict: Optional[IsMeetingRequest] = None, details: Optional[MeetingDetails] = None,
+               reply: Optional[str] = None, outcome: Optional[str] = None, mailbox: str = ""):
+        """Move ``email_id`` to ``stage`` (never back) and store the results given alongside."""
+        now = time.time()
+        rank = STAGES.index(stage)
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO emails (mailbox, id, thread_id, stage, verdict, details, reply, outcome, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(mailbox, id) DO UPDATE SET "
+                "stage = CASE WHEN ? > (" + self._rank_sql("emails.stage") + ") THEN excluded.stage ELSE emails.stage END, "
+                "thread_id = COALESCE(excluded.thread_id, emails.thread_id), "
+                "verdict = COALESCE(excluded.verdict, emails.verdict), "
+                "details = COALESCE(excluded.details, emails.details), "
+                "reply = COALESCE(excluded.reply, emails.reply), "
+                "outcome = COALESCE(excluded.outcome, emails.outcome), "
+                "updated_at = excluded.updated_at",
+                (mailbox, email_id, thread_id, stage,
+                 verdict.model_dump_json() if verdict is not None else None,
+                 details.model_dump_json() if details is not None else None,
+                 reply, outcome, now, now, rank),
+            )
+            self.conn.commit()
+
+    @staticmethod
+    def _rank_sql(column: str) -> str:
+        return "CASE " + column + " " + " ".join(f"WHEN '{stage}' THEN {rank}" for rank, stage in enumerate(STAGES)) + " END"
+
+    def acknowledge(self, email_ids: List[str], mailbox: str = ""):
+        """Mark emails whose read state has been written to Gmail; unknown ids are ignored."""
+        now = time.time()
+        with self.lock:
+            self.conn.executemany("UPDATE emails SET stage = ?, updated_at = ? WHERE mailbox = ? AND id = ?",
+                                  [(ACKNOWLEDGED, now, mailbox, email_id) for email_id in email_ids])
+            self.conn.commit()
+
+    def summary(self) -> str:
+        return (f"Journal: resumed {self.stats['resumed']} emails from an earlier run, "
+                f"{self.stats['skipped_actions']} of them already acted on")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# progress is only journaled once enable_journal() has been called
+journal: Optional[ProcessingJournal] = None
+# the account whose emails are being processed; set by set_mailbox()
+mailbox = ""
+
+def enable_journal(path: str = JOURNAL_FILE, retention_seconds: float = RETENTION_SECONDS) -> ProcessingJournal:
+    global journal
+    journal = ProcessingJournal(path, retention_seconds)
+    return journal
+
+def set_mailbox(name: str):
+    global mailbox
+    mailbox = name
+
+def lookup(email_id: str) -> Optional[JournalEntry]:
+    """The journaled progress of ``email_id``, or None when it is new or journaling is off."""
+    if journal is None:
+        return None
+    return journal.get(email_id, mailbox)
+
+def resume(email_id: str) -> Optional[JournalEntry]:
+    """Like ``lookup``, for an email about to be processed; counts and logs emails picked up again."""
+    entry = lookup(email_id)
+    if entry is not None:
+        journal.stats["resumed"] += 1
+        if entry.acted:
+            journal.stats["skipped_actions"] += 1
+        logger.info(f"Resuming email {email_id} from stage {entry.stage}")
+    return entry
+
+def record(email_id: str, stage: str, **results):
+    if journal is not None:
+        journal.record(email_id, stage, mailbox=mailbox, **results)
+
+def acknowledge(email_ids: List[str]):
+    if journal is not None:
+        journal.acknowledge(email_ids, mailbox)
+
+def log_journal_summary():
+    if journal is not None and journal.stats["resumed"]:
+        logger.info(journal.summary())
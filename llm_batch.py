@@ -0,0 +1,184 @@
+"""Bulk classification and extraction through the OpenAI Batch API.
+
+Used by ``main.py --batch`` when a backlog of emails has to be processed at
+once: requests are written as JSONL, uploaded, run as a batch at the Batch API's
+discounted rate and outside the synchronous rate limits, then mapped back onto
+the emails by ``custom_id``. Anything the batch does not answer is left to the
+synchronous calls in ``llm_calls``.
+"""
+import io
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple, Type
+from pydantic import BaseModel, ValidationError
+import llm_calls
+import metrics
+from gmail_utils import format_plaintext_email, format_email_date
+from llm_calls import is_meeting_request_messages, extract_meeting_details_messages, cache_lookup, cache_store
+from prefilter import prefilter_email, record_verdict
+from invites import parse_invite, parse_locally
+from rate_limit import call
+from schemas import IsMeetingRequest, MeetingDetails
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ENDPOINT = "/v1/chat/completions"
+# the Batch API accepts at most 50,000 requests per input file
+MAX_BATCH_REQUESTS = 50000
+POLL_INTERVAL_SECONDS = 30
+BATCH_TIMEOUT_SECONDS = 24 * 60 * 60
+PENDING_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+# file and batch management calls count against the request budget, but carry no completion tokens
+BATCH_CALL_COST = [("openai_requests", 1)]
+
+
+def response_format_param(response_format: Type[BaseModel]) -> Dict[str, Any]:
+    """The strict ``json_schema`` response format that ``chat.completions.parse`` sends for ``response_format``."""
+    schema = response_format.model_json_schema()
+    # strict structured outputs require objects to reject unknown keys; the schemas here have no nested models
+    schema["additionalProperties"] = False
+    return {"type": "json_schema", "json_schema": {"name": response_format.__name__, "schema": schema, "strict": True}}
+
+
+def build_batch_line(custom_id: str, messages: List[Dict[str, str]], response_format: Type[BaseModel]) -> Dict[str, Any]:
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": ENDPOINT,
+        "body": {
+            "model": llm_calls.model,
+            "messages": messages,
+            "response_format": response_format_param(response_format),
+        },
+    }
+
+
+def submit_batch(lines: List[Dict[str, Any]]) -> str:
+    payload = "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8")
+    input_file = call(lambda: llm_calls.get_client().files.create(file=("batch_input.jsonl", io.BytesIO(payload)), purpose="batch"),
+                      BATCH_CALL_COST, "OpenAI file upload", "openai", "files.create")
+    batch = call(lambda: llm_calls.get_client().batches.create(input_file_id=input_file.id, endpoint=ENDPOINT, completion_window="24h"),
+                 BATCH_CALL_COST, "OpenAI batch create", "openai", "batches.create")
+    logger.info(f"Submitted batch {batch.id} with {len(lines)} requests")
+    return batch.id
+
+
+def wait_for_batch(batch_id: str, poll_interval: float = POLL_INTERVAL_SECONDS, timeout: float = BATCH_TIMEOUT_SECONDS) -> Any:
+    deadline = time.monotonic() + timeout
+    while True:
+        batch = call(lambda: llm_calls.get_client().batches.retrieve(batch_id), BATCH_CALL_COST, "OpenAI batch status", "openai", "batches.retrieve")
+        if batch.status not in PENDING_STATUSES:
+            logger.info(f"Batch {batch_id} finished with status {batch.status}")
+            return batch
+        if time.monotonic() >= deadline:
+            logger.error(f"Batch {batch_id} still {batch.status} after {timeout}s. Cancelling it")
+            call(lambda: llm_calls.get_client().batches.cancel(batch_id), BATCH_CALL_COST, "OpenAI batch cancel", "openai", "batches.cancel")
+            return batch
+        time.sleep(poll_interval)
+
+
+def read_batch_results(batch: Any, response_format: Type[BaseModel]) -> Dict[str, Tuple[BaseModel, int]]:
+    """Map ``custom_id`` to (parsed result, total tokens) for every successful line of the batch output."""
+    results = {}
+    if not batch.output_file_id:
+        return results
+    content = call(lambda: llm_calls.get_client().files.content(batch.output_file_id), BATCH_CALL_COST, "OpenAI batch output", "openai", "files.content").text
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            logger.error(f"Batch request {record.get('custom_id')} failed: {record.get('error') or response.get('status_code')}")
+            continue
+        body = response["body"]
+        try:
+            parsed = response_format.model_validate_json(body["choices"][0]["message"]["content"])
+        except (KeyError, IndexError, TypeError, ValidationError) as e:
+            logger.error(f"Could not parse batch response for {record['custom_id']}: {e}")
+            continue
+        metrics.record_usage(body.get("usage"))
+        results[record["custom_id"]] = (parsed, body.get("usage", {}).get("total_tokens", 0))
+    return results
+
+
+def run_batch(requests: Dict[str, List[Dict[str, str]]], response_format: Type[BaseModel],
+              poll_interval: float = POLL_INTERVAL_SECONDS, timeout: float = BATCH_TIMEOUT_SECONDS) -> Dict[str, BaseModel]:
+    """Answer ``requests`` (custom_id -> chat messages) from the cache, then the Batch API.
+
+    Requests the batch could not answer are left out of the result.
+    """
+    results = {}
+    keys = {}
+    pending = {}
+    for custom_id, messages in requests.items():
+        keys[custom_id], cached = cache_lookup(messages, response_format)
+        if cached is not None:
+            results[custom_id] = cached
+        else:
+            pending[custom_id] = messages
+    logger.info(f"{len(results)} of {len(requests)} {response_format.__name__} requests answered from cache")
+
+    from openai import OpenAIError
+    ids = list(pending)
+    for start in range(0, len(ids), MAX_BATCH_REQUESTS):
+        chunk = ids[start:start + MAX_BATCH_REQUESTS]
+        try:
+            batch_id = submit_batch([build_batch_line(i, pending[i], response_format) for i in chunk])
+            answered = read_batch_results(wait_for_batch(batch_id, poll_interval, timeout), response_format)
+        except OpenAIError as e:
+            logger.error(f"Batch submission failed: {e}")
+            answered = {}
+        for custom_id, (parsed, tokens) in answered.items():
+            results[custom_id] = parsed
+            cache_store(keys[custom_id], parsed, tokens, 0.0)
+
+    missing = len(requests) - len(results)
+    if missing:
+        logger.warning(f"{missing} {response_format.__name__} requests were not answered by the batch")
+    return results
+
+
+def classify_and_extract(email_dicts: List[Dict[str, str]], username: str, poll_interval: float = POLL_INTERVAL_SECONDS,
+                         timeout: float = BATCH_TIMEOUT_SECONDS
+                         ) -> Tuple[Dict[str, IsMeetingRequest], Dict[str, MeetingDetails], Set[str]]:
+    """Classify every email, then extract details for the meeting requests, as two batches.
+
+    Returns verdicts and meeting details keyed by Gmail message id, and the ids whose
+    verdict came from the LLM rather than the prefilter or a calendar invite. Emails
+    missing from either mapping were not answered and should go through the
+    synchronous calls. Calendar invites are taken as meeting requests without
+    classification, and meeting requests whose details ``invites`` can read are not
+    extracted.
+    """
+    verdicts: Dict[str, Optional[IsMeetingRequest]] = {}
+    plaintext_emails = {}
+    to_classify = {}
+    for email_dict in email_dicts:
+        verdicts[email_dict['Id']] = prefilter_email(email_dict)
+        if verdicts[email_dict['Id']] is None and parse_invite(email_dict) is not None:
+            verdicts[email_dict['Id']] = IsMeetingRequest(is_meeting_request=True)
+        if verdicts[email_dict['Id']] is None:
+            plaintext_emails[email_dict['Id']] = format_plaintext_email(email_dict)
+            to_classify[email_dict['Id']] = is_meeting_request_messages(plaintext_emails[email_dict['Id']])
+
+    classified = run_batch(to_classify, IsMeetingRequest, poll_interval, timeout)
+    for email_dict in email_dicts:
+        if email_dict['Id'] in classified:
+            verdicts[email_dict['Id']] = classified[email_dict['Id']]
+            record_verdict(email_dict, classified[email_dict['Id']])
+
+    to_extract = {}
+    for email_dict in email_dicts:
+        if verdicts.get(email_dict['Id']) is not None and verdicts[email_dict['Id']].is_meeting_request:
+            if parse_locally(email_dict) is not None:
+                continue
+            if email_dict['Id'] not in plaintext_emails:
+                plaintext_emails[email_dict['Id']] = format_plaintext_email(email_dict)
+            to_extract[email_dict['Id']] = extract_meeting_details_messages(
+                plaintext_emails[email_dict['Id']], username, format_email_date(email_dict))
+    details = run_batch(to_extract, MeetingDetails, poll_interval, timeout)
+    return {k: v for k, v in verdicts.items() if v is not None}, details, set(classified)
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_FILE = "llm_cache.sqlite3"
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+# hits keep their access time in memory until the next put, or until this many are pending
+ACCESS_FLUSH_SIZE = 100
+
+
+class LLMCache:
+    """Content-addressed store for LLM responses, kept in SQLite.
+
+    Entries are keyed by a hash of (model, system prompt, user prompt, response
+    schema), expire after ``ttl_seconds`` and are evicted least recently used
+    first once the stored responses exceed ``max_bytes``. Each entry remembers the
+    tokens and latency of the call that produced it, so hits report what they saved.
+    The stored size is tracked as entries are added and evicted rather than summed
+    on every put, and access times are written in batches.
+    """
+
+    def __init__(self, path: str = LLM_CACHE_FILE, max_bytes: int = MAX_CACHE_BYTES, ttl_seconds: float = CACHE_TTL_SECONDS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "tokens_saved": 0, "latency_saved": 0.0}
+        # access times of hits not yet written
+        self.accessed: Dict[str, float] = {}
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, tokens INTEGER NOT NULL, "
+            "latency REAL NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+        self.conn.execute("DELETE FROM entries WHERE created_at < ?", (time.time() - ttl_seconds,))
+        self.size = self._stored_bytes()
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict[str, str]], response_schema: Optional[Dict[str, Any]]) -> str:
+        system_prompt = "\n".join(m["content"] for m in messages if m["role"] == "system")
+        user_prompt = "\n".join(m["content"] for m in messages if m["role"] != "system")
+        payload = json.dumps([model, system_prompt, user_prompt, response_schema], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT value, tokens, latency, created_at, size FROM entries WHERE key = ?",
+                                    (key,)).fetchone()
+            if row is not None and now - row[3] > self.ttl_seconds:
+                self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.conn.commit()
+                self.size -= row[4]
+                row = None
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self.accessed[key] = now
+            if len(self.accessed) >= ACCESS_FLUSH_SIZE:
+                self._write_access_times()
+                self.conn.commit()
+            self.stats["hits"] += 1
+            self.stats["tokens_saved"] += row[1]
+            self.stats["latency_saved"] += row[2]
+            return row[0]
+
+    def put(self, key: str, value: str, tokens: int = 0, latency: float = 0.0):
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self.lock:
+            replaced = self.conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, tokens, latency, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, value, size, tokens, latency, now, now),
+            )
+            self.size += size - (replaced[0] if replaced is not None else 0)
+            self.accessed.pop(key, None)
+            # pending access times go out with this commit, and must before eviction picks its victims
+            self._write_access_times()
+            if self.size > self.max_bytes:
+                self._evict()
+            self.conn.commit()
+
+    def _stored_bytes(self) -> int:
+        return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def _write_access_times(self):
+        if self.accessed:
+            self.conn.executemany("UPDATE entries SET accessed_at = ? WHERE key = ?",
+                                  [(accessed_at, key) for key, accessed_at in self.accessed.items()])
+            self.accessed.clear()
+
+    def _evict(self):
+        self.conn.execute("DELETE FROM entries WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+        # other processes sharing the file keep their own running totals, so recount before evicting
+        self.size = self._stored_bytes()
+        if self.size <= self.max_bytes:
+            return
+        evicted = 0
+        for key, size in self.conn.execute("SELECT key, size FROM entries ORDER BY accessed_at").fetchall():
+            if self.size <= self.max_bytes:
+                break
+            self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.size -= size
+            evicted += 1
+        logger.info(f"Evicted {evicted} entries from LLM cache")
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def summary(self) -> str:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        hit_rate = self.stats["hits"] / lookups if lookups else 0.0
+        return (f"LLM cache: {self.stats['hits']} hits, {self.stats['misses']} misses ({hit_rate:.0%} hit rate), "
+                f"saved {self.stats['tokens_saved']} tokens and {self.stats['latency_saved']:.1f}s of LLM latency")
+
+    def flush(self):
+        """Write the access times of hits still held in memory."""
+        with self.lock:
+            self._write_access_times()
+            self.conn.commit()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.conn.close()
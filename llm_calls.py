@@ -1,50 +1,179 @@
-from openai import OpenAI
 import os
 import logging
+import threading
+import time
+from pydantic import BaseModel, ValidationError
+from typing import Any, Dict, List, Optional, Tuple, Type
 from schemas import IsMeetingRequest, MeetingDetails
+from llm_cache import LLMCache, LLM_CACHE_FILE, MAX_CACHE_BYTES, CACHE_TTL_SECONDS
+from rate_limit import call_openai, call_openai_async
 
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize OpenAI API client
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-client = OpenAI(api_key=OPENAI_API_KEY)
+# OpenAI API clients, created on first use by get_client()/get_async_client():
+# importing openai is the slowest part of startup and tests never need a real client
+client: Any = None
+async_client: Any = None
+client_lock = threading.Lock()
 model = "gpt-4o-mini"
+# responses are only cached once enable_cache() has been called
+cache: Optional[LLMCache] = None
 
-def is_meeting_request(text: str) -> IsMeetingRequest:
-    system_message = "Analyze if the email contains a meeting request. Reply with True or False."
+def get_client() -> Any:
+    global client
+    with client_lock:
+        if client is None:
+            from openai import OpenAI
+            # rate_limit owns retries, so the SDK's own are turned off
+            client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+        return client
+
+def get_async_client() -> Any:
+    global async_client
+    with client_lock:
+        if async_client is None:
+            from openai import AsyncOpenAI
+            async_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+        return async_client
+
+def log_cache_summary():
+    if cache is not None:
+        cache.flush()
+        logger.info(cache.summary())
+
+def enable_cache(path: str = LLM_CACHE_FILE, max_bytes: int = MAX_CACHE_BYTES, ttl_seconds: float = CACHE_TTL_SECONDS) -> LLMCache:
+    global cache
+    cache = LLMCache(path, max_bytes, ttl_seconds)
+    return cache
+
+def cache_lookup(messages: List[Dict[str, str]], response_format: Optional[Type[BaseModel]]) -> Tuple[Optional[str], Any]:
+    """Return ``(key, cached_result)``; both are None when caching is disabled."""
+    if cache is None:
+        return None, None
+    schema = response_format.model_json_schema() if response_format is not None else None
+    key = LLMCache.make_key(model, messages, schema)
+    value = cache.get(key)
+    if value is None or response_format is None:
+        return key, value
+    try:
+        return key, response_format.model_validate_json(value)
+    except ValidationError as e:
+        logger.warning(f"Discarding cached LLM response that no longer matches {response_format.__name__}: {e}")
+        return key, None
+
+def cache_store(key: Optional[str], result: Any, tokens: int, latency: float):
+    if key is None or result is None:
+        return
+    value = result if isinstance(result, str) else result.model_dump_json()
+    cache.put(key, value, tokens=tokens, latency=latency)
+
+def response_tokens(response: Any) -> int:
+    usage = getattr(response, "usage", None)
+    return usage.total_tokens if usage is not None else 0
 
-    response = client.beta.chat.completions.parse(
+def parse_completion(messages: List[Dict[str, str]], response_format: Type[BaseModel]) -> Any:
+    key, result = cache_lookup(messages, response_format)
+    if result is not None:
+        return result
+    started = time.perf_counter()
+    response = call_openai(lambda: get_client().beta.chat.completions.parse(
         model=model,
-        messages=[{"role": "system", "content": system_message},
-                  {"role": "user", "content": text}],
-        response_format=IsMeetingRequest
-    )
-    logger.info("Checked if email contains a meeting request.")
-    return response.choices[0].message.parsed
+        messages=messages,
+        response_format=response_format
+    ), messages)
+    result = response.choices[0].message.parsed
+    cache_store(key, result, response_tokens(response), time.perf_counter() - started)
+    return result
 
-def extract_meeting_details(text: str, username: str, date: str) -> MeetingDetails:
+def create_completion(messages: List[Dict[str, str]]) -> str:
+    key, result = cache_lookup(messages, None)
+    if result is not None:
+        return result
+    started = time.perf_counter()
+    response = call_openai(lambda: get_client().chat.completions.create(
+        model=model,
+        messages=messages
+    ), messages)
+    result = response.choices[0].message.content
+    cache_store(key, result, response_tokens(response), time.perf_counter() - started)
+    return result
+
+async def parse_completion_async(messages: List[Dict[str, str]], response_format: Type[BaseModel]) -> Any:
+    key, result = cache_lookup(messages, response_format)
+    if result is not None:
+        return result
+    started = time.perf_counter()
+    response = await call_openai_async(lambda: get_async_client().beta.chat.completions.parse(
+        model=model,
+        messages=messages,
+        response_format=response_format
+    ), messages)
+    result = response.choices[0].message.parsed
+    cache_store(key, result, response_tokens(response), time.perf_counter() - started)
+    return result
+
+async def create_completion_async(messages: List[Dict[str, str]]) -> str:
+    key, result = cache_lookup(messages, None)
+    if result is not None:
+        return result
+    started = time.perf_counter()
+    response = await call_openai_async(lambda: get_async_client().chat.completions.create(
+        model=model,
+        messages=messages
+    ), messages)
+    result = response.choices[0].message.content
+    cache_store(key, result, response_tokens(response), time.perf_counter() - started)
+    return result
+
+def is_meeting_request_messages(text: str) -> List[Dict[str, str]]:
+    system_message = "Analyze if the email contains a meeting request. Reply with True or False."
+    return [{"role": "system", "content": system_message},
+            {"role": "user", "content": text}]
+
+def extract_meeting_details_messages(text: str, username: str, date: str) -> List[Dict[str, str]]:
     system_message = f"You are a helpful assistant that schedules meetings for {username}. Extract meeting details from the following email. This email was sent on {date}. Date and time details, if found, should be relative to {date}."
     prompt = f'Email:\n"{text}"'
+    return [{"role": "system", "content": system_message},
+            {"role": "user", "content": prompt}]
 
-    response = client.beta.chat.completions.parse(
-        model=model,
-        messages=[{"role": "system", "content": system_message},
-                  {"role": "user", "content": prompt}],
-        response_format=MeetingDetails
-    )
+def compose_availability_email_messages(text: str, username: str, slots: Optional[List[str]] = None) -> List[Dict[str, str]]:
+    system_message = f"You are a helpful assistant that responds to emails for {username}. Write a response to the following email. Respond with just the body of the email. Do not include headers. Sign the message as {username}"
+    if slots:
+        times = "\n".join(f"- {slot}" for slot in slots)
+        prompt = f"This email contains details about a meeting request, but is missing some details such as the date and time. Write a response that offers these times when {username} is free, listed exactly as given, and asks the sender to pick one or suggest another:\n{times}\n\nEmail:\n{text}"
+    else:
+        prompt = f"This email contains details about a meeting request, but is missing some details such as the date and time. Write a response to ask for available times.\n\nEmail:\n{text}"
+    return [{"role": "system", "content": system_message},
+            {"role": "user", "content": prompt}]
+
+def is_meeting_request(text: str) -> IsMeetingRequest:
+    result = parse_completion(is_meeting_request_messages(text), IsMeetingRequest)
+    logger.info("Checked if email contains a meeting request.")
+    return result
+
+def extract_meeting_details(text: str, username: str, date: str) -> MeetingDetails:
+    result = parse_completion(extract_meeting_details_messages(text, username, date), MeetingDetails)
     logger.info("Extracted meeting details from email.")
-    return response.choices[0].message.parsed
+    return result
 
-def compose_availability_email(text: str, username: str) -> str:
-    system_message = f"You are a helpful assistant that responds to emails for {username}. Write a response to the following email. Respond with just the body of the email. Do not include headers. Sign the message as {username}"
-    prompt = f"This email contains details about a meeting request, but is missing some details such as the date and time. Write a response to ask for available times.\n\nEmail:\n{text}"
+def compose_availability_email(text: str, username: str, slots: Optional[List[str]] = None) -> str:
+    result = create_completion(compose_availability_email_messages(text, username, slots))
+    logger.info("Composed availability email.")
+    return result
 
-    response = client.chat.completions.create(
-        model=model,
-        messages=[{"role": "system", "content": system_message},
-                  {"role": "user", "content": prompt}]
-    )
+async def is_meeting_request_async(text: str) -> IsMeetingRequest:
+    result = await parse_completion_async(is_meeting_request_messages(text), IsMeetingRequest)
+    logger.info("Checked if email contains a meeting request.")
+    return result
+
+async def extract_meeting_details_async(text: str, username: str, date: str) -> MeetingDetails:
+    result = await parse_completion_async(extract_meeting_details_messages(text, username, date), MeetingDetails)
+    logger.info("Extracted meeting details from email.")
+    return result
+
+async def compose_availability_email_async(text: str, username: str, slots: Optional[List[str]] = None) -> str:
+    result = await create_completion_async(compose_availability_email_messages(text, username, slots))
     logger.info("Composed availability email.")
-    return response.choices[0].message.content
\ No newline at end of file
+    return result
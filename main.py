@@ -1,10 +1,26 @@
+import asyncio
+import datetime as dt
 import logging
 import argparse
-from dateutil import parser
+from typing import Optional
+from dateutil import tz
 from oauth_utils import get_calendar_service, get_gmail_service
-from calendar_utils import create_calendar_event
-from gmail_utils import mark_email_as_read, send_reply_email, get_unread_emails
-from llm_calls import is_meeting_request, extract_meeting_details, compose_availability_email
+from gmail_utils import make_label_batcher, BATCH_SIZE, PAGE_SIZE, SYNC_STATE_FILE, MAX_BATCH_MODIFY_IDS, FLUSH_SECONDS
+from llm_calls import enable_cache, log_cache_summary
+from llm_cache import LLM_CACHE_FILE, MAX_CACHE_BYTES, CACHE_TTL_SECONDS
+from prefilter import enable_prefilter, log_prefilter_summary, MODEL_FILE, LABELS_FILE, SKIP_BELOW
+from pipeline import run_workflow_async, STAGE_CONCURRENCY, MAX_PENDING
+from llm_batch import POLL_INTERVAL_SECONDS
+from normalize import set_token_budget, log_normalize_summary, MAX_BODY_TOKENS
+from journal import enable_journal, acknowledge, log_journal_summary, JOURNAL_FILE
+from invites import log_extraction_summary
+from metrics import enable_export, export_metrics, log_metrics_summary
+from availability import configure as configure_availability, PROPOSED_SLOTS, WORKDAY_START, WORKDAY_END, CALENDARS
+from calendar_utils import DEFAULT_TIMEZONE
+from workflow import process_emails
+from daemon import run_daemon, MIN_POLL_SECONDS, MAX_POLL_SECONDS
+from rate_limit import configure as configure_rate_limits, OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE
+from roster import run_roster, load_roster, WORKERS
 
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO)
@@ -12,62 +28,157 @@ logger = logging.getLogger(__name__)
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Run the email and calendar workflow.")
-    parser.add_argument("username", type=str, help="The username to use in the workflow.")
-    return parser.parse_args()
+    parser.add_argument("username", type=str, nargs="?", help="The username to use in the workflow.")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE, help="Number of unread message ids listed per page (max 500).")
+    parser.add_argument("--max-in-flight", type=int, default=BATCH_SIZE, help="Maximum number of messages fetched per batch request.")
+    parser.add_argument("--incremental", action="store_true", help="Only fetch mail added since the last run, using Gmail history ids.")
+    parser.add_argument("--sync-state", type=str, default=SYNC_STATE_FILE, help="File where --incremental keeps the last history id.")
+    parser.add_argument("--thread-dedup", action=argparse.BooleanOptionalAction, default=None,
+                        help="Process only the newest unread message of each thread. On by default with --incremental only, "
+                             "since a full scan then lists every page before handling the first email.")
+    parser.add_argument("--pipeline", action="store_true", help="Process emails concurrently with a bounded worker pool per stage.")
+    parser.add_argument("--stage-concurrency", type=parse_stage_concurrency, default={},
+                        help=f"Per-stage limits for --pipeline, e.g. classify=16,act=2. Stages: {', '.join(STAGE_CONCURRENCY)}.")
+    parser.add_argument("--max-pending", type=int, default=MAX_PENDING, help="Maximum emails in flight across all stages with --pipeline.")
+    parser.add_argument("--llm-cache", type=str, default=LLM_CACHE_FILE, help="SQLite file caching LLM responses.")
+    parser.add_argument("--llm-cache-max-mb", type=float, default=MAX_CACHE_BYTES / 2**20, help="Size limit of the LLM cache in MB.")
+    parser.add_argument("--llm-cache-ttl-days", type=float, default=CACHE_TTL_SECONDS / 86400, help="Days before a cached LLM response expires.")
+    parser.add_argument("--no-llm-cache", action="store_true", help="Always call the LLM, bypassing the response cache.")
+    parser.add_argument("--journal", type=str, default=JOURNAL_FILE, help="SQLite file recording each email's progress, so an interrupted run resumes.")
+    parser.add_argument("--no-journal", action="store_true", help="Do not record progress; a rerun starts every email over.")
+    parser.add_argument("--no-prefilter", action="store_true", help="Send every email to the LLM classifier.")
+    parser.add_argument("--prefilter-model", type=str, default=MODEL_FILE, help="Model trained with `python prefilter.py train`.")
+    parser.add_argument("--prefilter-labels", type=str, default=LABELS_FILE, help="File where LLM verdicts are recorded as training labels.")
+    parser.add_argument("--skip-below", type=float, default=SKIP_BELOW, help="Skip the LLM when the prefilter's meeting probability is below this.")
+    parser.add_argument("--accept-above", type=float, default=None, help="Treat emails as meeting requests without the LLM above this probability.")
+    parser.add_argument("--audit-rate", type=float, default=0.0, help="Share of prefilter-rejected emails still sent to the LLM to keep labels unbiased.")
+    parser.add_argument("--max-body-tokens", type=int, default=MAX_BODY_TOKENS, help="Trim email bodies sent to the LLM to this many tokens; 0 keeps them whole.")
+    parser.add_argument("--batch", action="store_true", help="Classify and extract the whole backlog through the OpenAI Batch API first.")
+    parser.add_argument("--batch-poll-interval", type=float, default=POLL_INTERVAL_SECONDS, help="Seconds between Batch API status checks.")
+    parser.add_argument("--processed-label", type=str, default=None, help="Gmail label added to every handled email, e.g. scheduler-processed.")
+    parser.add_argument("--flush-size", type=int, default=MAX_BATCH_MODIFY_IDS, help="Mark emails read once this many are pending (max 1000).")
+    parser.add_argument("--flush-seconds", type=float, default=FLUSH_SECONDS, help="Mark emails read once the oldest has waited this long.")
+    parser.add_argument("--daemon", action="store_true", help="Keep running and poll for new mail instead of exiting after one pass.")
+    parser.add_argument("--min-poll-seconds", type=float, default=MIN_POLL_SECONDS, help="Poll interval with --daemon while mail is arriving.")
+    parser.add_argument("--max-poll-seconds", type=float, default=MAX_POLL_SECONDS, help="Longest poll interval with --daemon once the inbox is quiet.")
+    parser.add_argument("--openai-rpm", type=float, default=OPENAI_REQUESTS_PER_MINUTE, help="OpenAI requests per minute allowed for your account tier.")
+    parser.add_argument("--openai-tpm", type=float, default=OPENAI_TOKENS_PER_MINUTE, help="OpenAI tokens per minute allowed for your account tier.")
+    parser.add_argument("--proposed-slots", type=int, default=PROPOSED_SLOTS, help="Free times offered when a meeting request has no time; 0 just asks for times.")
+    parser.add_argument("--timezone", type=parse_timezone, default=DEFAULT_TIMEZONE, help="Your time zone, for working hours and proposed times.")
+    parser.add_argument("--working-hours", type=parse_working_hours, default=(WORKDAY_START, WORKDAY_END),
+                        help="Hours within which times are proposed, e.g. 09:00-17:00.")
+    parser.add_argument("--calendars", type=lambda value: value.split(","), default=CALENDARS,
+                        help="Comma-separated calendar ids whose busy times are avoided.")
+    parser.add_argument("--metrics-file", type=str, default=None, help="Write metrics here after each run: Prometheus text, or a JSON snapshot for a .json path.")
+    parser.add_argument("--log-bodies", action="store_true", help="Log email bodies, extracted details and replies. They may contain personal data.")
+    parser.add_argument("--roster", type=str, default=None, help="JSON list of accounts to process instead of a single username.")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Worker processes the --roster accounts are sharded across.")
+    args = parser.parse_args()
+    if (args.username is None) == (args.roster is None):
+        parser.error("pass either a username or --roster")
+    if args.roster and (args.batch or args.pipeline):
+        parser.error("--roster cannot be combined with --batch or --pipeline")
+    if args.batch and (args.pipeline or args.incremental or args.daemon):
+        # the whole backlog is listed before any email is handled, which would advance the sync checkpoint early
+        parser.error("--batch cannot be combined with --pipeline, --incremental or --daemon")
+    if args.daemon and args.pipeline:
+        parser.error("--daemon cannot be combined with --pipeline")
+    return args
 
-def run_workflow(username: str):
+def parse_timezone(value: str) -> str:
+    if tz.gettz(value) is None:
+        raise argparse.ArgumentTypeError(f"unknown time zone: {value!r}")
+    return value
+
+def parse_working_hours(value: str) -> tuple:
+    try:
+        start, end = (dt.time.fromisoformat(part.strip()) for part in value.split("-"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid working hours: {value!r}")
+    if start >= end:
+        raise argparse.ArgumentTypeError(f"working hours must end after they start: {value!r}")
+    return start, end
+
+def parse_stage_concurrency(value: str) -> dict:
+    limits = {}
+    for item in value.split(","):
+        stage, _, limit = item.partition("=")
+        if stage not in STAGE_CONCURRENCY or not limit.isdigit() or int(limit) < 1:
+            raise argparse.ArgumentTypeError(f"invalid stage limit: {item!r}")
+        limits[stage] = int(limit)
+    return limits
+
+def run_workflow(username: str, page_size: int = PAGE_SIZE, max_in_flight: int = BATCH_SIZE,
+                 incremental: bool = False, sync_state: str = SYNC_STATE_FILE,
+                 batch: bool = False, batch_poll_interval: float = POLL_INTERVAL_SECONDS,
+                 processed_label: Optional[str] = None, flush_size: int = MAX_BATCH_MODIFY_IDS,
+                 flush_seconds: float = FLUSH_SECONDS, collapse_threads: Optional[bool] = None):
     calendar_service = get_calendar_service()
     gmail_service = get_gmail_service()
-    logger.info('fetching most recent unread email')
-    email_dicts = get_unread_emails(gmail_service)
-    logger.info(f'found {len(email_dicts)} emails')
-    for email_dict in email_dicts:
-        logger.info('reconstructing email...')
-        plaintext_email = "\n".join([
-            'From: ' + email_dict['From'],
-            'To: ' + email_dict['To'],
-            # 'Date: ' + email_dict['Date'],
-            'Subject: ' + email_dict['Subject'],
-            "\n" + email_dict['Body']
-        ])
-        logger.info('reconstructed email:')
-        logger.info(plaintext_email)
-
-        logger.info('determining if email contains meeting...')
-        relevant_email = is_meeting_request(plaintext_email)
-        if relevant_email.is_meeting_request:
-            logger.info(f'meeting contains request')
-            logger.info('extracting meeting details...')
-            timestamp = parser.parse(email_dict['Date'])
-            date_str = timestamp.strftime("%a, %d %b, %Y")
-            meeting_details = extract_meeting_details(plaintext_email, username, date_str)
-            logger.info('extracted meeting details:')
-            logger.info(meeting_details, email_dict)
-            if meeting_details.start_time is not None and meeting_details.date is not None:
-                logger.info(f'meeting details contain a date and time: {meeting_details.date} {meeting_details.start_time}. creating calendar event...')
-                if email_dict['To'] not in meeting_details.attendees: # recipient is attendee
-                    meeting_details.attendees.append(email_dict['To'])
-                if email_dict['From'] not in meeting_details.attendees: # sender is attendee. note: not always true if secretary scheduling for others
-                    meeting_details.attendees.append(email_dict['From'])
-                create_calendar_event(calendar_service, meeting_details)
-                logger.info('created calendar event')
-            else:
-                logger.info('meeting details missing date and/or time details. composing followup email...')
-                reply_message = compose_availability_email(plaintext_email, username)
-                logger.info('response email:')
-                logger.info(reply_message)
-                logger.info('sending response email...')
-                send_reply_email(gmail_service, email_dict, reply_message)
-                logger.info('sent_response_email')
-        else:
-            logger.info("email does not contain meeting request. skipping...")
-        logger.info("marking email as read")
-        mark_email_as_read(gmail_service, email_dict['Id'])
-        logger.info("marked email as read")
-        logger.info('====================')
-    logger.info('done')
-    exit()
+    with make_label_batcher(gmail_service, processed_label, flush_size, flush_seconds, acknowledge) as read_marker:
+        processed = process_emails(username, calendar_service, gmail_service, read_marker, page_size=page_size,
+                                   max_in_flight=max_in_flight, incremental=incremental, sync_state=sync_state,
+                                   batch=batch, batch_poll_interval=batch_poll_interval,
+                                   collapse_threads=collapse_threads)
+    logger.info(f'done. processed {processed} emails')
+    log_cache_summary()
+    log_prefilter_summary()
+    log_normalize_summary()
+    log_journal_summary()
+    log_extraction_summary()
+    log_metrics_summary()
+    export_metrics()
+    return processed
 
 if __name__ == "__main__":
     args = parse_arguments()
-    run_workflow(args.username)
\ No newline at end of file
+    if args.log_bodies:
+        for name in ("workflow", "pipeline"):
+            logging.getLogger(name).setLevel(logging.DEBUG)
+    configure_rate_limits(openai_requests_per_minute=args.openai_rpm, openai_tokens_per_minute=args.openai_tpm)
+    availability_options = dict(timezone=args.timezone, start=args.working_hours[0], end=args.working_hours[1],
+                                slot_count=args.proposed_slots, calendar_ids=args.calendars)
+    cache_options = None if args.no_llm_cache else dict(
+        path=args.llm_cache, max_bytes=int(args.llm_cache_max_mb * 2**20), ttl_seconds=args.llm_cache_ttl_days * 86400)
+    journal_options = None if args.no_journal else dict(path=args.journal)
+    prefilter_options = None if args.no_prefilter else dict(
+        model_path=args.prefilter_model, labels=args.prefilter_labels, skip_below=args.skip_below,
+        accept_above=args.accept_above, audit_rate=args.audit_rate)
+    if args.roster:
+        # the workers open the cache and load the prefilter themselves
+        run_roster(load_roster(args.roster), workers=args.workers, daemon=args.daemon,
+                   min_interval=args.min_poll_seconds, max_interval=args.max_poll_seconds,
+                   llm_cache=cache_options, prefilter=prefilter_options, journal=journal_options, max_body_tokens=args.max_body_tokens,
+                   metrics_file=args.metrics_file, log_bodies=args.log_bodies, availability_options=availability_options,
+                   openai_requests_per_minute=args.openai_rpm, openai_tokens_per_minute=args.openai_tpm,
+                   processed_label=args.processed_label, flush_size=args.flush_size, flush_seconds=args.flush_seconds,
+                   page_size=args.page_size, max_in_flight=args.max_in_flight, incremental=args.incremental,
+                   collapse_threads=args.thread_dedup)
+    else:
+        set_token_budget(args.max_body_tokens)
+        configure_availability(**availability_options)
+        enable_export(args.metrics_file)
+        if cache_options is not None:
+            enable_cache(**cache_options)
+        if journal_options is not None:
+            enable_journal(**journal_options)
+        if prefilter_options is not None:
+            enable_prefilter(**prefilter_options)
+        if args.daemon:
+            run_daemon(args.username, min_interval=args.min_poll_seconds, max_interval=args.max_poll_seconds,
+                       processed_label=args.processed_label, flush_size=args.flush_size, flush_seconds=args.flush_seconds,
+                       page_size=args.page_size, max_in_flight=args.max_in_flight,
+                       incremental=args.incremental, sync_state=args.sync_state,
+                       collapse_threads=args.thread_dedup)
+        elif args.pipeline:
+            asyncio.run(run_workflow_async(args.username, page_size=args.page_size, max_in_flight=args.max_in_flight,
+                                           incremental=args.incremental, sync_state=args.sync_state,
+                                           stage_concurrency=args.stage_concurrency, max_pending=args.max_pending,
+                                           processed_label=args.processed_label, flush_size=args.flush_size,
+                                           flush_seconds=args.flush_seconds, collapse_threads=args.thread_dedup))
+        else:
+            run_workflow(args.username, page_size=args.page_size, max_in_flight=args.max_in_flight,
+                         incremental=args.incremental, sync_state=args.sync_state,
+                         batch=args.batch, batch_poll_interval=args.batch_poll_interval,
+                         processed_label=args.processed_label, flush_size=args.flush_size, flush_seconds=args.flush_seconds,
+                         collapse_threads=args.thread_dedup)
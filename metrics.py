@@ -0,0 +1,211 @@
+"""Timing spans, API counters and OpenAI token usage for the workflow.
+
+Stages are timed with ``span``, and ``rate_limit`` counts every API request,
+error, retry and rate-limit wait. Everything is kept in memory per process.
+``log_metrics_summary`` logs it at the end of a run, and ``export_metrics``
+writes it to the file set with ``enable_export``: a JSON snapshot for a
+``.json`` path, otherwise the Prometheus text format read by node_exporter's
+textfile collector.
+"""
+import bisect
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PREFIX = "scheduler_"
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+HELP = {
+    "stage_seconds": "Time spent in each workflow stage, per email or per call.",
+    "emails_total": "Emails handled, by outcome.",
+    "api_requests_total": "Google and OpenAI API requests, counting each part of a batch request.",
+    "api_errors_total": "API requests that failed, by HTTP status or error type.",
+    "api_retries_total": "API requests retried after a throttling or transient error.",
+    "rate_limit_wait_seconds_total": "Time spent waiting for client-side rate limit budget.",
+    "openai_tokens_total": "OpenAI tokens used, as reported in each response.",
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self):
+        # one count per bucket, plus one for values above the last bound
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the ``q`` quantile; exact enough to spot a regression."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+lock = threading.Lock()
+counters: Dict[Tuple[str, Labels], float] = {}
+histograms: Dict[Tuple[str, Labels], Histogram] = {}
+# added to every series, e.g. the worker a roster shard runs on
+constant_labels: Dict[str, str] = {}
+metrics_file: Optional[str] = None
+
+
+def labels_key(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def count(name: str, amount: float = 1, **labels: Any):
+    key = (name, labels_key(labels))
+    with lock:
+        counters[key] = counters.get(key, 0) + amount
+
+def observe(name: str, value: float, **labels: Any):
+    key = (name, labels_key(labels))
+    with lock:
+        if key not in histograms:
+            histograms[key] = Histogram()
+        histograms[key].observe(value)
+
+@contextlib.contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Time the block as one sample of ``stage``; works around ``await`` too."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("stage_seconds", time.perf_counter() - started, stage=stage)
+
+def timed(stage: str, fn: Callable) -> Callable:
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with span(stage):
+            return fn(*args, **kwargs)
+    return wrapper
+
+def timed_iter(stage: str, items: Iterable) -> Iterator:
+    """Yield from ``items``, timing how long each item takes to arrive."""
+    iterator = iter(items)
+    while True:
+        started = time.perf_counter()
+        item = next(iterator, None)
+        if item is None:
+            return
+        observe("stage_seconds", time.perf_counter() - started, stage=stage)
+        yield item
+
+def record_usage(usage: Any):
+    """Count prompt and completion tokens from an OpenAI ``usage``, as an object or as parsed JSON."""
+    if usage is None:
+        return
+    for kind in ("prompt", "completion"):
+        tokens = usage.get(f"{kind}_tokens") if isinstance(usage, dict) else getattr(usage, f"{kind}_tokens", None)
+        if isinstance(tokens, int):
+            count("openai_tokens_total", tokens, kind=kind)
+
+def reset():
+    with lock:
+        counters.clear()
+        histograms.clear()
+
+
+def series(labels: Labels) -> Dict[str, str]:
+    return {**constant_labels, **dict(labels)}
+
+def snapshot() -> Dict[str, Any]:
+    with lock:
+        result: Dict[str, Any] = {"counters": {}, "histograms": {}}
+        for (name, labels), value in sorted(counters.items()):
+            result["counters"].setdefault(name, []).append({"labels": series(labels), "value": value})
+        for (name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+            result["histograms"].setdefault(name, []).append({
+                "labels": series(labels), "count": histogram.count, "sum": histogram.sum,
+                "p50": histogram.quantile(0.5), "p95": histogram.quantile(0.95), "max": histogram.max,
+            })
+        return result
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (name + '="' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+               for name, value in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+def to_prometheus() -> str:
+    lines: List[str] = []
+    described = set()
+
+    def describe(name: str, kind: str):
+        if name not in described:
+            described.add(name)
+            lines.append(f"# HELP {PREFIX}{name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+    with lock:
+        for (name, labels), value in sorted(counters.items()):
+            describe(name, "counter")
+            lines.append(f"{PREFIX}{name}{format_labels(series(labels))} {value:g}")
+        for (name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+            describe(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + (float("inf"),), histogram.counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f"{PREFIX}{name}_bucket{format_labels({**series(labels), 'le': le})} {cumulative}")
+            lines.append(f"{PREFIX}{name}_sum{format_labels(series(labels))} {histogram.sum:g}")
+            lines.append(f"{PREFIX}{name}_count{format_labels(series(labels))} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+def enable_export(path: Optional[str]):
+    global metrics_file
+    metrics_file = path
+
+def export_metrics():
+    """Write the metrics to the file set with ``enable_export``, if any."""
+    if metrics_file is None:
+        return
+    content = json.dumps(snapshot(), indent=2) if metrics_file.endswith(".json") else to_prometheus()
+    # write then rename so a scraper never reads a half-written file
+    tmp_path = metrics_file + ".tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, metrics_file)
+    except OSError as e:
+        logger.error(f"Error writing metrics to {metrics_file}: {e}")
+
+def log_metrics_summary():
+    data = snapshot()
+    for entry in data["histograms"].get("stage_seconds", []):
+        logger.info(f"Stage {entry['labels']['stage']}: {entry['count']} calls, p50 {entry['p50'] * 1000:.0f}ms "
+                    f"p95 {entry['p95'] * 1000:.0f}ms")
+    totals: Dict[str, Dict[str, float]] = {}
+    for name in ("api_requests_total", "api_errors_total", "api_retries_total"):
+        for entry in data["counters"].get(name, []):
+            api_totals = totals.setdefault(entry["labels"].get("api", "other"), {})
+            api_totals[name] = api_totals.get(name, 0) + entry["value"]
+    for api, api_totals in totals.items():
+        logger.info(f"API {api}: {api_totals.get('api_requests_total', 0):g} requests, "
+                    f"{api_totals.get('api_errors_total', 0):g} errors, {api_totals.get('api_retries_total', 0):g} retries")
+    tokens = {entry["labels"]["kind"]: entry["value"] for entry in data["counters"].get("openai_tokens_total", [])}
+    if tokens:
+        logger.info(f"OpenAI tokens: {tokens.get('prompt', 0):g} prompt, {tokens.get('completion', 0):g} completion")
@@ -0,0 +1,239 @@
+"""Shrink email bodies to the text that matters before they are sent to the LLM.
+
+Quoted reply history, signatures and legal disclaimers are stripped, and what
+is left is trimmed to a token budget. Tokens are counted with ``tiktoken`` when
+it is installed, and estimated at four characters per token otherwise.
+"""
+import html
+import logging
+import re
+from html.parser import HTMLParser
+from typing import Any, Dict, List, NamedTuple
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# most emails fit well within this; longer ones are cut in the middle
+MAX_BODY_TOKENS = 1500
+# tokenizer used by the gpt-4o model family
+TIKTOKEN_ENCODING = "o200k_base"
+CHARS_PER_TOKEN = 4
+# share of the budget kept from the start of the body; the rest comes from its end
+HEAD_SHARE = 0.75
+TRIM_MARKER = "\n[...]\n"
+
+# a reply header marks where the quoted history starts; everything after it is dropped
+REPLY_HEADER_PATTERNS = [
+    re.compile(r"^On\b[^\n]{0,200}(?:\n[^\n]{0,200})?\bwrote:[ \t]*$", re.M),
+    re.compile(r"^-{2,}[ \t]*Original Message[ \t]*-{2,}", re.M | re.I),
+    re.compile(r"^_{20,}[ \t]*\nFrom:", re.M),
+    re.compile(r"^From:[^\n]*\n(?:[^\n]*\n){0,3}?(?:Sent|Date):", re.M),
+]
+# a forwarded message's header block looks like a reply header, but what follows it is the message being passed on
+FORWARD_MARKER = re.compile(r"^(?:-{2,}[ \t]*Forwarded message[ \t]*-{2,}|Begin forwarded message:)[^\n]*", re.M | re.I)
+SIGNATURE_PATTERNS = [
+    # RFC 3676 signature separator
+    re.compile(r"^--[ \t]?$", re.M),
+    re.compile(r"^(?:Sent from my|Sent from Mail for|Get Outlook for)\b", re.M | re.I),
+]
+VALEDICTION = re.compile(
+    r"^(?:best|best regards|best wishes|kind regards|warm regards|regards|thanks|thank you|many thanks|"
+    r"cheers|sincerely|all the best)[ \t]*[,.!]?[ \t]*$", re.I)
+# a closing line this close to the end starts the signature block
+VALEDICTION_MAX_LINES_FROM_END = 8
+# ...but only when the lines after it are few, short and say nothing about when to meet
+SIGNATURE_MAX_LINES = 4
+SIGNATURE_MAX_LINE_CHARS = 60
+NOT_SIGNATURE = re.compile(
+    r"\?|\b(?:mon|tues?|wed(?:nes)?|thu(?:rs)?|fri|sat(?:ur)?|sun)(?:day)?\b|\b(?:today|tomorrow|tonight|next week)\b|"
+    r"\b\d{1,2}(?::\d{2})?[ \t]*[ap]\.?m\b|\b\d{1,2}:\d{2}\b|"
+    r"\b(?:jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\.?[ \t]+\d{1,2}\b", re.I)
+DISCLAIMER = re.compile(
+    r"confidentiality notice|intended (?:solely |only )?for the (?:use of the )?(?:individual|addressee|named recipient)|"
+    r"if you (?:are not the intended recipient|have received this (?:e-?mail|message) in error)|"
+    r"this (?:e-?mail|message)(?: and any attachments)? (?:is|are|may be|contains?) (?:confidential|privileged)",
+    re.I)
+
+
+class HTMLToText(HTMLParser):
+    """Collects the visible text of an HTML body, one line per block element, skipping quoted replies."""
+
+    BLOCK_TAGS = {"p", "div", "br", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6", "table", "ul", "ol", "hr"}
+    SKIPPED_TAGS = {"script", "style", "head", "title", "blockquote"}
+    VOID_TAGS = {"br", "hr", "img", "meta", "link", "input", "wbr", "area", "base", "col", "source"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+        # open tags, each marked with whether it hides its content
+        self.stack: List[bool] = []
+
+    def skipping(self) -> bool:
+        return any(self.stack)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+        if tag in self.VOID_TAGS:
+            return
+        classes = dict(attrs).get("class") or ""
+        # Gmail and Yahoo wrap the quoted history in these
+        self.stack.append(tag in self.SKIPPED_TAGS or "gmail_quote" in classes or "yahoo_quoted" in classes)
+
+    def handle_endtag(self, tag):
+        if tag in self.VOID_TAGS:
+            return
+        if self.stack:
+            self.stack.pop()
+        if tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self.skipping():
+            self.parts.append(data)
+
+    def text(self) -> str:
+        text = "".join(self.parts).replace("\xa0", " ")
+        text = re.sub(r"[ \t\r\f\v]+", " ", text)
+        return "\n".join(line.strip() for line in text.split("\n"))
+
+
+def html_to_text(html_body: str) -> str:
+    parser = HTMLToText()
+    try:
+        parser.feed(html_body)
+        parser.close()
+    except AssertionError:
+        # HTMLParser gives up on some malformed markup; fall back to dropping the tags
+        return html.unescape(re.sub(r"<[^>]+>", " ", html_body))
+    return collapse_blank_lines(parser.text())
+
+
+def collapse_blank_lines(text: str) -> str:
+    text = "\n".join(line.rstrip() for line in text.split("\n"))
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def strip_quoted(text: str) -> str:
+    """Drop the quoted history of a reply: everything after a reply header, and ``>`` lines.
+
+    The header block under a "Forwarded message" marker is kept, along with the forwarded message.
+    """
+    forwarded = {len(text[:match.end()].rstrip()) for match in FORWARD_MARKER.finditer(text)}
+    cut = len(text)
+    for pattern in REPLY_HEADER_PATTERNS:
+        for match in pattern.finditer(text):
+            if len(text[:match.start()].rstrip()) not in forwarded:
+                cut = min(cut, match.start())
+                break
+    return "\n".join(line for line in text[:cut].split("\n") if not line.lstrip().startswith(">"))
+
+
+def strip_signature(text: str) -> str:
+    for pattern in SIGNATURE_PATTERNS:
+        match = pattern.search(text)
+        if match is not None:
+            text = text[:match.start()]
+    lines = text.rstrip().split("\n")
+    for i in range(len(lines) - 1, max(-1, len(lines) - 1 - VALEDICTION_MAX_LINES_FROM_END), -1):
+        if VALEDICTION.match(lines[i].strip()):
+            # only the last closing line is considered; one followed by more of the message is not a sign-off
+            return "\n".join(lines[:i]) if looks_like_signature(lines[i + 1:]) else text
+    return text
+
+
+def looks_like_signature(lines: List[str]) -> bool:
+    lines = [line.strip() for line in lines if line.strip()]
+    return len(lines) <= SIGNATURE_MAX_LINES and all(
+        len(line) <= SIGNATURE_MAX_LINE_CHARS and not NOT_SIGNATURE.search(line) for line in lines)
+
+
+def strip_disclaimers(text: str) -> str:
+    paragraphs = re.split(r"\n[ \t]*\n", text)
+    return "\n\n".join(paragraph for paragraph in paragraphs if not DISCLAIMER.search(paragraph))
+
+
+_encoding: Any = None
+_encoding_loaded = False
+
+def get_encoding() -> Any:
+    """The tiktoken encoding, or None when tiktoken is not installed or its data cannot be loaded."""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+        except Exception as e:
+            logger.info(f"tiktoken unavailable ({e!r}). Estimating tokens from characters")
+    return _encoding
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def trim_to_budget(text: str, max_tokens: int) -> str:
+    """Keep the start and end of ``text`` within ``max_tokens``, where greetings, asks and sign-offs usually are."""
+    if max_tokens <= 0 or count_tokens(text) <= max_tokens:
+        return text
+    head_tokens = int(max_tokens * HEAD_SHARE)
+    tail_tokens = max_tokens - head_tokens
+    encoding = get_encoding()
+    if encoding is None:
+        head = text[:head_tokens * CHARS_PER_TOKEN]
+        tail = text[-tail_tokens * CHARS_PER_TOKEN:] if tail_tokens else ""
+    else:
+        tokens = encoding.encode(text, disallowed_special=())
+        head = encoding.decode(tokens[:head_tokens])
+        tail = encoding.decode(tokens[-tail_tokens:]) if tail_tokens else ""
+    return head.rstrip() + TRIM_MARKER + tail.lstrip()
+
+
+class NormalizedBody(NamedTuple):
+    text: str
+    tokens_before: int
+    tokens_after: int
+
+
+def normalize_body(body: str, max_tokens: int = MAX_BODY_TOKENS) -> NormalizedBody:
+    """Strip quoted history, disclaimers and signature from ``body`` and trim it to ``max_tokens``."""
+    text = collapse_blank_lines(strip_signature(strip_disclaimers(strip_quoted(body))))
+    if not text:
+        # a body that is nothing but quotes is better sent as is than not at all
+        text = collapse_blank_lines(body)
+    text = trim_to_budget(text, max_tokens)
+    return NormalizedBody(text, count_tokens(body), count_tokens(text))
+
+
+# the budget used by normalize_email; set from --max-body-tokens
+max_body_tokens = MAX_BODY_TOKENS
+stats = {"emails": 0, "tokens_before": 0, "tokens_after": 0}
+
+def set_token_budget(max_tokens: int):
+    global max_body_tokens
+    max_body_tokens = max_tokens
+
+def normalize_email(msg_dict: Dict[str, str]) -> str:
+    normalized = normalize_body(msg_dict['Body'], max_body_tokens)
+    stats["emails"] += 1
+    stats["tokens_before"] += normalized.tokens_before
+    stats["tokens_after"] += normalized.tokens_after
+    if normalized.tokens_after < normalized.tokens_before:
+        logger.info(f"Normalized email {msg_dict.get('Id', '')}: {normalized.tokens_before} -> {normalized.tokens_after} tokens "
+                    f"({normalized.tokens_before - normalized.tokens_after} saved)")
+    return normalized.text
+
+def normalize_thread(msg_dicts: List[Dict[str, str]]) -> str:
+    """Earlier messages of a thread, oldest first, each cleaned up like a body and trimmed together to one body's budget."""
+    text = "\n\n".join(f"On {msg_dict.get('Date', '')}, {msg_dict.get('From', '')} wrote:\n{normalize_body(msg_dict['Body'], 0).text}"
+                       for msg_dict in msg_dicts)
+    return trim_to_budget(text, max_body_tokens)
+
+def log_normalize_summary():
+    if stats["emails"]:
+        saved = stats["tokens_before"] - stats["tokens_after"]
+        logger.info(f"Normalization: {stats['emails']} emails, {stats['tokens_before']} -> {stats['tokens_after']} body tokens "
+                    f"({saved} saved, {saved / max(stats['tokens_before'], 1):.0%})")
@@ -1,17 +1,18 @@
+import datetime as dt
 import logging
 import os
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+import threading
 from googleapiclient.errors import HttpError
 
-from typing import Any
+from typing import Any, Optional
 
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# refresh access tokens this long before they expire
+REFRESH_MARGIN = dt.timedelta(minutes=5)
+
 SCOPES = [
     "https://www.googleapis.com/auth/calendar",
     "https://www.googleapis.com/auth/gmail.readonly",
@@ -19,38 +20,131 @@ SCOPES = [
     "https://www.googleapis.com/auth/gmail.modify",
 ]
 
-def load_credentials() -> Any:
+TOKEN_FILE = "token.json"
+CREDENTIALS_FILE = "credentials.json"
+
+def load_credentials(token_file: str = TOKEN_FILE) -> Any:
+    # google-auth and the OAuth flow are only imported once credentials are needed
+    from google.oauth2.credentials import Credentials
+    from google.auth.transport.requests import Request
     creds = None
-    if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+    if os.path.exists(token_file):
+        creds = Credentials.from_authorized_user_file(token_file, SCOPES)
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
         else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file(
-                "credentials.json", SCOPES
+                CREDENTIALS_FILE, SCOPES
             )
             creds = flow.run_local_server(port=0)
-        with open("token.json", "w") as token:
-            token.write(creds.to_json())
+        save_credentials(creds, token_file)
     return creds
 
+def save_credentials(creds: Any, token_file: str = TOKEN_FILE):
+    with open(token_file, "w") as token:
+        token.write(creds.to_json())
+
+def refresh_if_expiring(creds: Any, margin: dt.timedelta = REFRESH_MARGIN, token_file: str = TOKEN_FILE) -> bool:
+    """Refresh and persist ``creds`` when they expire within ``margin``; return whether they were refreshed."""
+    if creds.expiry is None or not creds.refresh_token:
+        return False
+    # google-auth keeps expiry as a naive UTC datetime
+    if creds.expiry - dt.datetime.now(dt.timezone.utc).replace(tzinfo=None) > margin:
+        return False
+    from google.auth.transport.requests import Request
+    creds.refresh(Request())
+    save_credentials(creds, token_file)
+    logger.info(f"Refreshed credentials, now valid until {creds.expiry}")
+    return True
+
+def build(service_name: str, version: str, **kwargs: Any) -> Any:
+    """``googleapiclient.discovery.build`` without importing the discovery module until a service is needed.
+
+    Services are built from the discovery documents bundled with the client
+    library, so building never fetches a document over the network.
+    """
+    from googleapiclient.discovery import build as discovery_build
+    kwargs.setdefault("static_discovery", True)
+    return discovery_build(service_name, version, **kwargs)
+
+def authorized_http(creds: Any) -> Any:
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
+    return AuthorizedHttp(creds, http=httplib2.Http())
+
+def build_service(name: str, version: str, creds: Any, http: Optional[Any] = None) -> Any:
+    # httplib2.Http is not thread-safe, so every service built here owns its own transport unless one is passed in
+    return build(name, version, http=http or authorized_http(creds))
+
+
+class GoogleSession:
+    """Loads credentials once and hands out Google API services built on them.
+
+    Discovery-built services and their httplib2 transports are not thread-safe,
+    so each thread gets its own ``AuthorizedHttp`` and its own cached services,
+    all sharing the one set of credentials. Refreshes are serialized. Each
+    mailbox keeps its credentials in its own ``token_file``.
+    """
+
+    def __init__(self, creds: Optional[Any] = None, token_file: str = TOKEN_FILE):
+        self._creds = creds
+        self.token_file = token_file
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @property
+    def credentials(self) -> Any:
+        with self.lock:
+            if self._creds is None:
+                self._creds = load_credentials(self.token_file)
+            return self._creds
+
+    def refresh_if_expiring(self, margin: dt.timedelta = REFRESH_MARGIN) -> bool:
+        creds = self.credentials
+        with self.lock:
+            return refresh_if_expiring(creds, margin, self.token_file)
+
+    def http(self) -> Any:
+        if not hasattr(self.local, "http"):
+            self.local.http = authorized_http(self.credentials)
+        return self.local.http
+
+    def get(self, name: str, version: str) -> Any:
+        services = self.local.__dict__.setdefault("services", {})
+        if (name, version) not in services:
+            services[(name, version)] = build_service(name, version, self.credentials, http=self.http())
+        return services[(name, version)]
+
+    def gmail(self) -> Any:
+        return self.get("gmail", "v1")
+
+    def calendar(self) -> Any:
+        return self.get("calendar", "v3")
+
+
+_session: Optional[GoogleSession] = None
+_session_lock = threading.Lock()
+
+def get_session() -> GoogleSession:
+    """The process-wide session, so credentials are read (and refreshed) once however many services are used."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = GoogleSession()
+        return _session
+
 def get_calendar_service() -> Any:
     try:
-        creds = load_credentials()
-        service = build("calendar", "v3", credentials=creds)
-        return service
+        return get_session().calendar()
     except HttpError as e:
         logger.error(f"Error getting calendar service: {e}")
         return None
-    
-    
 
 def get_gmail_service() -> Any:
     try:
-        creds = load_credentials()
-        service = build("gmail", "v1", credentials=creds)
-        return service
+        return get_session().gmail()
     except HttpError as e:
         logger.error(f"Error getting gmail service: {e}")
         return None
@@ -0,0 +1,253 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+from oauth_utils import GoogleSession, get_session
+from availability import BusyIndex, propose_slots, record_event
+from calendar_utils import create_calendar_event, add_email_participants, event_id_for
+from gmail_utils import LabelUpdateBatcher, make_label_batcher, is_loaded, load_body, mark_handled, send_reply_email, reply_was_sent, format_plaintext_email, format_email_date, iter_unread_emails, iter_new_emails, BATCH_SIZE, PAGE_SIZE, SYNC_STATE_FILE, MAX_BATCH_MODIFY_IDS, FLUSH_SECONDS
+from llm_calls import is_meeting_request_async, extract_meeting_details_async, compose_availability_email_async, log_cache_summary
+from metrics import count, span, timed, timed_iter, log_metrics_summary, export_metrics
+from journal import resume, record, acknowledge, log_journal_summary, FETCHED, CLASSIFIED, EXTRACTED, SENDING, ACTED
+from normalize import log_normalize_summary
+from prefilter import prefilter_email, record_verdict, log_prefilter_summary
+from invites import parse_invite, extract_locally, record_extraction, record_email, log_extraction_summary, LLM
+from schemas import IsMeetingRequest
+from workflow import likely_needs_body, ERROR_OUTCOMES
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# how many emails may be inside each stage at the same time
+STAGE_CONCURRENCY = {
+    "fetch_body": 4,
+    "classify": 8,
+    "extract": 8,
+    "compose": 4,
+    "act": 4,
+    "mark_read": 4,
+}
+# emails fetched but not yet through every stage
+MAX_PENDING = 64
+
+
+class Pipeline:
+    """Runs each email through fetch_body -> classify -> extract -> act -> mark_read.
+
+    Emails are processed concurrently, but each stage has its own bound, OpenAI
+    calls go through the async client and Google API calls run on a thread pool.
+    Bodies are downloaded there too, and only for mail not already rejected by
+    its headers.
+    A single email always moves through its stages in order, and is only marked
+    as read after its calendar event or reply has been handled; read state is
+    flushed in bulk through ``read_marker``.
+    """
+
+    def __init__(self, username: str, services: GoogleSession, read_marker: LabelUpdateBatcher,
+                 stage_concurrency: Optional[Dict[str, int]] = None, busy_index: Optional[BusyIndex] = None):
+        self.username = username
+        self.services = services
+        self.read_marker = read_marker
+        self.busy_index = busy_index or BusyIndex()
+        # event id -> the insert creating it; repeats wait for it rather than inserting again
+        self.event_inserts: Dict[str, asyncio.Task] = {}
+        # emails left unread; incremental sync lists them again next run
+        self.failed = set()
+        self.limits = {**STAGE_CONCURRENCY, **(stage_concurrency or {})}
+        self.semaphores = {stage: asyncio.Semaphore(limit) for stage, limit in self.limits.items()}
+        self.executor = ThreadPoolExecutor(max_workers=self.limits["fetch_body"] + self.limits["act"] + self.limits["mark_read"],
+                                           thread_name_prefix="google-api")
+
+    async def in_thread(self, stage: str, fn, *args):
+        async with self.semaphores[stage]:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def load_body(self, email_dict: Dict[str, str]):
+        # downloaded on a worker thread, with its own transport, rather than lazily on the event loop;
+        # the thread's earlier messages come along since their text is read with it
+        if not is_loaded(email_dict):
+            await self.in_thread("fetch_body", lambda: load_body(email_dict, self.services.gmail()))
+
+    async def process_email(self, email_dict: Dict[str, str]):
+        entry = resume(email_dict['Id'])
+        if entry is not None and entry.acted:
+            logger.info(f"email {email_dict['Id']} was already handled by an earlier run. marking it as read")
+            count("emails_total", outcome="resumed")
+            await self.in_thread("mark_read", mark_handled, self.read_marker, email_dict)
+            return
+        if entry is None:
+            record(email_dict['Id'], FETCHED, thread_id=email_dict.get('ThreadId'))
+        if likely_needs_body(email_dict):
+            await self.load_body(email_dict)
+        used_llm = False
+        relevant_email = entry.verdict if entry is not None else None
+        if relevant_email is None:
+            relevant_email = prefilter_email(email_dict)
+        if relevant_email is None or relevant_email.is_meeting_request:
+            await self.load_body(email_dict)
+            with span("normalize"):
+                plaintext_email = format_plaintext_email(email_dict)
+        if relevant_email is None and parse_invite(email_dict) is not None:
+            relevant_email = IsMeetingRequest(is_meeting_request=True)
+        if relevant_email is None:
+            used_llm = True
+            async with self.semaphores["classify"]:
+                with span("classify"):
+                    relevant_email = await is_meeting_request_async(plaintext_email)
+            record_verdict(email_dict, relevant_email)
+        record(email_dict['Id'], CLASSIFIED, verdict=relevant_email)
+        if relevant_email.is_meeting_request:
+            date_str = format_email_date(email_dict)
+            meeting_details = entry.details if entry is not None else None
+            if meeting_details is None:
+                meeting_details = extract_locally(email_dict)
+            if meeting_details is None:
+                used_llm = True
+                record_extraction(LLM)
+                async with self.semaphores["extract"]:
+                    with span("extract"):
+                        meeting_details = await extract_meeting_details_async(plaintext_email, self.username, date_str)
+            if entry is None or entry.details is None:
+                record(email_dict['Id'], EXTRACTED, details=meeting_details)
+            if meeting_details.start_time is not None and meeting_details.date is not None:
+                add_email_participants(meeting_details, email_dict)
+                event_id = event_id_for(email_dict, meeting_details)
+                insert = self.event_inserts.get(event_id)
+                if insert is not None:
+                    # settled with the email that inserts the event, so it is left unread if that insert fails
+                    created = await insert
+                    if created:
+                        logger.info(f"calendar event for email {email_dict['Id']} was already created. skipping")
+                    outcome = "duplicate" if created else "calendar_error"
+                else:
+                    # claimed before the insert so a concurrent email about the same meeting does not insert it too
+                    insert = asyncio.ensure_future(self.in_thread("act", timed("calendar", lambda: create_calendar_event(self.services.calendar(), meeting_details, event_id))))
+                    self.event_inserts[event_id] = insert
+                    created = await insert
+                    if created:
+                        logger.info(f"created calendar event for email {email_dict['Id']}")
+                        record_event(self.busy_index, meeting_details)
+                    else:
+                        # a later email about the same meeting may still create it
+                        del self.event_inserts[event_id]
+                    outcome = "scheduled" if created else "calendar_error"
+            else:
+                reply_message = entry.reply if entry is not None else None
+                if reply_message is None:
+                    # the index serializes its freebusy queries, so concurrent emails share one
+                    slots = await self.in_thread("act", timed("availability", lambda: propose_slots(self.busy_index, self.services.calendar(), meeting_details)))
+                    used_llm = True
+                    async with self.semaphores["compose"]:
+                        with span("compose"):
+                            reply_message = await compose_availability_email_async(plaintext_email, self.username, slots)
+                    record(email_dict['Id'], EXTRACTED, reply=reply_message)
+                if entry is not None and entry.stage == SENDING and await self.in_thread(
+                        "act", lambda: reply_was_sent(self.services.gmail(), email_dict)):
+                    logger.info(f"availability reply for email {email_dict['Id']} was sent before the previous run stopped")
+                    sent = True
+                else:
+                    record(email_dict['Id'], SENDING)
+                    sent = await self.in_thread("act", timed("reply", lambda: send_reply_email(self.services.gmail(), email_dict, reply_message)))
+                    logger.info(f"sent availability reply for email {email_dict['Id']}")
+                outcome = "replied" if sent else "reply_error"
+        else:
+            logger.info(f"email {email_dict['Id']} does not contain meeting request. skipping...")
+            outcome = "skipped"
+        record_email(used_llm)
+        count("emails_total", outcome=outcome)
+        if outcome in ERROR_OUTCOMES:
+            # kept below acted and left unread, so the next run tries again
+            logger.error(f"Error handling email {email_dict['Id']} ({outcome}). leaving it unread")
+            record(email_dict['Id'], EXTRACTED, outcome=outcome)
+            self.failed.add(email_dict['Id'])
+            self.failed.update(email_dict.get('Superseded', []))
+            return
+        record(email_dict['Id'], ACTED, outcome=outcome)
+        await self.in_thread("mark_read", mark_handled, self.read_marker, email_dict)
+
+    async def run(self, email_dicts_factory, max_pending: int = MAX_PENDING) -> int:
+        """Feed emails from ``email_dicts_factory(before_checkpoint)`` through the stages.
+
+        The factory is called on a dedicated fetch thread and must return an
+        iterator of email dicts. At most ``max_pending`` emails are in flight.
+        """
+        loop = asyncio.get_running_loop()
+        fetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gmail-fetch")
+        pending = asyncio.Semaphore(max_pending)
+        tasks = set()
+        processed = 0
+
+        def on_done(email_dict: Dict[str, str], task: asyncio.Task):
+            tasks.discard(task)
+            pending.release()
+            if not task.cancelled() and task.exception() is not None:
+                logger.error(f"Error processing email {email_dict['Id']}: {task.exception()!r}")
+                count("emails_total", outcome="failed")
+                self.failed.add(email_dict['Id'])
+                self.failed.update(email_dict.get('Superseded', []))
+
+        async def drain():
+            await asyncio.gather(*list(tasks), return_exceptions=True)
+
+        def before_checkpoint():
+            # runs on the fetch thread: hold the sync checkpoint until in-flight emails finish
+            asyncio.run_coroutine_threadsafe(drain(), loop).result()
+
+        try:
+            email_dicts = await loop.run_in_executor(fetch_executor, email_dicts_factory, before_checkpoint)
+            while True:
+                await pending.acquire()
+                email_dict = await loop.run_in_executor(fetch_executor, next, email_dicts, None)
+                if email_dict is None:
+                    pending.release()
+                    break
+                processed += 1
+                task = asyncio.create_task(self.process_email(email_dict))
+                tasks.add(task)
+                task.add_done_callback(functools.partial(on_done, email_dict))
+            await drain()
+        finally:
+            fetch_executor.shutdown(wait=True)
+            self.executor.shutdown(wait=True)
+        return processed
+
+
+async def run_workflow_async(username: str, page_size: int = PAGE_SIZE, max_in_flight: int = BATCH_SIZE,
+                             incremental: bool = False, sync_state: str = SYNC_STATE_FILE,
+                             stage_concurrency: Optional[Dict[str, int]] = None, max_pending: int = MAX_PENDING,
+                             processed_label: Optional[str] = None, flush_size: int = MAX_BATCH_MODIFY_IDS,
+                             flush_seconds: float = FLUSH_SECONDS, collapse_threads: Optional[bool] = None) -> int:
+    loop = asyncio.get_running_loop()
+    if collapse_threads is None:
+        # grouping threads lists every page of unread mail first; history sync lists it all anyway
+        collapse_threads = incremental
+    services = get_session()
+    # the batcher serializes its own calls, so one service is enough for every worker thread
+    read_marker = await loop.run_in_executor(None, make_label_batcher, services.gmail(), processed_label, flush_size,
+                                             flush_seconds, acknowledge)
+    pipeline = Pipeline(username, services, read_marker, stage_concurrency)
+
+    def email_dicts_factory(before_checkpoint):
+        if incremental:
+            return timed_iter("fetch", iter_new_emails(services.gmail(), sync_state, page_size=page_size,
+                                                       max_in_flight=max_in_flight, before_checkpoint=before_checkpoint,
+                                                       collapse_threads=collapse_threads, failed=pipeline.failed,
+                                                       needs_body=likely_needs_body))
+        return timed_iter("fetch", iter_unread_emails(services.gmail(), page_size=page_size, max_in_flight=max_in_flight,
+                                                      collapse_threads=collapse_threads, needs_body=likely_needs_body))
+
+    try:
+        processed = await pipeline.run(email_dicts_factory, max_pending=max_pending)
+    finally:
+        await loop.run_in_executor(None, read_marker.close)
+    logger.info(f'done. processed {processed} emails')
+    log_cache_summary()
+    log_prefilter_summary()
+    log_normalize_summary()
+    log_journal_summary()
+    log_extraction_summary()
+    log_metrics_summary()
+    export_metrics()
+    return processed
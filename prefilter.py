@@ -0,0 +1,272 @@
+"""Local first-stage classifier that keeps obvious non-meeting mail away from the LLM.
+
+Header rules reject bulk and automated mail outright. The remaining emails are
+scored by a logistic regression over hashed subject/body/header features, trained
+on the verdicts ``is_meeting_request`` returned for past emails. Only emails whose
+score falls between the thresholds are sent to the LLM.
+
+Train a model and measure it against the recorded LLM labels with:
+
+    python prefilter.py train
+    python prefilter.py report
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import zlib
+from collections import namedtuple
+from typing import Any, Dict, List, Optional, Sequence
+import numpy as np
+from schemas import IsMeetingRequest
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MODEL_FILE = "prefilter_model.npz"
+LABELS_FILE = "prefilter_labels.jsonl"
+N_FEATURES = 2 ** 18
+# skip the LLM when the model's meeting probability is below this
+SKIP_BELOW = 0.05
+# only the first part of a body is featurized; meeting asks are rarely buried deep
+MAX_BODY_CHARS = 4000
+
+NO_REPLY_SENDER = re.compile(r"\b(no[-_.]?reply|do[-_.]?not[-_.]?reply|mailer-daemon|postmaster|bounce[s]?|notifications?)[^@\s]*@", re.IGNORECASE)
+TOKEN = re.compile(r"[a-z0-9']+")
+
+SKIP = "skip"
+ASK_LLM = "llm"
+MEETING = "meeting"
+Decision = namedtuple("Decision", ["verdict", "probability", "reason"])
+
+
+def header_rule(email_dict: Dict[str, str]) -> Optional[str]:
+    """Return the name of the rule marking ``email_dict`` as bulk or automated mail, if any."""
+    headers = {name.lower(): value for name, value in email_dict.items()}
+    if "list-unsubscribe" in headers or "list-id" in headers:
+        return "mailing-list"
+    if headers.get("precedence", "").strip().lower() in ("bulk", "list", "junk"):
+        return "precedence"
+    if headers.get("auto-submitted", "no").strip().lower() != "no":
+        return "auto-submitted"
+    if NO_REPLY_SENDER.search(headers.get("from", "")):
+        return "no-reply-sender"
+    return None
+
+
+def extract_features(email_dict: Dict[str, str]) -> List[str]:
+    features = ["__bias__"]
+    sender = email_dict.get("From", "")
+    if "@" in sender:
+        features.append("from_domain=" + sender.rsplit("@", 1)[1].strip(" >").lower())
+    for header in ("List-Unsubscribe", "Precedence", "Auto-Submitted", "In-Reply-To"):
+        if header in email_dict:
+            features.append("has_header=" + header.lower())
+    for field, text in (("subject", email_dict.get("Subject", "")), ("body", email_dict.get("Body", "")[:MAX_BODY_CHARS])):
+        tokens = TOKEN.findall(text.lower())
+        features.extend(f"{field}:{token}" for token in tokens)
+        features.extend(f"{field}:{a}_{b}" for a, b in zip(tokens, tokens[1:]))
+    return features
+
+
+def hash_features(features: Sequence[str], n_features: int = N_FEATURES) -> np.ndarray:
+    # crc32 rather than hash() so indices are stable across processes and runs
+    return np.unique(np.fromiter((zlib.crc32(f.encode("utf-8")) % n_features for f in features), dtype=np.int64, count=len(features)))
+
+
+def _flatten(indices: Sequence[np.ndarray]):
+    lengths = np.fromiter((len(i) for i in indices), dtype=np.int64, count=len(indices))
+    rows = np.repeat(np.arange(len(indices)), lengths)
+    values = np.repeat(1.0 / np.sqrt(np.maximum(lengths, 1)), lengths)
+    return np.concatenate(indices) if len(indices) else np.zeros(0, dtype=np.int64), rows, values
+
+
+class Prefilter:
+    """Header rules plus a hashed-feature logistic regression.
+
+    ``decide`` skips the LLM when a rule matches or the meeting probability is
+    below ``skip_below``. With ``accept_above`` set, confident positives skip the
+    LLM classifier too. ``audit_rate`` sends a random share of skipped emails to
+    the LLM anyway so that recorded labels keep covering what the model rejects.
+    """
+
+    def __init__(self, weights: Optional[np.ndarray] = None, bias: float = 0.0, skip_below: float = SKIP_BELOW,
+                 accept_above: Optional[float] = None, audit_rate: float = 0.0):
+        self.weights = weights
+        self.bias = bias
+        self.skip_below = skip_below
+        self.accept_above = accept_above
+        self.audit_rate = audit_rate
+
+    @property
+    def n_features(self) -> int:
+        return len(self.weights) if self.weights is not None else N_FEATURES
+
+    @classmethod
+    def load(cls, path: str = MODEL_FILE, **thresholds) -> "Prefilter":
+        if not os.path.exists(path):
+            logger.info(f"No prefilter model at {path}. Only header rules will be applied")
+            return cls(**thresholds)
+        with np.load(path) as data:
+            return cls(weights=data["weights"], bias=float(data["bias"]), **thresholds)
+
+    def save(self, path: str = MODEL_FILE):
+        np.savez_compressed(path, weights=self.weights, bias=np.float64(self.bias))
+
+    def predict_proba(self, indices: Sequence[np.ndarray]) -> np.ndarray:
+        if self.weights is None:
+            return np.full(len(indices), 0.5)
+        flat, rows, values = _flatten(indices)
+        scores = np.bincount(rows, weights=self.weights[flat] * values, minlength=len(indices)) + self.bias
+        return 1.0 / (1.0 + np.exp(-scores))
+
+    def fit(self, indices: Sequence[np.ndarray], labels: Sequence[bool], epochs: int = 300,
+            learning_rate: float = 2.0, l2: float = 1e-6, n_features: int = N_FEATURES) -> "Prefilter":
+        """Full-batch gradient descent on class-balanced log loss."""
+        y = np.asarray(labels, dtype=np.float64)
+        positives = max(y.sum(), 1.0)
+        negatives = max(len(y) - y.sum(), 1.0)
+        # weight classes equally so rare meeting requests are not traded away for accuracy
+        sample_weight = np.where(y == 1, len(y) / (2 * positives), len(y) / (2 * negatives))
+        flat, rows, values = _flatten(indices)
+        self.weights = np.zeros(n_features)
+        self.bias = 0.0
+        for _ in range(epochs):
+            scores = np.bincount(rows, weights=self.weights[flat] * values, minlength=len(y)) + self.bias
+            error = (1.0 / (1.0 + np.exp(-scores)) - y) * sample_weight
+            gradient = np.bincount(flat, weights=error[rows] * values, minlength=n_features) / len(y)
+            self.weights -= learning_rate * (gradient + l2 * self.weights)
+            self.bias -= learning_rate * error.mean()
+        return self
+
+    def decide(self, email_dict: Dict[str, str]) -> Decision:
+        rule = header_rule(email_dict)
+        # calendar services send invites from no-reply addresses; parse_invite reads those without the LLM
+        if rule in (None, "no-reply-sender") and email_dict.get("Calendar"):
+            return Decision(ASK_LLM, 1.0, "calendar-invite")
+        if rule is not None:
+            return self._audited(Decision(SKIP, 0.0, rule))
+        if self.weights is None:
+            return Decision(ASK_LLM, 0.5, "no-model")
+        probability = float(self.predict_proba([hash_features(extract_features(email_dict), self.n_features)])[0])
+        if probability < self.skip_below:
+            return self._audited(Decision(SKIP, probability, "model"))
+        if self.accept_above is not None and probability > self.accept_above:
+            return Decision(MEETING, probability, "model")
+        return Decision(ASK_LLM, probability, "uncertain")
+
+    def _audited(self, decision: Decision) -> Decision:
+        if self.audit_rate and random.random() < self.audit_rate:
+            return Decision(ASK_LLM, decision.probability, "audit")
+        return decision
+
+
+# set by enable_prefilter(); when None every email goes to the LLM
+active: Optional[Prefilter] = None
+labels_path: Optional[str] = LABELS_FILE
+stats = {SKIP: 0, ASK_LLM: 0, MEETING: 0}
+
+
+def enable_prefilter(model_path: str = MODEL_FILE, labels: Optional[str] = LABELS_FILE, **thresholds) -> Prefilter:
+    global active, labels_path
+    active = Prefilter.load(model_path, **thresholds)
+    labels_path = labels
+    return active
+
+
+def prefilter_email(email_dict: Dict[str, str]) -> Optional[IsMeetingRequest]:
+    """Return a local verdict for ``email_dict``, or None when the LLM should decide."""
+    if active is None:
+        return None
+    decision = active.decide(email_dict)
+    stats[decision.verdict] += 1
+    if decision.verdict == ASK_LLM:
+        return None
+    logger.info(f"prefilter decided {decision.verdict} ({decision.reason}, p={decision.probability:.3f})")
+    return IsMeetingRequest(is_meeting_request=decision.verdict == MEETING)
+
+
+def record_verdict(email_dict: Dict[str, str], verdict: IsMeetingRequest):
+    """Append the LLM's verdict as a training label.
+
+    Only hashed feature indices are stored, never the email text itself.
+    """
+    if active is None or labels_path is None:
+        return
+    indices = hash_features(extract_features(email_dict), active.n_features)
+    record = {"n_features": active.n_features, "indices": indices.tolist(),
+              "rule": header_rule(email_dict), "label": verdict.is_meeting_request}
+    with open(labels_path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def log_prefilter_summary():
+    if active is not None:
+        total = sum(stats.values())
+        skipped = stats[SKIP] + stats[MEETING]
+        logger.info(f"Prefilter: resolved {skipped}/{total} emails locally, sent {stats[ASK_LLM]} to the LLM")
+
+
+def load_labels(path: str = LABELS_FILE, n_features: int = N_FEATURES) -> List[Dict[str, Any]]:
+    records = []
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record["n_features"] == n_features:
+                record["indices"] = np.asarray(record["indices"], dtype=np.int64)
+                records.append(record)
+    return records
+
+
+def evaluate(prefilter: Prefilter, records: List[Dict[str, Any]]) -> Dict[str, float]:
+    """Compare prefilter decisions with the LLM labels in ``records``.
+
+    ``meeting_recall`` is the share of LLM-confirmed meeting requests the prefilter
+    lets through (skipping one is the costly mistake); ``skip_precision`` is the
+    share of skipped emails the LLM also rejected.
+    """
+    labels = np.array([r["label"] for r in records], dtype=bool)
+    probabilities = prefilter.predict_proba([r["indices"] for r in records])
+    ruled_out = np.array([r["rule"] is not None for r in records], dtype=bool)
+    skipped = ruled_out | (probabilities < prefilter.skip_below)
+    if prefilter.weights is None:
+        skipped = ruled_out
+    passed = ~skipped
+    return {
+        "emails": len(records),
+        "meeting_requests": int(labels.sum()),
+        "llm_calls_avoided": float(skipped.mean()) if len(records) else 0.0,
+        "meeting_recall": float((passed & labels).sum() / max(labels.sum(), 1)),
+        "meeting_precision": float((passed & labels).sum() / max(passed.sum(), 1)),
+        "skip_precision": float((skipped & ~labels).sum() / max(skipped.sum(), 1)),
+        "missed_meeting_requests": int((skipped & labels).sum()),
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Train and evaluate the local pre-classifier.")
+    arg_parser.add_argument("command", choices=["train", "report"])
+    arg_parser.add_argument("--labels", default=LABELS_FILE)
+    arg_parser.add_argument("--model", default=MODEL_FILE)
+    arg_parser.add_argument("--skip-below", type=float, default=SKIP_BELOW)
+    arg_parser.add_argument("--holdout", type=float, default=0.2, help="Share of labels held out for the report.")
+    args = arg_parser.parse_args()
+
+    records = load_labels(args.labels)
+    if args.command == "train":
+        Prefilter().fit([r["indices"] for r in records], [r["label"] for r in records]).save(args.model)
+        logger.info(f"Trained prefilter on {len(records)} labels and saved it to {args.model}")
+        return
+
+    random.Random(0).shuffle(records)
+    split = int(len(records) * (1 - args.holdout))
+    train, test = records[:split], records[split:]
+    prefilter = Prefilter(skip_below=args.skip_below).fit([r["indices"] for r in train], [r["label"] for r in train])
+    print(json.dumps(evaluate(prefilter, test), indent=2))
+
+
+if __name__ == "__main__":
+    main()
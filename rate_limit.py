@@ -0,0 +1,327 @@
+"""Client-side quotas and retries shared by every Gmail, Calendar and OpenAI call.
+
+Each API has a token bucket sized to its published per-user limits, so bursts
+are smoothed out before the server has to reject them. Calls that fail with a
+throttling or transient error are retried with jittered exponential backoff,
+waiting at least as long as the server's ``Retry-After``, and a 429 pauses the
+whole bucket so concurrent callers back off together.
+"""
+import asyncio
+import email.utils
+import logging
+import random
+import sys
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+from googleapiclient.errors import HttpError
+import metrics
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Gmail allows 250 quota units per user per second; methods cost different amounts
+GMAIL_UNITS_PER_SECOND = 250
+QUOTA_UNITS = {
+    "gmail": {
+        "getProfile": 1,
+        "history.list": 2,
+        "labels.list": 1,
+        "labels.create": 5,
+        "messages.list": 5,
+        "messages.get": 5,
+        "messages.modify": 5,
+        "messages.batchModify": 50,
+        "messages.send": 100,
+        "threads.get": 10,
+    },
+}
+# Calendar's default per-user quota is 600 queries per minute
+CALENDAR_REQUESTS_PER_SECOND = 10
+# gpt-4o-mini limits at usage tier 1; raise them with --openai-rpm/--openai-tpm on higher tiers
+OPENAI_REQUESTS_PER_MINUTE = 500
+OPENAI_TOKENS_PER_MINUTE = 200000
+# how many seconds of OpenAI budget may be spent in one burst
+OPENAI_BURST_SECONDS = 10
+# completion tokens reserved per request until the response reports its usage
+COMPLETION_TOKENS_ESTIMATE = 256
+
+MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+# Google reports per-user throttling as 403 with one of these reasons
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+# a 5xx or dropped connection may come after these took effect, so they are only retried when throttled
+NON_IDEMPOTENT_METHODS = {("gmail", "messages.send")}
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at ``rate`` tokens per second up to ``capacity``.
+
+    Callers reserve tokens up front and wait out any deficit, so a reservation
+    larger than the capacity is allowed and simply waits longer.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Take ``amount`` tokens and return how many seconds to wait before using them."""
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self, amount: float = 1) -> float:
+        wait = self.reserve(amount)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, amount: float = 1) -> float:
+        wait = self.reserve(amount)
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+    def adjust(self, amount: float):
+        """Give back (or, when negative, charge) tokens once the real cost of a call is known."""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def pause(self, seconds: float):
+        """Make every caller wait at least ``seconds`` before the next call."""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+buckets: Dict[str, TokenBucket] = {}
+
+def configure(gmail_units_per_second: float = GMAIL_UNITS_PER_SECOND,
+              calendar_requests_per_second: float = CALENDAR_REQUESTS_PER_SECOND,
+              openai_requests_per_minute: float = OPENAI_REQUESTS_PER_MINUTE,
+              openai_tokens_per_minute: float = OPENAI_TOKENS_PER_MINUTE):
+    buckets.update({
+        "gmail": TokenBucket(gmail_units_per_second, gmail_units_per_second),
+        "calendar": TokenBucket(calendar_requests_per_second, calendar_requests_per_second),
+        "openai_requests": TokenBucket(openai_requests_per_minute / 60,
+                                       max(1, openai_requests_per_minute / 60 * OPENAI_BURST_SECONDS)),
+        "openai_tokens": TokenBucket(openai_tokens_per_minute / 60, openai_tokens_per_minute / 60 * OPENAI_BURST_SECONDS),
+    })
+
+def disable_limits():
+    """Stop throttling; calls are still retried. Used by the benchmarks, whose fakes have no quota."""
+    buckets.clear()
+
+configure()
+
+
+def quota_cost(api: str, method: str) -> float:
+    return QUOTA_UNITS.get(api, {}).get(method, 1)
+
+def error_status(e: Exception) -> Optional[int]:
+    if isinstance(e, HttpError):
+        return e.resp.status
+    return getattr(e, "status_code", None)
+
+def is_retryable(e: Exception, idempotent: bool = True) -> bool:
+    """Whether ``e`` clears by waiting. Requests that are not ``idempotent`` are only retried when throttled."""
+    if isinstance(e, HttpError):
+        if e.resp.status == 403:
+            content = e.content.decode("utf-8", "replace") if isinstance(e.content, bytes) else str(e.content)
+            return any(reason in content for reason in RATE_LIMIT_REASONS)
+        return e.resp.status == 429 or (idempotent and e.resp.status in RETRYABLE_STATUSES)
+    if not idempotent:
+        return False
+    if isinstance(e, (ConnectionError, TimeoutError)):
+        return True
+    # openai is imported lazily; if it has not been loaded, e cannot be one of its errors
+    openai = sys.modules.get("openai")
+    if openai is not None:
+        if isinstance(e, openai.APIConnectionError):
+            return True
+        if isinstance(e, openai.APIStatusError):
+            # a 429 for an exhausted billing quota will not clear by waiting
+            return e.status_code in RETRYABLE_STATUSES and getattr(e, "code", None) != "insufficient_quota"
+    return False
+
+def retry_after(e: Exception) -> Optional[float]:
+    """Seconds the server asked us to wait, from ``Retry-After`` (seconds or HTTP date) or ``retry-after-ms``."""
+    if isinstance(e, HttpError):
+        headers = e.resp
+    else:
+        headers = getattr(getattr(e, "response", None), "headers", None)
+    if headers is None:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers.get("retry-after-ms")) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+def backoff_delay(e: Exception, attempt: int) -> float:
+    # full jitter keeps concurrent callers from retrying in lockstep
+    delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+    hinted = retry_after(e)
+    if hinted is not None:
+        delay = hinted + random.uniform(0, BACKOFF_BASE_SECONDS)
+    return delay
+
+def retry_delay(e: Exception, attempt: int, costs: Sequence[Tuple[str, float]], description: str,
+                idempotent: bool = True) -> Optional[float]:
+    """How long to wait before retrying after ``e``, or None when it should be raised."""
+    if attempt >= MAX_RETRIES or not is_retryable(e, idempotent):
+        return None
+    delay = backoff_delay(e, attempt)
+    if error_status(e) == 429:
+        for name, _ in costs:
+            if name in buckets:
+                buckets[name].pause(delay)
+    logger.warning(f"{description} failed ({e!r}). retry {attempt + 1}/{MAX_RETRIES} in {delay:.1f}s")
+    return delay
+
+def error_label(e: Exception) -> str:
+    return str(error_status(e) or type(e).__name__)
+
+def wait_for_budget(costs: Sequence[Tuple[str, float]]):
+    for name, amount in costs:
+        if name in buckets:
+            waited = buckets[name].acquire(amount)
+            if waited:
+                metrics.count("rate_limit_wait_seconds_total", waited, bucket=name)
+
+async def wait_for_budget_async(costs: Sequence[Tuple[str, float]]):
+    for name, amount in costs:
+        if name in buckets:
+            waited = await buckets[name].acquire_async(amount)
+            if waited:
+                metrics.count("rate_limit_wait_seconds_total", waited, bucket=name)
+
+def call(fn: Callable[[], Any], costs: Sequence[Tuple[str, float]], description: str,
+         api: str = "other", method: str = "") -> Any:
+    """Call ``fn`` once the ``(bucket, amount)`` costs are available, retrying throttling and transient errors.
+
+    Requests, errors and retries are counted under ``api`` and ``method``.
+    """
+    attempt = 0
+    while True:
+        wait_for_budget(costs)
+        metrics.count("api_requests_total", api=api, method=method)
+        try:
+            return fn()
+        except Exception as e:
+            metrics.count("api_errors_total", api=api, method=method, error=error_label(e))
+            delay = retry_delay(e, attempt, costs, description, (api, method) not in NON_IDEMPOTENT_METHODS)
+            if delay is None:
+                raise
+        metrics.count("api_retries_total", api=api, method=method)
+        time.sleep(delay)
+        attempt += 1
+
+async def call_async(fn: Callable[[], Awaitable[Any]], costs: Sequence[Tuple[str, float]], description: str,
+                     api: str = "other", method: str = "") -> Any:
+    attempt = 0
+    while True:
+        await wait_for_budget_async(costs)
+        metrics.count("api_requests_total", api=api, method=method)
+        try:
+            return await fn()
+        except Exception as e:
+            metrics.count("api_errors_total", api=api, method=method, error=error_label(e))
+            delay = retry_delay(e, attempt, costs, description, (api, method) not in NON_IDEMPOTENT_METHODS)
+            if delay is None:
+                raise
+        metrics.count("api_retries_total", api=api, method=method)
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+def execute(request: Any, api: str, method: str) -> Any:
+    """Execute a googleapiclient request, charged at ``method``'s quota cost."""
+    return call(request.execute, [(api, quota_cost(api, method))], f"{api} {method}", api, method)
+
+def execute_batch(service: Any, requests: List[Tuple[str, Any]], callback: Callable[[str, Any, Any], None],
+                  api: str, method: str):
+    """Run ``(request_id, request)`` pairs as one batch request, calling ``callback`` once per request.
+
+    Every sub-request is charged against the quota. Sub-requests that fail with
+    a throttling or transient error are retried in a smaller batch after a
+    backoff; the others are reported to ``callback`` as they are. Raises
+    ``HttpError`` when the batch request itself keeps failing.
+    """
+    pending = list(requests)
+    idempotent = (api, method) not in NON_IDEMPOTENT_METHODS
+    attempt = 0
+    while pending:
+        failed = {}
+
+        def collect(request_id, response, exception):
+            if exception is not None:
+                metrics.count("api_errors_total", api=api, method=method, error=error_label(exception))
+            if exception is not None and attempt < MAX_RETRIES and is_retryable(exception, idempotent):
+                failed[request_id] = exception
+            else:
+                callback(request_id, response, exception)
+
+        batch = service.new_batch_http_request(callback=collect)
+        for request_id, request in pending:
+            batch.add(request, request_id=request_id)
+        metrics.count("api_requests_total", len(pending), api=api, method=method)
+        call(batch.execute, [(api, quota_cost(api, method) * len(pending))], f"{api} batch of {len(pending)} {method}", api, "batch")
+        if not failed:
+            return
+        metrics.count("api_retries_total", len(failed), api=api, method=method)
+        pending = [(request_id, request) for request_id, request in pending if request_id in failed]
+        delay = max(backoff_delay(e, attempt) for e in failed.values())
+        if api in buckets and any(error_status(e) == 429 for e in failed.values()):
+            buckets[api].pause(delay)
+        logger.warning(f"{len(failed)} {api} {method} requests in the batch failed "
+                       f"({next(iter(failed.values()))!r}). retry {attempt + 1}/{MAX_RETRIES} in {delay:.1f}s")
+        time.sleep(delay)
+        attempt += 1
+
+
+def estimate_tokens(messages: List[Dict[str, str]]) -> int:
+    # roughly four characters per token for English text
+    return sum(len(message["content"]) for message in messages) // 4 + COMPLETION_TOKENS_ESTIMATE
+
+def settle_tokens(response: Any, estimate: int):
+    total = getattr(getattr(response, "usage", None), "total_tokens", None)
+    if isinstance(total, int) and "openai_tokens" in buckets:
+        buckets["openai_tokens"].adjust(estimate - total)
+
+def call_openai(fn: Callable[[], Any], messages: List[Dict[str, str]]) -> Any:
+    """Make a chat completion call within the RPM/TPM budgets, settling the token estimate against its usage."""
+    estimate = estimate_tokens(messages)
+    response = call(fn, [("openai_requests", 1), ("openai_tokens", estimate)], "OpenAI request", "openai", "chat.completions")
+    settle_tokens(response, estimate)
+    metrics.record_usage(getattr(response, "usage", None))
+    return response
+
+async def call_openai_async(fn: Callable[[], Awaitable[Any]], messages: List[Dict[str, str]]) -> Any:
+    estimate = estimate_tokens(messages)
+    response = await call_async(fn, [("openai_requests", 1), ("openai_tokens", estimate)], "OpenAI request",
+                                "openai", "chat.completions")
+    settle_tokens(response, estimate)
+    metrics.record_usage(getattr(response, "usage", None))
+    return response
@@ -0,0 +1,276 @@
+"""Run the workflow for many mailboxes from one deployment.
+
+Accounts are read from a JSON roster, a list of entries such as::
+
+    [{"name": "Alice Example", "token": "tokens/alice.json"},
+     {"name": "Bob Example", "token": "tokens/bob.json", "processed_label": "scheduler-processed"}]
+
+``name`` is the display name used in prompts and replies, ``token`` the account's
+own OAuth token store. ``sync_state`` defaults to a file next to the token.
+Accounts are sharded across a pool of worker processes. Each worker sets up
+once, then handles its accounts one after another, so a mailbox is only ever
+processed by one worker and its emails keep their order. Workers share the
+SQLite LLM cache and processing journal, which keys emails by account, and
+split the OpenAI rate budget between them.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional
+from dateutil import parser
+import rate_limit
+import availability
+from availability import BusyIndex
+from daemon import AdaptivePoller, install_stop_handlers, MIN_POLL_SECONDS, MAX_POLL_SECONDS
+from gmail_utils import make_label_batcher, MAX_BATCH_MODIFY_IDS, FLUSH_SECONDS
+from llm_calls import enable_cache, log_cache_summary
+import metrics
+from normalize import set_token_budget, log_normalize_summary, MAX_BODY_TOKENS
+from journal import enable_journal, set_mailbox, acknowledge, log_journal_summary
+from invites import log_extraction_summary
+from oauth_utils import GoogleSession, load_credentials
+from prefilter import enable_prefilter, log_prefilter_summary
+from workflow import process_emails
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ROSTER_FILE = "roster.json"
+WORKERS = min(4, os.cpu_count() or 1)
+
+
+class Account(NamedTuple):
+    name: str
+    token_file: str
+    sync_state: str
+    processed_label: Optional[str] = None
+
+
+def load_roster(path: str = ROSTER_FILE) -> List[Account]:
+    with open(path) as f:
+        entries = json.load(f)
+    accounts = []
+    for entry in entries:
+        token_file = entry["token"]
+        sync_state = entry.get("sync_state", os.path.splitext(token_file)[0] + ".sync_state.json")
+        accounts.append(Account(entry["name"], token_file, sync_state, entry.get("processed_label")))
+    token_files = [account.token_file for account in accounts]
+    if len(set(token_files)) != len(token_files):
+        # two workers on the same mailbox would race on its read state and sync checkpoint
+        raise ValueError(f"{path} lists the same token file more than once")
+    return accounts
+
+
+def shard_accounts(accounts: List[Account], workers: int) -> List[List[Account]]:
+    shards = [accounts[i::workers] for i in range(workers)]
+    return [shard for shard in shards if shard]
+
+
+# per worker process, set by init_worker
+stop_event: Any = None
+sessions: Dict[str, GoogleSession] = {}
+busy_indexes: Dict[str, BusyIndex] = {}
+
+
+def init_worker(stop: Any, llm_cache: Optional[Dict[str, Any]], prefilter: Optional[Dict[str, Any]],
+                rate_limits: Dict[str, float], max_body_tokens: int = MAX_BODY_TOKENS, log_bodies: bool = False,
+                availability_options: Optional[Dict[str, Any]] = None, journal: Optional[Dict[str, Any]] = None):
+    """Set up a worker process once; its warm clients, cache and budgets serve every account in its shard."""
+    global stop_event
+    stop_event = stop
+    # the parent turns SIGINT/SIGTERM into ``stop``, so workers finish the email they are on
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if llm_cache is not None:
+        enable_cache(**llm_cache)
+    if journal is not None:
+        enable_journal(**journal)
+    if prefilter is not None:
+        enable_prefilter(**prefilter)
+    rate_limit.configure(**rate_limits)
+    set_token_budget(max_body_tokens)
+    availability.configure(**(availability_options or {}))
+    if log_bodies:
+        logging.getLogger("workflow").setLevel(logging.DEBUG)
+
+
+def email_lag(email_dict: Dict[str, str]) -> Optional[float]:
+    """Seconds between an email's Date header and now."""
+    try:
+        return time.time() - parser.parse(email_dict['Date']).timestamp()
+    except (KeyError, ValueError, OverflowError):
+        return None
+
+
+def run_account(account: Account, processed_label: Optional[str] = None, flush_size: int = MAX_BATCH_MODIFY_IDS,
+                flush_seconds: float = FLUSH_SECONDS, **fetch_options: Any) -> Dict[str, Any]:
+    """Process one pass of ``account``'s mail and report its throughput and lag."""
+    report = {"account": account.name, "processed": 0, "seconds": 0.0, "lag_p50_seconds": None,
+              "lag_max_seconds": None, "error": None}
+    if not os.path.exists(account.token_file):
+        # a worker cannot open a browser for the OAuth consent screen
+        report["error"] = f"no token at {account.token_file}; run `python roster.py authorize`"
+        logger.error(f"{account.name}: {report['error']}")
+        return report
+    lags = []
+
+    def on_email(email_dict):
+        lag = email_lag(email_dict)
+        if lag is not None:
+            lags.append(lag)
+
+    started = time.perf_counter()
+    try:
+        if account.token_file not in sessions:
+            sessions[account.token_file] = GoogleSession(token_file=account.token_file)
+            busy_indexes[account.token_file] = BusyIndex()
+        session = sessions[account.token_file]
+        session.refresh_if_expiring()
+        # message ids are only unique within a mailbox; the shared journal keys them by token file
+        set_mailbox(account.token_file)
+        with make_label_batcher(session.gmail(), account.processed_label or processed_label,
+                                flush_size, flush_seconds, acknowledge) as read_marker:
+            report["processed"] = process_emails(account.name, session.calendar(), session.gmail(), read_marker,
+                                                 sync_state=account.sync_state, stop=stop_event, on_email=on_email,
+                                                 busy_index=busy_indexes[account.token_file], **fetch_options)
+    except Exception as e:
+        logger.exception(f"{account.name}: error processing mailbox")
+        report["error"] = repr(e)
+    report["seconds"] = time.perf_counter() - started
+    if lags:
+        report["lag_p50_seconds"] = statistics.median(lags)
+        report["lag_max_seconds"] = max(lags)
+    if report["processed"]:
+        logger.info(format_report(report))
+    return report
+
+
+def combine_reports(total: Optional[Dict[str, Any]], report: Dict[str, Any]) -> Dict[str, Any]:
+    """Fold one pass into an account's running totals; lag p50 is the latest pass that saw mail."""
+    if total is None:
+        return dict(report)
+    lag_maxima = [lag for lag in (total["lag_max_seconds"], report["lag_max_seconds"]) if lag is not None]
+    return {
+        "account": report["account"],
+        "processed": total["processed"] + report["processed"],
+        "seconds": total["seconds"] + report["seconds"],
+        "lag_p50_seconds": report["lag_p50_seconds"] if report["lag_p50_seconds"] is not None else total["lag_p50_seconds"],
+        "lag_max_seconds": max(lag_maxima) if lag_maxima else None,
+        "error": report["error"] or total["error"],
+    }
+
+
+def shard_metrics_file(metrics_file: Optional[str], shard: int) -> Optional[str]:
+    """Each worker writes its own file, e.g. metrics.0.prom, which a textfile collector reads side by side."""
+    if metrics_file is None:
+        return None
+    root, ext = os.path.splitext(metrics_file)
+    return f"{root}.{shard}{ext}"
+
+
+def run_shard(accounts: List[Account], options: Dict[str, Any], daemon: bool = False,
+              min_interval: float = MIN_POLL_SECONDS, max_interval: float = MAX_POLL_SECONDS,
+              shard: int = 0, metrics_file: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Handle each account in turn, once or, with ``daemon``, until stopped; return per-account totals."""
+    metrics.constant_labels["worker"] = str(shard)
+    metrics.enable_export(shard_metrics_file(metrics_file, shard))
+    totals = {}
+    poller = AdaptivePoller(min_interval, max_interval)
+    while not stop_event.is_set():
+        processed = 0
+        for account in accounts:
+            if stop_event.is_set():
+                break
+            report = run_account(account, **options)
+            totals[account.token_file] = combine_reports(totals.get(account.token_file), report)
+            processed += report["processed"]
+        metrics.export_metrics()
+        if not daemon:
+            break
+        stop_event.wait(poller.next_interval(processed))
+    log_cache_summary()
+    log_prefilter_summary()
+    log_normalize_summary()
+    log_journal_summary()
+    log_extraction_summary()
+    metrics.log_metrics_summary()
+    metrics.export_metrics()
+    return list(totals.values())
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    rate = report["processed"] / report["seconds"] if report["seconds"] else 0.0
+    line = f"{report['account']}: {report['processed']} emails in {report['seconds']:.1f}s ({rate:.2f}/s)"
+    if report["lag_p50_seconds"] is not None:
+        line += f", lag p50 {report['lag_p50_seconds']:.0f}s max {report['lag_max_seconds']:.0f}s"
+    if report["error"]:
+        line += f", error: {report['error']}"
+    return line
+
+
+def run_roster(accounts: List[Account], workers: int = WORKERS, daemon: bool = False,
+               min_interval: float = MIN_POLL_SECONDS, max_interval: float = MAX_POLL_SECONDS,
+               llm_cache: Optional[Dict[str, Any]] = None, prefilter: Optional[Dict[str, Any]] = None,
+               openai_requests_per_minute: float = rate_limit.OPENAI_REQUESTS_PER_MINUTE,
+               openai_tokens_per_minute: float = rate_limit.OPENAI_TOKENS_PER_MINUTE,
+               max_body_tokens: int = MAX_BODY_TOKENS, metrics_file: Optional[str] = None, log_bodies: bool = False,
+               availability_options: Optional[Dict[str, Any]] = None, journal: Optional[Dict[str, Any]] = None,
+               **options: Any) -> List[Dict[str, Any]]:
+    """Process every account in ``accounts`` on a pool of ``workers`` processes.
+
+    ``llm_cache``, ``prefilter`` and ``journal`` are keyword arguments for
+    ``enable_cache``, ``enable_prefilter`` and ``enable_journal`` in each worker,
+    or None to leave them off, and ``availability_options`` those for
+    ``availability.configure``. Each worker writes its metrics to its own
+    variant of ``metrics_file``. ``options`` are passed on to ``process_emails``
+    for every account.
+    """
+    shards = shard_accounts(accounts, workers)
+    if not shards:
+        logger.info("roster is empty")
+        return []
+    # the OpenAI budget belongs to the whole organization, so the workers split it;
+    # Gmail and Calendar quotas are per mailbox and each worker serves one mailbox at a time
+    rate_limits = {"openai_requests_per_minute": openai_requests_per_minute / len(shards),
+                   "openai_tokens_per_minute": openai_tokens_per_minute / len(shards)}
+    stop = multiprocessing.Event()
+    install_stop_handlers(stop)
+    logger.info(f"processing {len(accounts)} accounts on {len(shards)} workers")
+    with ProcessPoolExecutor(max_workers=len(shards), initializer=init_worker,
+                             initargs=(stop, llm_cache, prefilter, rate_limits, max_body_tokens, log_bodies,
+                                       availability_options, journal)) as executor:
+        futures = [executor.submit(run_shard, shard, options, daemon, min_interval, max_interval, index, metrics_file)
+                   for index, shard in enumerate(shards)]
+        reports = [report for future in futures for report in future.result()]
+    for report in reports:
+        logger.info(format_report(report))
+    return reports
+
+
+def authorize(accounts: List[Account]):
+    """Run the OAuth consent flow for every account that has no token yet."""
+    for account in accounts:
+        if os.path.exists(account.token_file):
+            continue
+        logger.info(f"Authorizing {account.name}. Sign in as them in the browser window")
+        os.makedirs(os.path.dirname(account.token_file) or ".", exist_ok=True)
+        load_credentials(account.token_file)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Manage the accounts in a mailbox roster.")
+    arg_parser.add_argument("command", choices=["authorize"])
+    arg_parser.add_argument("roster", nargs="?", default=ROSTER_FILE)
+    args = arg_parser.parse_args()
+    authorize(load_roster(args.roster))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import datetime as dt
+import unittest
+from unittest.mock import MagicMock, patch
+import httplib2
+from dateutil import tz
+from googleapiclient.errors import HttpError
+import availability
+import calendar_utils
+from availability import BusyIndex, WorkingHours, free_slots, format_slot, merge_intervals, propose_slots, record_event
+from calendar_utils import build_event
+from schemas import MeetingDetails
+from benchmarks.testing import make_details
+
+NEW_YORK = tz.gettz("America/New_York")
+# a Monday
+NOW = dt.datetime(2024, 3, 11, 8, 0, tzinfo=NEW_YORK)
+HOURS = WorkingHours("America/New_York", dt.time(9), dt.time(17), (0, 1, 2, 3, 4))
+
+
+def at(day, hour, minute=0):
+    return dt.datetime(2024, 3, day, hour, minute, tzinfo=NEW_YORK)
+
+
+def make_service(*busy_by_query):
+    """A Calendar service whose successive freebusy queries return the given (start, end) blocks."""
+    service = MagicMock()
+    service.freebusy().query().execute.side_effect = [
+        {"calendars": {"primary": {"busy": [{"start": start.isoformat(), "end": end.isoformat()} for start, end in busy]}}}
+        for busy in busy_by_query
+    ]
+    service.freebusy().query.reset_mock()
+    return service
+
+
+class TestFreeSlots(unittest.TestCase):
+
+    def test_merge_intervals(self):
+        merged = merge_intervals([(at(11, 13), at(11, 14)), (at(11, 9), at(11, 10)), (at(11, 9, 30), at(11, 11))])
+        self.assertEqual(merged, [(at(11, 9), at(11, 11)), (at(11, 13), at(11, 14))])
+
+    def test_slots_avoid_busy_time_and_respect_notice(self):
+        service = make_service([(at(11, 10), at(11, 12)), (at(11, 11), at(11, 12, 30))])
+
+        slots = free_slots(BusyIndex(), service, 60, count=3, now=NOW, hours=HOURS)
+
+        # two hours of notice from 8:00, and the merged 10:00-12:30 block, push Monday to 12:30
+        self.assertEqual(slots, [(at(11, 12, 30), at(11, 13, 30)), (at(12, 9), at(12, 10)), (at(13, 9), at(13, 10))])
+
+    def test_weekends_and_evenings_are_skipped(self):
+        friday_evening = dt.datetime(2024, 3, 15, 16, 30, tzinfo=NEW_YORK)
+
+        slots = free_slots(BusyIndex(), make_service([]), 30, count=1, now=friday_evening, hours=HOURS)
+
+        self.assertEqual(slots, [(at(18, 9), at(18, 9, 30))])
+
+    def test_requested_date_is_offered_first(self):
+        slots = free_slots(BusyIndex(), make_service([]), 30, count=2, on_date=dt.date(2024, 3, 14), now=NOW, hours=HOURS)
+
+        self.assertEqual(slots, [(at(14, 9), at(14, 9, 30)), (at(14, 9, 30), at(14, 10))])
+
+    def test_no_slots_when_freebusy_fails(self):
+        service = MagicMock()
+        service.freebusy().query().execute.side_effect = HttpError(httplib2.Response({"status": 404}), b"notFound")
+
+        self.assertEqual(free_slots(BusyIndex(), service, 30, count=3, now=NOW, hours=HOURS), [])
+
+    def test_format_slot(self):
+        self.assertEqual(format_slot((at(12, 14), at(12, 14, 30))), "Tuesday, March 12, 2:00 PM - 2:30 PM EDT")
+
+
+class TestBusyIndex(unittest.TestCase):
+
+    def test_index_is_reused_within_ttl(self):
+        service = make_service([(at(11, 10), at(11, 11))])
+        index = BusyIndex(ttl_seconds=300)
+
+        free_slots(index, service, 30, count=3, now=NOW, hours=HOURS)
+        free_slots(index, service, 30, count=3, now=NOW + dt.timedelta(minutes=5), hours=HOURS)
+
+        self.assertEqual(service.freebusy().query.call_count, 1)
+
+    def test_only_new_days_are_queried_when_the_horizon_moves(self):
+        service = make_service([], [(at(26, 9), at(26, 17))])
+        index = BusyIndex(ttl_seconds=86400)
+        index.ensure(service, NOW, at(25, 0))
+
+        index.ensure(service, NOW + dt.timedelta(days=1), at(26, 0))
+
+        tail_query = service.freebusy().query.call_args_list[-1].kwargs["body"]
+        self.assertEqual((tail_query["timeMin"], tail_query["timeMax"]), ("2024-03-25T04:00:00Z", "2024-03-26T04:00:00Z"))
+        self.assertEqual(index.intervals, [(at(26, 9), at(26, 17))])
+
+    def test_index_is_requeried_after_ttl(self):
+        service = make_service([], [])
+        index = BusyIndex(ttl_seconds=300)
+        index.ensure(service, NOW, at(25, 0))
+        index.fetched_at -= 301
+        index.ensure(service, NOW, at(25, 0))
+
+        self.assertEqual(service.freebusy().query.call_count, 2)
+
+    def test_created_events_are_avoided_before_the_next_query(self):
+        service = make_service([])
+        index = BusyIndex()
+        index.ensure(service, NOW, at(25, 0))
+
+        record_event(index, MeetingDetails(summary="Sync", agenda=None, date="2024-03-12", start_time="09:00", duration=60,
+                                           location=None, timezone=None, attendees=[]))
+
+        slots = free_slots(index, service, 30, count=1, on_date=dt.date(2024, 3, 12), now=NOW, hours=HOURS)
+        self.assertEqual(slots, [(at(12, 10), at(12, 10, 30))])
+
+    def test_propose_slots_formats_them(self):
+        with patch('availability.working_hours', HOURS):
+            slots = propose_slots(BusyIndex(), make_service([]), make_details(date="2024-03-13", start_time=None), now=NOW)
+
+        self.assertEqual(slots, ["Wednesday, March 13, 9:00 AM - 9:30 AM EDT", "Wednesday, March 13, 9:30 AM - 10:00 AM EDT",
+                                 "Wednesday, March 13, 10:00 AM - 10:30 AM EDT"])
+
+    @patch('availability.working_hours', HOURS)
+    @patch('calendar_utils.default_timezone', calendar_utils.DEFAULT_TIMEZONE)
+    def test_configured_time_zone_applies_to_events_without_one(self):
+        availability.configure(timezone="Europe/Berlin")
+
+        details = make_details(date="2024-03-13")
+        self.assertEqual(build_event(details)["start"]["timeZone"], "Europe/Berlin")
+
+
+if __name__ == '__main__':
+    unittest.main()
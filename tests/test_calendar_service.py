@@ -1,8 +1,10 @@
 import unittest
 from unittest.mock import patch, MagicMock
 from oauth_utils import get_calendar_service
-from calendar_utils import create_calendar_event
+from googleapiclient.errors import HttpError
+from calendar_utils import create_calendar_event, create_calendar_events, event_id_for
 from schemas import MeetingDetails
+from benchmarks.testing import FakeBatch, make_details
 
 class TestCalendarService(unittest.TestCase):
 
@@ -30,5 +32,49 @@ class TestCalendarService(unittest.TestCase):
         create_calendar_event(mock_service, meeting_details)
         mock_service.events().insert.assert_called_once()
 
+
+class TestIdempotentEvents(unittest.TestCase):
+
+    def test_event_id_is_stable_per_thread_and_start(self):
+        first = {"Id": "1", "ThreadId": "t1", "Message-ID": "<a@example.com>"}
+        reply = {"Id": "2", "ThreadId": "t1", "Message-ID": "<b@example.com>"}
+        event_id = event_id_for(first, make_details())
+        self.assertEqual(event_id, event_id_for(reply, make_details(start_time="10:00 AM")))
+        self.assertNotEqual(event_id, event_id_for(first, make_details(start_time="11:00")))
+        self.assertRegex(event_id, r"^[0-9a-v]{5,1024}$")
+
+    def test_event_id_falls_back_to_references_root(self):
+        reply = {"Id": "2", "References": "<root@example.com> <a@example.com>", "Message-ID": "<b@example.com>"}
+        root = {"Id": "1", "Message-ID": "<root@example.com>"}
+        self.assertEqual(event_id_for(reply, make_details()), event_id_for(root, make_details()))
+
+    def test_insert_uses_deterministic_id(self):
+        mock_service = MagicMock()
+        self.assertTrue(create_calendar_event(mock_service, make_details(), "sched123"))
+        body = mock_service.events().insert.call_args.kwargs["body"]
+        self.assertEqual(body["id"], "sched123")
+
+    def test_existing_event_counts_as_created(self):
+        mock_service = MagicMock()
+        mock_service.events().insert().execute.side_effect = HttpError(MagicMock(status=409), b"duplicate")
+        self.assertTrue(create_calendar_event(mock_service, make_details(), "sched123"))
+
+    def test_batched_insert(self):
+        mock_service = MagicMock()
+        errors = {"sched2": HttpError(MagicMock(status=409), b"duplicate"), "sched3": HttpError(MagicMock(status=400), b"bad")}
+        batches = []
+
+        def respond(request_id, request):
+            return errors.get(request_id) or {"id": request_id}
+
+        mock_service.new_batch_http_request.side_effect = lambda callback: batches.append(FakeBatch(callback, respond)) or batches[-1]
+        events = [(make_details(), f"sched{i}") for i in range(1, 5)]
+
+        created = create_calendar_events(mock_service, events, batch_size=2)
+
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(created, {"sched1", "sched2", "sched4"})
+
+
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
@@ -0,0 +1,73 @@
+import datetime as dt
+import threading
+import unittest
+from unittest.mock import patch, MagicMock
+from daemon import AdaptivePoller, run_daemon
+from oauth_utils import refresh_if_expiring, TOKEN_FILE
+
+
+class TestAdaptivePoller(unittest.TestCase):
+
+    def test_backs_off_while_quiet_and_resets_on_mail(self):
+        poller = AdaptivePoller(min_interval=10, max_interval=60)
+        self.assertEqual([poller.next_interval(0) for _ in range(4)], [20, 40, 60, 60])
+        self.assertEqual(poller.next_interval(3), 10)
+
+
+class TestRefreshIfExpiring(unittest.TestCase):
+
+    def make_creds(self, expires_in):
+        creds = MagicMock()
+        creds.refresh_token = "refresh"
+        creds.expiry = dt.datetime.now(dt.timezone.utc).replace(tzinfo=None) + expires_in
+        return creds
+
+    @patch('oauth_utils.save_credentials')
+    def test_refreshes_shortly_before_expiry(self, mock_save):
+        creds = self.make_creds(dt.timedelta(minutes=2))
+        self.assertTrue(refresh_if_expiring(creds))
+        creds.refresh.assert_called_once()
+        mock_save.assert_called_once_with(creds, TOKEN_FILE)
+
+    @patch('oauth_utils.save_credentials')
+    def test_leaves_fresh_credentials_alone(self, mock_save):
+        creds = self.make_creds(dt.timedelta(minutes=30))
+        self.assertFalse(refresh_if_expiring(creds))
+        creds.refresh.assert_not_called()
+        mock_save.assert_not_called()
+
+
+class TestRunDaemon(unittest.TestCase):
+
+    @patch('daemon.make_label_batcher')
+    @patch('daemon.get_session')
+    @patch('daemon.process_emails')
+    def test_polls_with_warm_services_until_stopped(self, mock_process, mock_session, mock_batcher):
+        stop = threading.Event()
+        results = iter([2, RuntimeError("network down"), 0])
+
+        def process(*args, **kwargs):
+            result = next(results)
+            if isinstance(result, Exception):
+                raise result
+            if result == 0:
+                stop.set()
+            return result
+
+        mock_process.side_effect = process
+
+        total = run_daemon("Me", min_interval=0, max_interval=0, stop=stop, incremental=True)
+
+        self.assertEqual(total, 2)
+        self.assertEqual(mock_process.call_count, 3)
+        session = mock_session.return_value
+        session.gmail.assert_called_once()
+        session.calendar.assert_called_once()
+        self.assertEqual(session.refresh_if_expiring.call_count, 3)
+        self.assertTrue(mock_process.call_args.kwargs["incremental"])
+        read_marker = mock_batcher.return_value.__enter__.return_value
+        self.assertEqual(read_marker.flush.call_count, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
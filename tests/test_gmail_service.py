@@ -1,9 +1,52 @@
 import unittest
 import email
+import os
+import tempfile
 import base64
+import threading
 from unittest.mock import patch, MagicMock
 from oauth_utils import get_gmail_service
-from gmail_utils import mark_email_as_read, send_reply_email, get_email_body, get_unread_emails
+from googleapiclient.errors import HttpError
+from gmail_utils import mark_email_as_read, send_reply_email, get_email_body, get_unread_emails, fetch_emails, iter_unread_emails
+from gmail_utils import iter_new_emails, load_sync_state, save_sync_state, format_plaintext_email, mark_handled, reply_was_sent
+from gmail_utils import LabelUpdateBatcher, make_label_batcher, get_or_create_label, is_loaded, load_body
+from prefilter import Prefilter
+from schemas import IsMeetingRequest
+from workflow import process_emails, likely_needs_body
+from benchmarks.testing import FakeBatch
+
+
+def encode_message(sender, subject, body, date=None, **headers):
+    msg = email.message.EmailMessage()
+    msg['From'] = sender
+    msg['To'] = "me@example.com"
+    msg['Subject'] = subject
+    if date is not None:
+        msg['Date'] = date
+    for name, value in headers.items():
+        msg[name.replace('_', '-')] = value
+    msg.set_content(body)
+    return base64.urlsafe_b64encode(msg.as_bytes()).decode('ASCII')
+
+
+def metadata_response(message_id, raw):
+    """The ``messages.get(format="metadata")`` view of a raw message."""
+    msg = email.message_from_bytes(base64.urlsafe_b64decode(raw))
+    return {"id": message_id, "snippet": msg.get_payload()[:100].strip(),
+            "payload": {"mimeType": msg.get_content_type(), "headers": [{"name": k, "value": v} for k, v in msg.items()]}}
+
+
+def answer_from(responses):
+    """Answers ``messages.get`` sub-requests from raw messages (or errors) keyed by message id."""
+    def respond(request_id, request):
+        response = responses[request['id']]
+        if isinstance(response, Exception):
+            return response
+        if request['format'] == "metadata":
+            return metadata_response(request['id'], response)
+        return {"id": request['id'], "raw": response}
+    return respond
+
 
 class TestGmailService(unittest.TestCase):
 
@@ -23,9 +66,8 @@ class TestGmailService(unittest.TestCase):
             userId="me", id='test_id', body={"removeLabelIds": ["UNREAD"]}
         )
 
-    @patch('gmail_utils.get_email_body')
     @patch('oauth_utils.build')
-    def test_get_unread_emails(self, mock_build, mock_get_email_body):
+    def test_get_unread_emails(self, mock_build):
         # Mock the service and its methods
         mock_service = MagicMock()
         mock_build.return_value = mock_service
@@ -33,31 +75,63 @@ class TestGmailService(unittest.TestCase):
         mock_service.users().messages().list().execute.return_value = {
             "messages": [{"id": "123"}, {"id": "456"}]
         }
-
-        # Mock the response from the get method for headers
-        mock_service.users().messages().get().execute.side_effect = [
-            {"payload": {
-                "headers": [{"name": "From", "value": "test@example.com"}, {"name": "To", "value": "me@example.com"},
-                            {"name": "Subject", "value": "Test Subject"}]}},
-            {"raw": "raw_email_body_123"},
-            {"payload": {
-                "headers": [{"name": "From", "value": "test2@example.com"}, {"name": "To", "value": "me@example.com"},
-                            {"name": "Subject", "value": "Test Subject 2"}]}},
-            {"raw": "raw_email_body_456"}
-        ]
-
-        # Mock the get_email_body function
-        mock_get_email_body.side_effect = ["Decoded body 123", "Decoded body 456"]
+        mock_service.users().messages().get.side_effect = lambda **kwargs: kwargs
+        raw_messages = {
+            "123": encode_message("test@example.com", "Test Subject", "Decoded body 123"),
+            "456": encode_message("test2@example.com", "Test Subject 2", "Decoded body 456"),
+        }
+        batches = []
+        mock_service.new_batch_http_request.side_effect = lambda callback: batches.append(
+            FakeBatch(callback, answer_from(raw_messages))) or batches[-1]
 
         # Call the function
         unread_emails = get_unread_emails(mock_service)
 
         # Assertions
+        self.assertEqual(len(batches), 1)
         self.assertEqual(len(unread_emails), 2)
+        self.assertEqual(unread_emails[0]['Id'], "123")
         self.assertEqual(unread_emails[0]['From'], "test@example.com")
-        self.assertEqual(unread_emails[0]['Body'], "Decoded body 123")
+        self.assertEqual(unread_emails[0]['Subject'], "Test Subject")
+        self.assertEqual(unread_emails[0]['Snippet'], "Decoded body 123")
+        # bodies are only downloaded once read, the whole chunk in one batch
+        self.assertEqual(unread_emails[0]['Body'].strip(), "Decoded body 123")
+        self.assertEqual(len(batches), 2)
+        mock_service.users().messages().get.assert_any_call(userId="me", id="456", format="raw")
         self.assertEqual(unread_emails[1]['From'], "test2@example.com")
-        self.assertEqual(unread_emails[1]['Body'], "Decoded body 456")
+        self.assertEqual(unread_emails[1]['Body'].strip(), "Decoded body 456")
+
+    def test_fetch_emails_chunks_and_isolates_errors(self):
+        mock_service = MagicMock()
+        mock_service.users().messages().get.side_effect = lambda **kwargs: kwargs
+        raw_messages = {str(i): encode_message("a@example.com", f"Subject {i}", f"Body {i}") for i in range(5)}
+        raw_messages["3"] = HttpError(MagicMock(status=404), b"not found")
+        batches = []
+        mock_service.new_batch_http_request.side_effect = lambda callback: batches.append(
+            FakeBatch(callback, answer_from(raw_messages))) or batches[-1]
+
+        emails = fetch_emails(mock_service, [str(i) for i in range(5)], batch_size=2)
+
+        self.assertEqual(len(batches), 3)
+        self.assertEqual([e['Id'] for e in emails], ["0", "1", "2", "4"])
+
+    def test_iter_unread_emails_follows_pages(self):
+        mock_service = MagicMock()
+        mock_service.users().messages().list().execute.side_effect = [
+            {"messages": [{"id": "1"}, {"id": "2"}], "nextPageToken": "page-2"},
+            {"messages": [{"id": "3"}]},
+        ]
+        mock_service.users().messages().get.side_effect = lambda **kwargs: kwargs
+        raw_messages = {str(i): encode_message("a@example.com", f"Subject {i}", f"Body {i}") for i in range(1, 4)}
+        mock_service.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback, answer_from(raw_messages))
+
+        emails = iter_unread_emails(mock_service, page_size=2, max_in_flight=1)
+        self.assertEqual(next(emails)['Id'], "1")
+        # the second page is only requested once the first has been consumed
+        self.assertEqual(mock_service.users().messages().list().execute.call_count, 1)
+        self.assertEqual([e['Id'] for e in emails], ["2", "3"])
+        mock_service.users().messages().list.assert_called_with(
+            userId="me", labelIds=["UNREAD"], maxResults=2, pageToken="page-2")
 
     @patch('oauth_utils.build')
     def test_send_reply_email(self, mock_build):
@@ -75,6 +149,298 @@ class TestGmailService(unittest.TestCase):
         send_reply_email(mock_service, msg_dict, reply)
         mock_service.users().messages().send.assert_called_once()
 
+    def test_reply_was_sent_looks_for_our_reply_in_the_thread(self):
+        mock_service = MagicMock()
+        mock_service.users().threads().get().execute.return_value = {"messages": [
+            {"labelIds": ["INBOX"], "payload": {"headers": []}},
+            {"labelIds": ["SENT"], "payload": {"headers": [{"name": "In-Reply-To", "value": "<1@example.com>"}]}},
+        ]}
+
+        self.assertTrue(reply_was_sent(mock_service, {"ThreadId": "t1", "Message-ID": "<1@example.com>"}))
+        self.assertFalse(reply_was_sent(mock_service, {"ThreadId": "t1", "Message-ID": "<2@example.com>"}))
+
+
+class TestIncrementalSync(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.state_path = os.path.join(self.tmpdir.name, "sync_state.json")
+        self.service = MagicMock()
+        self.service.users().messages().get.side_effect = lambda **kwargs: kwargs
+        raw_messages = {str(i): encode_message("a@example.com", f"Subject {i}", f"Body {i}") for i in range(1, 4)}
+        self.service.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback, answer_from(raw_messages))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_first_run_does_full_sync_and_saves_history_id(self):
+        self.service.users().getProfile().execute.return_value = {"historyId": "100"}
+        self.service.users().messages().list().execute.return_value = {"messages": [{"id": "1"}]}
+
+        emails = list(iter_new_emails(self.service, self.state_path))
+
+        self.assertEqual([e['Id'] for e in emails], ["1"])
+        self.assertEqual(load_sync_state(self.state_path), {"historyId": "100"})
+
+    def test_incremental_sync_fetches_only_added_messages(self):
+        save_sync_state(self.state_path, {"historyId": "100"})
+        self.service.users().history().list().execute.return_value = {
+            "history": [
+                {"messagesAdded": [{"message": {"id": "2", "labelIds": ["INBOX", "UNREAD"]}}]},
+                {"messagesAdded": [{"message": {"id": "3", "labelIds": ["INBOX", "SENT"]}}]},
+                {"messagesAdded": [{"message": {"id": "2", "labelIds": ["INBOX"]}}]},
+            ],
+            "historyId": "120",
+        }
+
+        emails = list(iter_new_emails(self.service, self.state_path))
+
+        self.assertEqual([e['Id'] for e in emails], ["2"])
+        self.service.users().messages().list().execute.assert_not_called()
+        self.assertEqual(load_sync_state(self.state_path), {"historyId": "120"})
+
+    def test_expired_history_id_falls_back_to_full_sync(self):
+        save_sync_state(self.state_path, {"historyId": "1"})
+        self.service.users().history().list().execute.side_effect = HttpError(MagicMock(status=404), b"expired")
+        self.service.users().getProfile().execute.return_value = {"historyId": "200"}
+        self.service.users().messages().list().execute.return_value = {"messages": [{"id": "1"}, {"id": "3"}]}
+
+        emails = list(iter_new_emails(self.service, self.state_path))
+
+        self.assertEqual([e['Id'] for e in emails], ["1", "3"])
+        self.assertEqual(load_sync_state(self.state_path), {"historyId": "200"})
+
+    def test_state_not_saved_until_stream_is_consumed(self):
+        save_sync_state(self.state_path, {"historyId": "100"})
+        self.service.users().history().list().execute.return_value = {
+            "history": [{"messagesAdded": [{"message": {"id": "1", "labelIds": ["INBOX"]}}]},
+                        {"messagesAdded": [{"message": {"id": "2", "labelIds": ["INBOX"]}}]}],
+            "historyId": "130",
+        }
+
+        emails = iter_new_emails(self.service, self.state_path, max_in_flight=1)
+        next(emails)
+
+        self.assertEqual(load_sync_state(self.state_path), {"historyId": "100"})
+
+    def test_unhandled_messages_are_listed_again_next_run(self):
+        save_sync_state(self.state_path, {"historyId": "100"})
+        self.service.users().history().list().execute.return_value = {
+            "history": [{"messagesAdded": [{"message": {"id": "1", "labelIds": ["INBOX"]}}]},
+                        {"messagesAdded": [{"message": {"id": "2", "labelIds": ["INBOX"]}}]}],
+            "historyId": "130",
+        }
+        read_marker = MagicMock()
+
+        with patch('workflow.prefilter_email', return_value=None), \
+                patch('workflow.is_meeting_request', side_effect=[RuntimeError("timeout"), IsMeetingRequest(is_meeting_request=False)]):
+            process_emails("Me", MagicMock(), self.service, read_marker, incremental=True, sync_state=self.state_path,
+                           collapse_threads=False)
+
+        self.assertEqual([call.args[0] for call in read_marker.add.call_args_list], ["2"])
+        self.assertEqual(load_sync_state(self.state_path), {"historyId": "130", "retry": {"1": 1}})
+
+        self.service.users().history().list().execute.return_value = {"history": [], "historyId": "140"}
+        emails = list(iter_new_emails(self.service, self.state_path))
+
+        self.assertEqual([e['Id'] for e in emails], ["1"])
+        self.assertEqual(load_sync_state(self.state_path), {"historyId": "140"})
+
+
+class TestThreadCollapsing(unittest.TestCase):
+
+    def setUp(self):
+        self.service = MagicMock()
+        self.service.users().messages().get.side_effect = lambda **kwargs: kwargs
+        self.raw_messages = {
+            "1": encode_message("a@example.com", "Sync", "Can we meet Tuesday?", "Mon, 11 Mar 2024 09:00:00 -0400"),
+            "2": encode_message("b@example.com", "Newsletter", "News", "Mon, 11 Mar 2024 10:00:00 -0400"),
+            "3": encode_message("a@example.com", "Re: Sync", "How about 2pm?", "Mon, 11 Mar 2024 11:00:00 -0400"),
+        }
+        self.service.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback, answer_from(self.raw_messages))
+
+    def test_only_newest_message_of_each_thread_is_yielded(self):
+        self.service.users().messages().list().execute.side_effect = [
+            {"messages": [{"id": "3", "threadId": "t1"}, {"id": "2", "threadId": "t2"}], "nextPageToken": "page-2"},
+            {"messages": [{"id": "1", "threadId": "t1"}]},
+        ]
+
+        emails = list(iter_unread_emails(self.service, page_size=2, max_in_flight=2, collapse_threads=True))
+
+        self.assertEqual([e['Id'] for e in emails], ["3", "2"])
+        self.assertEqual(emails[0]['Superseded'], ["1"])
+        self.assertNotIn('Superseded', emails[1])
+        plaintext = format_plaintext_email(emails[0])
+        self.assertLess(plaintext.index("How about 2pm?"), plaintext.index("Can we meet Tuesday?"))
+
+    def test_thread_across_a_batch_boundary_is_loaded_together(self):
+        self.service.users().messages().list().execute.return_value = {
+            "messages": [{"id": "2", "threadId": "t2"}, {"id": "3", "threadId": "t1"}, {"id": "1", "threadId": "t1"}]}
+        worker_service = MagicMock()
+        worker_service.users().messages().get.side_effect = lambda **kwargs: kwargs
+        batches = []
+        worker_service.new_batch_http_request.side_effect = lambda callback: batches.append(
+            FakeBatch(callback, answer_from(self.raw_messages))) or batches[-1]
+
+        emails = list(iter_unread_emails(self.service, page_size=3, max_in_flight=2, collapse_threads=True))
+        load_body(emails[1], worker_service)
+
+        self.assertTrue(is_loaded(emails[1]))
+        self.assertEqual([request_id for request_id, _ in batches[0].requests], ["3", "1"])
+        self.assertIn("Can we meet Tuesday?", format_plaintext_email(emails[1]))
+
+    def test_history_messages_are_collapsed(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        state_path = os.path.join(tmpdir.name, "sync_state.json")
+        save_sync_state(state_path, {"historyId": "100"})
+        self.service.users().history().list().execute.return_value = {
+            "history": [{"messagesAdded": [{"message": {"id": "1", "threadId": "t1", "labelIds": ["INBOX"]}}]},
+                        {"messagesAdded": [{"message": {"id": "3", "threadId": "t1", "labelIds": ["INBOX"]}}]}],
+            "historyId": "120",
+        }
+
+        emails = list(iter_new_emails(self.service, state_path, collapse_threads=True))
+
+        self.assertEqual([(e['Id'], e['Superseded']) for e in emails], [("3", ["1"])])
+
+    def test_full_scan_streams_by_default(self):
+        self.service.users().messages().list().execute.side_effect = [
+            {"messages": [{"id": "3", "threadId": "t1"}], "nextPageToken": "page-2"},
+            {"messages": [{"id": "1", "threadId": "t1"}]},
+        ]
+        first_handled = MagicMock(side_effect=StopIteration)
+
+        with patch('workflow.prefilter_email', return_value=IsMeetingRequest(is_meeting_request=False)):
+            with self.assertRaises(StopIteration):
+                process_emails("Me", MagicMock(), self.service, MagicMock(), on_email=first_handled)
+
+        # the second page is not listed before the first email is handled
+        self.assertEqual(self.service.users().messages().list().execute.call_count, 1)
+
+    def test_superseded_messages_are_marked_read_with_the_newest(self):
+        read_marker = MagicMock()
+
+        mark_handled(read_marker, {"Id": "3", "Superseded": ["1", "2"]})
+
+        self.assertEqual([call.args[0] for call in read_marker.add.call_args_list], ["3", "1", "2"])
+
+
+class TestLabelUpdateBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.service = MagicMock()
+        self.batch_modify = self.service.users().messages().batchModify
+
+    def modified_ids(self):
+        return [call.kwargs["body"]["ids"] for call in self.batch_modify.call_args_list]
+
+    def test_flushes_when_size_threshold_is_reached(self):
+        batcher = LabelUpdateBatcher(self.service, max_ids=2, max_age_seconds=3600)
+        for i in range(5):
+            batcher.add(str(i))
+        self.assertEqual(self.modified_ids(), [["0", "1"], ["2", "3"]])
+        batcher.close()
+        self.assertEqual(self.modified_ids(), [["0", "1"], ["2", "3"], ["4"]])
+        self.batch_modify.assert_called_with(userId="me", body={"ids": ["4"], "removeLabelIds": ["UNREAD"]})
+
+    @patch('gmail_utils.time.monotonic')
+    def test_flushes_when_oldest_email_is_too_old(self, mock_monotonic):
+        batcher = LabelUpdateBatcher(self.service, max_ids=100, max_age_seconds=30)
+        mock_monotonic.return_value = 0
+        batcher.add("1")
+        mock_monotonic.return_value = 10
+        batcher.add("2")
+        self.batch_modify.assert_not_called()
+        mock_monotonic.return_value = 31
+        batcher.flush_if_due()
+        self.assertEqual(self.modified_ids(), [["1", "2"]])
+
+    def test_age_limit_holds_without_further_emails(self):
+        flushed = threading.Event()
+        batcher = LabelUpdateBatcher(self.service, max_ids=100, max_age_seconds=0.01, on_flush=lambda ids: flushed.set())
+        batcher.add("1")
+
+        self.assertTrue(flushed.wait(5))
+        self.assertEqual(self.modified_ids(), [["1"]])
+
+    def test_add_does_not_wait_for_a_flush_in_progress(self):
+        batcher = LabelUpdateBatcher(self.service, max_ids=100, max_age_seconds=3600)
+        added = []
+
+        def execute():
+            adder = threading.Thread(target=batcher.add, args=("2",))
+            adder.start()
+            adder.join(5)
+            added.append(not adder.is_alive())
+
+        self.batch_modify.return_value.execute.side_effect = execute
+        batcher.add("1")
+        batcher.flush()
+
+        self.assertEqual(added, [True])
+        self.assertEqual(batcher.pending, ["2"])
+        batcher.close()
+
+    def test_size_is_capped_at_gmail_limit(self):
+        with LabelUpdateBatcher(self.service, max_ids=5000, max_age_seconds=3600) as batcher:
+            for i in range(1500):
+                batcher.add(str(i))
+        self.assertEqual([len(ids) for ids in self.modified_ids()], [1000, 500])
+
+    def test_processed_label_is_created_once_and_applied(self):
+        self.service.users().labels().list().execute.return_value = {"labels": [{"id": "Label_1", "name": "other"}]}
+        self.service.users().labels().create().execute.return_value = {"id": "Label_2", "name": "scheduler-processed"}
+        with make_label_batcher(self.service, "scheduler-processed") as batcher:
+            batcher.add("1")
+        self.batch_modify.assert_called_once_with(
+            userId="me", body={"ids": ["1"], "removeLabelIds": ["UNREAD"], "addLabelIds": ["Label_2"]})
+
+    def test_existing_label_is_reused(self):
+        self.service.users().labels().list().execute.return_value = {"labels": [{"id": "Label_7", "name": "scheduler-processed"}]}
+        self.assertEqual(get_or_create_label(self.service, "scheduler-processed"), "Label_7")
+        self.service.users().labels().create().execute.assert_not_called()
+
+
+class TestEmailRecord(unittest.TestCase):
+
+    def setUp(self):
+        self.service = MagicMock()
+        self.service.users().messages().get.side_effect = lambda **kwargs: kwargs
+        self.raw_messages = {
+            "1": encode_message("a@example.com", "Sync", "Can we meet Tuesday?", X_Mailer="Thunderbird"),
+            "2": encode_message("news@example.com", "Weekly digest", "News", List_Unsubscribe="<mailto:u@example.com>"),
+            "3": encode_message("b@example.com", "Lunch", "Noon?"),
+        }
+        self.batches = []
+        self.service.new_batch_http_request.side_effect = lambda callback: self.batches.append(
+            FakeBatch(callback, answer_from(self.raw_messages))) or self.batches[-1]
+
+    def test_only_the_headers_used_are_kept(self):
+        record = fetch_emails(self.service, ["1"])[0]
+
+        self.assertEqual(set(record), {"Id", "Snippet", "From", "To", "Subject"})
+        self.assertNotIn("X-Mailer", record)
+        self.assertEqual(len(self.batches), 1)
+
+    @patch('prefilter.active', Prefilter())
+    def test_bodies_are_downloaded_together_except_for_bulk_mail(self):
+        records = fetch_emails(self.service, ["1", "2", "3"], needs_body=likely_needs_body)
+
+        self.assertEqual(records[0]['Body'].strip(), "Can we meet Tuesday?")
+        self.assertEqual(records[2]['Body'].strip(), "Noon?")
+
+        self.assertEqual(len(self.batches), 2)
+        self.assertEqual([request_id for request_id, _ in self.batches[1].requests], ["1", "3"])
+        self.assertNotIn("Body", list(records[1]))
+
+    def test_failed_download_is_not_mistaken_for_an_empty_body(self):
+        record = fetch_emails(self.service, ["1"])[0]
+        self.raw_messages["1"] = HttpError(MagicMock(status=404), b"not found")
+
+        with self.assertRaises(HttpError):
+            record.get("Body", "")
+
 
 class TestGmailUtils(unittest.TestCase):
 
@@ -119,7 +485,7 @@ class TestGmailUtils(unittest.TestCase):
         body = get_email_body(encoded_message)
 
         # Assertions
-        self.assertEqual(body, "")
+        self.assertEqual(body, "This is the HTML part of the email.")
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
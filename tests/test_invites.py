@@ -0,0 +1,158 @@
+import base64
+import datetime as dt
+import unittest
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from unittest.mock import patch, MagicMock
+import invites
+import prefilter
+from gmail_utils import parse_raw_email
+from invites import parse_ics, parse_explicit
+from prefilter import Prefilter
+from workflow import process_emails
+
+INVITE = "\r\n".join([
+    "BEGIN:VCALENDAR",
+    "METHOD:REQUEST",
+    "BEGIN:VEVENT",
+    "SUMMARY:Quarterly review",
+    "DTSTART;TZID=Eastern Standard Time:20240312T140000",
+    "DTEND;TZID=Eastern Standard Time:20240312T153000",
+    "LOCATION:Room 4\\, 2nd floor",
+    'ORGANIZER;CN="Doe: Jane":mailto:jane@example.com',
+    "ATTENDEE;CN=Bob;ROLE=REQ-PARTICIPANT:mailto:bob@exam",
+    " ple.com",
+    "END:VEVENT",
+    "END:VCALENDAR",
+])
+SENT = dt.date(2024, 3, 10)
+
+
+class TestParseIcs(unittest.TestCase):
+
+    def test_invite_maps_onto_meeting_details(self):
+        details = parse_ics(INVITE)
+
+        self.assertEqual((details.summary, details.date, details.start_time, details.duration),
+                         ("Quarterly review", "2024-03-12", "14:00", 90))
+        self.assertEqual(details.timezone, "America/New_York")
+        self.assertEqual(details.location, "Room 4, 2nd floor")
+        self.assertEqual(details.attendees, ["jane@example.com", "bob@example.com"])
+
+    def test_utc_start_with_duration(self):
+        ics = INVITE.replace("DTSTART;TZID=Eastern Standard Time:20240312T140000", "DTSTART:20240312T180000Z")
+        ics = ics.replace("DTEND;TZID=Eastern Standard Time:20240312T153000", "DURATION:PT45M")
+
+        details = parse_ics(ics)
+
+        self.assertEqual((details.start_time, details.timezone, details.duration), ("18:00", "UTC", 45))
+
+    def test_alarm_properties_are_not_the_events(self):
+        alarm = "BEGIN:VALARM\r\nACTION:DISPLAY\r\nDESCRIPTION:REMINDER\r\nTRIGGER:-PT5M\r\nDURATION:PT5M\r\nEND:VALARM\r\n"
+        ics = INVITE.replace("SUMMARY:Quarterly review", alarm + "SUMMARY:Quarterly review")
+
+        details = parse_ics(ics)
+
+        self.assertEqual((details.duration, details.agenda, details.summary), (90, None, "Quarterly review"))
+
+    def test_unclear_invites_are_left_to_the_llm(self):
+        self.assertIsNone(parse_ics(INVITE.replace("METHOD:REQUEST", "METHOD:CANCEL")))
+        self.assertIsNone(parse_ics(INVITE.replace("DTSTART;TZID=Eastern Standard Time:20240312T140000",
+                                                   "DTSTART;VALUE=DATE:20240312")))
+        self.assertIsNone(parse_ics(INVITE.replace("Eastern Standard Time", "Somewhere Standard Time")))
+
+
+class TestParseExplicit(unittest.TestCase):
+
+    def test_single_date_and_time(self):
+        details = parse_explicit("Can we meet on Tuesday, March 12 at 2:30 PM for 30 minutes?", SENT)
+
+        self.assertEqual((details.date, details.start_time, details.duration, details.timezone),
+                         ("2024-03-12", "14:30", 30, None))
+
+    def test_time_range_and_zone(self):
+        details = parse_explicit("How about 3/15/2024 2-3pm PT?", SENT)
+
+        self.assertEqual((details.date, details.start_time, details.duration, details.timezone),
+                         ("2024-03-15", "14:00", 60, "America/Los_Angeles"))
+
+    def test_missing_year_is_the_year_sent(self):
+        self.assertEqual(parse_explicit("April 5 at 9am works", SENT).date, "2024-04-05")
+
+    def test_past_date_is_not_a_slot(self):
+        self.assertIsNone(parse_explicit("Jan 5 at 9am works", SENT))
+
+    def test_date_outside_the_meeting_ask_is_left_to_the_llm(self):
+        self.assertIsNone(parse_explicit("The report is due March 12 at 5pm. Can we meet to discuss?", SENT))
+
+    def test_ambiguous_text_is_left_to_the_llm(self):
+        for text in ["Meet tomorrow at 2pm?", "March 12 at 2pm or March 13 at 3pm?", "March 12 at 2pm or 4pm",
+                     "Wednesday, March 12 at 2pm", "On 03/04/2024 at 10am", "Let's meet on March 12"]:
+            with self.subTest(text=text):
+                self.assertIsNone(parse_explicit(text, SENT))
+
+
+class TestCalendarPart(unittest.TestCase):
+
+    def test_invite_is_kept_alongside_the_body(self):
+        message = MIMEMultipart("alternative")
+        message["Subject"] = "Invitation: Quarterly review"
+        message.attach(MIMEText("You have been invited", "plain"))
+        message.attach(MIMEText(INVITE, "calendar"))
+
+        msg_dict = parse_raw_email(base64.urlsafe_b64encode(message.as_bytes()).decode())
+
+        self.assertEqual(msg_dict["Body"], "You have been invited")
+        self.assertEqual(parse_ics(msg_dict["Calendar"]).summary, "Quarterly review")
+
+
+@patch('workflow.prefilter_email', return_value=None)
+@patch('workflow.record_verdict')
+@patch('workflow.create_calendar_event', return_value=True)
+@patch('workflow.extract_meeting_details')
+@patch('workflow.is_meeting_request')
+class TestWorkflowFastPath(unittest.TestCase):
+
+    def setUp(self):
+        invites.stats.update({key: 0 for key in invites.stats})
+
+    def run_workflow(self, email_dict):
+        email_dict = {"Id": "1", "ThreadId": "t1", "From": "jane@example.com", "To": "me@example.com",
+                      "Date": "Sun, 10 Mar 2024 09:00:00 -0400", "Message-ID": "<1@example.com>", **email_dict}
+        with patch('workflow.iter_unread_emails', return_value=iter([email_dict])):
+            process_emails("Me", MagicMock(), MagicMock(), MagicMock(), collapse_threads=False)
+
+    def test_invite_needs_no_llm_call(self, mock_classify, mock_extract, mock_create, *_):
+        self.run_workflow({"Subject": "Invitation: Quarterly review", "Body": "You have been invited",
+                           "Calendar": INVITE})
+
+        mock_classify.assert_not_called()
+        mock_extract.assert_not_called()
+        self.assertEqual(mock_create.call_args.args[1].start_time, "14:00")
+        self.assertEqual((invites.stats["ics"], invites.stats["without_llm"]), (1, 1))
+
+    def test_explicit_date_skips_extraction_only(self, mock_classify, mock_extract, mock_create, *_):
+        mock_classify.return_value.is_meeting_request = True
+
+        self.run_workflow({"Subject": "Re: Budget sync", "Body": "Could we meet March 12 at 2pm for an hour?"})
+
+        mock_classify.assert_called_once()
+        mock_extract.assert_not_called()
+        details = mock_create.call_args.args[1]
+        self.assertEqual((details.summary, details.date, details.start_time, details.duration),
+                         ("Budget sync", "2024-03-12", "14:00", 60))
+        self.assertEqual((invites.stats["text"], invites.stats["without_llm"]), (1, 0))
+
+    def test_google_invite_passes_the_prefilter(self, mock_classify, mock_extract, mock_create, _, mock_prefilter):
+        mock_prefilter.side_effect = prefilter.prefilter_email
+        with patch('prefilter.active', Prefilter()):
+            self.run_workflow({"From": "Google Calendar <calendar-notification@google.com>",
+                               "Subject": "Invitation: Quarterly review", "Body": "You have been invited",
+                               "Calendar": INVITE})
+
+        mock_classify.assert_not_called()
+        self.assertEqual(mock_create.call_args.args[1].summary, "Quarterly review")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+import journal
+from journal import ProcessingJournal, FETCHED, CLASSIFIED, EXTRACTED, SENDING, ACTED, ACKNOWLEDGED
+from schemas import IsMeetingRequest, MeetingDetails
+from workflow import process_emails
+from benchmarks.testing import make_email, make_details
+
+
+class TestProcessingJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "journal.sqlite3")
+        self.journal = ProcessingJournal(self.path)
+
+    def tearDown(self):
+        self.journal.close()
+        self.tmpdir.cleanup()
+
+    def test_results_are_kept_across_stages(self):
+        self.journal.record("1", FETCHED, thread_id="t1")
+        self.journal.record("1", CLASSIFIED, verdict=IsMeetingRequest(is_meeting_request=True))
+        self.journal.record("1", EXTRACTED, details=make_details())
+
+        entry = self.journal.get("1")
+
+        self.assertEqual(entry.stage, EXTRACTED)
+        self.assertTrue(entry.verdict.is_meeting_request)
+        self.assertEqual(entry.details, make_details())
+        self.assertFalse(entry.acted)
+
+    def test_stage_never_moves_back(self):
+        self.journal.record("1", ACTED, outcome="replied")
+        self.journal.record("1", EXTRACTED, reply="Does Tuesday work?")
+
+        entry = self.journal.get("1")
+        self.assertEqual((entry.stage, entry.reply, entry.outcome), (ACTED, "Does Tuesday work?", "replied"))
+
+    def test_progress_survives_reopening(self):
+        self.journal.record("1", ACTED, outcome="skipped")
+        self.journal.acknowledge(["1", "unknown"])
+        self.journal.close()
+
+        self.journal = ProcessingJournal(self.path)
+
+        self.assertEqual(self.journal.get("1").stage, ACKNOWLEDGED)
+        self.assertIsNone(self.journal.get("unknown"))
+
+    def test_mailboxes_are_kept_apart(self):
+        self.journal.record("1", ACTED, outcome="skipped", mailbox="tokens/alice.json")
+        self.journal.record("1", CLASSIFIED, verdict=IsMeetingRequest(is_meeting_request=True), mailbox="tokens/bob.json")
+        self.journal.acknowledge(["1"], "tokens/alice.json")
+
+        self.assertEqual(self.journal.get("1", "tokens/alice.json").stage, ACKNOWLEDGED)
+        self.assertEqual(self.journal.get("1", "tokens/bob.json").stage, CLASSIFIED)
+        self.assertIsNone(self.journal.get("1"))
+
+    def test_journal_without_mailboxes_is_migrated(self):
+        self.journal.close()
+        os.remove(self.path)
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE emails (id TEXT PRIMARY KEY, thread_id TEXT, stage TEXT NOT NULL, verdict TEXT, "
+                     "details TEXT, reply TEXT, outcome TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)")
+        conn.execute("INSERT INTO emails VALUES ('1', 't1', 'acted', NULL, NULL, NULL, 'skipped', 0, 0)")
+        conn.commit()
+        conn.close()
+
+        self.journal = ProcessingJournal(self.path)
+
+        self.assertEqual((self.journal.get("1").stage, self.journal.get("1").outcome), (ACTED, "skipped"))
+
+    def test_old_acknowledged_emails_are_forgotten(self):
+        self.journal.record("1", ACTED, outcome="skipped")
+        self.journal.acknowledge(["1"])
+        self.journal.record("2", CLASSIFIED, verdict=IsMeetingRequest(is_meeting_request=True))
+        self.journal.close()
+
+        self.journal = ProcessingJournal(self.path, retention_seconds=-1)
+
+        self.assertIsNone(self.journal.get("1"))
+        self.assertEqual(self.journal.get("2").stage, CLASSIFIED)
+
+
+@patch('workflow.prefilter_email', return_value=None)
+@patch('workflow.record_verdict')
+class TestWorkflowResume(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        journal.enable_journal(os.path.join(self.tmpdir.name, "journal.sqlite3"))
+
+    def tearDown(self):
+        journal.journal.close()
+        journal.journal = None
+        self.tmpdir.cleanup()
+
+    def run_workflow(self, emails):
+        read_marker = MagicMock()
+        with patch('workflow.iter_unread_emails', return_value=iter(emails)):
+            process_emails("Me", MagicMock(), MagicMock(), read_marker, collapse_threads=False)
+        return [call.args[0] for call in read_marker.add.call_args_list]
+
+    @patch('workflow.create_calendar_event')
+    @patch('workflow.extract_meeting_details')
+    @patch('workflow.is_meeting_request')
+    def test_failed_email_resumes_without_calling_the_llm_again(self, mock_classify, mock_extract, mock_create, *_):
+        mock_classify.return_value = IsMeetingRequest(is_meeting_request=True)
+        mock_extract.return_value = make_details()
+        mock_create.side_effect = [RuntimeError("connection reset"), True]
+
+        self.assertEqual(self.run_workflow([make_email(1)]), [])
+        self.assertEqual(journal.lookup("1").stage, EXTRACTED)
+
+        self.assertEqual(self.run_workflow([make_email(1)]), ["1"])
+        self.assertEqual(mock_classify.call_count, 1)
+        self.assertEqual(mock_extract.call_count, 1)
+        self.assertEqual(mock_create.call_count, 2)
+        self.assertEqual(journal.lookup("1").outcome, "scheduled")
+
+    @patch('workflow.send_reply_email')
+    @patch('workflow.compose_availability_email')
+    @patch('workflow.propose_slots', return_value=[])
+    @patch('workflow.extract_meeting_details')
+    @patch('workflow.is_meeting_request')
+    def test_acted_email_is_only_marked_read(self, mock_classify, mock_extract, _, mock_compose, mock_send, *__):
+        mock_classify.return_value = IsMeetingRequest(is_meeting_request=True)
+        mock_extract.return_value = make_details(start_time=None)
+        mock_compose.return_value = "When are you free?"
+        mock_send.return_value = True
+
+        self.run_workflow([make_email(1)])
+        # the read state never reached Gmail, so the email shows up again
+        self.assertEqual(self.run_workflow([make_email(1)]), ["1"])
+
+        mock_send.assert_called_once()
+        mock_compose.assert_called_once()
+        self.assertEqual(journal.journal.stats, {"resumed": 1, "skipped_actions": 1})
+
+    @patch('workflow.create_calendar_event')
+    @patch('workflow.extract_meeting_details')
+    @patch('workflow.is_meeting_request')
+    def test_calendar_error_is_left_unread_and_retried(self, mock_classify, mock_extract, mock_create, *_):
+        mock_classify.return_value = IsMeetingRequest(is_meeting_request=True)
+        mock_extract.return_value = make_details()
+        mock_create.side_effect = [False, True]
+
+        self.assertEqual(self.run_workflow([make_email(1)]), [])
+        self.assertEqual((journal.lookup("1").stage, journal.lookup("1").outcome), (EXTRACTED, "calendar_error"))
+
+        self.assertEqual(self.run_workflow([make_email(1)]), ["1"])
+        self.assertEqual((journal.lookup("1").stage, journal.lookup("1").outcome), (ACTED, "scheduled"))
+
+    @patch('workflow.create_calendar_events')
+    @patch('workflow.classify_and_extract')
+    def test_batched_repeat_is_settled_with_its_original(self, mock_batch, mock_create, *_):
+        emails = [dict(make_email(i), ThreadId="t1") for i in (1, 2)]
+        mock_batch.return_value = ({email["Id"]: IsMeetingRequest(is_meeting_request=True) for email in emails},
+                                   {email["Id"]: make_details() for email in emails}, {"1", "2"})
+        mock_create.return_value = set()
+
+        with patch('workflow.iter_unread_emails', return_value=iter(emails)):
+            read_marker = MagicMock()
+            process_emails("Me", MagicMock(), MagicMock(), read_marker, collapse_threads=False, batch=True)
+
+        self.assertEqual(len(mock_create.call_args.args[1]), 1)
+        read_marker.add.assert_not_called()
+        self.assertEqual([journal.lookup(id).outcome for id in ("1", "2")], ["calendar_error", "calendar_error"])
+
+        mock_create.side_effect = lambda service, events: {event_id for _, event_id in events}
+        with patch('workflow.iter_unread_emails', return_value=iter(emails)):
+            process_emails("Me", MagicMock(), MagicMock(), read_marker, collapse_threads=False, batch=True)
+
+        self.assertEqual([call.args[0] for call in read_marker.add.call_args_list], ["1", "2"])
+        self.assertEqual([journal.lookup(id).outcome for id in ("1", "2")], ["scheduled", "duplicate"])
+
+    @patch('workflow.is_meeting_request', return_value=IsMeetingRequest(is_meeting_request=False))
+    @patch('workflow.classify_and_extract', return_value=({}, {}, set()))
+    def test_email_the_batch_left_unanswered_is_not_prefiltered_again(self, _, mock_classify, __, mock_prefilter):
+        with patch('workflow.iter_unread_emails', return_value=iter([make_email(1)])):
+            process_emails("Me", MagicMock(), MagicMock(), MagicMock(), collapse_threads=False, batch=True)
+
+        mock_classify.assert_called_once()
+        mock_prefilter.assert_not_called()
+
+    @patch('workflow.reply_was_sent')
+    @patch('workflow.send_reply_email', return_value=True)
+    @patch('workflow.propose_slots', return_value=[])
+    @patch('workflow.is_meeting_request')
+    def test_interrupted_send_is_not_repeated(self, mock_classify, _, mock_send, mock_was_sent, *__):
+        journal.record("1", SENDING, verdict=IsMeetingRequest(is_meeting_request=True),
+                       details=make_details(start_time=None), reply="When are you free?")
+        mock_was_sent.return_value = True
+
+        self.assertEqual(self.run_workflow([make_email(1)]), ["1"])
+
+        mock_classify.assert_not_called()
+        mock_send.assert_not_called()
+        self.assertEqual(journal.lookup("1").outcome, "replied")
+
+    @patch('workflow.reply_was_sent', return_value=False)
+    @patch('workflow.send_reply_email', return_value=True)
+    @patch('workflow.propose_slots', return_value=[])
+    def test_unsent_reply_is_sent_on_resume(self, mock_propose, mock_send, *__):
+        journal.record("1", SENDING, verdict=IsMeetingRequest(is_meeting_request=True),
+                       details=make_details(start_time=None), reply="When are you free?")
+
+        self.assertEqual(self.run_workflow([make_email(1)]), ["1"])
+
+        self.assertEqual(mock_send.call_args.args[2], "When are you free?")
+        # the journaled reply already offers its slots
+        mock_propose.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import email.parser
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from openai import OpenAI
+import llm_batch
+from prefilter import Prefilter
+from llm_batch import classify_and_extract, run_batch
+from schemas import IsMeetingRequest, MeetingDetails
+from benchmarks.testing import make_email
+
+
+def answer(body):
+    """Plays the model: meeting requests mention 'meet', details are fixed."""
+    schema_name = body["response_format"]["json_schema"]["name"]
+    text = body["messages"][-1]["content"]
+    if schema_name == "IsMeetingRequest":
+        content = {"is_meeting_request": "meet" in text}
+    else:
+        content = {"summary": "Sync", "agenda": None, "date": "2023-10-11", "start_time": "10:00", "duration": 30,
+                   "location": None, "timezone": None, "attendees": []}
+    return {"id": "chatcmpl-1", "object": "chat.completion", "created": 0, "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": json.dumps(content)}}],
+            "usage": {"prompt_tokens": 90, "completion_tokens": 10, "total_tokens": 100}}
+
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    """Serves the subset of /v1/files and /v1/batches used by llm_batch."""
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        state = self.server.state
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.path == "/v1/files":
+            form = email.parser.BytesParser().parsebytes(
+                b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + body)
+            content = next(part.get_payload(decode=True) for part in form.get_payload()
+                           if part.get_param("name", header="content-disposition") == "file")
+            file_id = f"file-{len(state['files'])}"
+            state["files"][file_id] = content.decode()
+            self.send_json({"id": file_id, "object": "file", "bytes": len(content), "created_at": 0,
+                            "filename": "batch_input.jsonl", "purpose": "batch", "status": "processed"})
+        elif self.path == "/v1/batches":
+            request = json.loads(body)
+            lines = [json.loads(line) for line in state["files"][request["input_file_id"]].splitlines()]
+            state["requests"].extend(lines)
+            output = "".join(json.dumps({"id": f"req-{i}", "custom_id": line["custom_id"], "error": None,
+                                         "response": {"status_code": 200, "body": answer(line["body"])}}) + "\n"
+                             for i, line in enumerate(lines) if line["custom_id"] not in state["fail"])
+            output_id = f"file-{len(state['files'])}"
+            state["files"][output_id] = output
+            batch_id = f"batch-{len(state['batches'])}"
+            state["batches"][batch_id] = {"id": batch_id, "object": "batch", "endpoint": request["endpoint"],
+                                          "completion_window": "24h", "created_at": 0,
+                                          "input_file_id": request["input_file_id"], "status": "in_progress",
+                                          "output_file_id": None, "pending_output_file_id": output_id}
+            self.send_json(state["batches"][batch_id])
+
+    def do_GET(self):
+        state = self.server.state
+        parts = self.path.strip("/").split("/")
+        if parts[1] == "batches":
+            batch = state["batches"][parts[2]]
+            # first poll reports in_progress, the next one completion
+            if batch["status"] == "in_progress":
+                batch["status"] = "finalizing"
+            else:
+                batch["status"] = "completed"
+                batch["output_file_id"] = batch["pending_output_file_id"]
+            self.send_json(batch)
+        elif parts[1] == "files" and parts[3] == "content":
+            data = state["files"][parts[2]].encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+
+class TestBatchMode(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubOpenAIHandler)
+        self.server.state = {"files": {}, "batches": {}, "requests": [], "fail": set()}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        client = OpenAI(api_key="test", base_url=f"http://127.0.0.1:{self.server.server_port}/v1", max_retries=0)
+        self.client_patch = patch("llm_calls.client", client)
+        self.client_patch.start()
+
+    def tearDown(self):
+        self.client_patch.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_classify_and_extract_maps_results_back_to_emails(self):
+        emails = [make_email(1, "Can we meet tomorrow at 10?"), make_email(2, "Your receipt"),
+                  make_email(3, "Let's meet on Wednesday")]
+
+        verdicts, details, classified = classify_and_extract(emails, "Me", poll_interval=0)
+
+        self.assertEqual({k: v.is_meeting_request for k, v in verdicts.items()}, {"1": True, "2": False, "3": True})
+        self.assertEqual(classified, {"1", "2", "3"})
+        self.assertEqual(set(details), {"1", "3"})
+        self.assertIsInstance(details["1"], MeetingDetails)
+        self.assertEqual(len(self.server.state["batches"]), 2)
+        # the extraction batch only carries the meeting requests
+        self.assertEqual(len(self.server.state["requests"]), 5)
+        first = self.server.state["requests"][0]
+        self.assertEqual(first["url"], "/v1/chat/completions")
+        self.assertEqual(first["body"]["response_format"]["type"], "json_schema")
+        json_schema = first["body"]["response_format"]["json_schema"]
+        self.assertEqual((json_schema["name"], json_schema["strict"]), ("IsMeetingRequest", True))
+        self.assertEqual(json_schema["schema"]["required"], ["is_meeting_request"])
+        self.assertFalse(json_schema["schema"]["additionalProperties"])
+
+    def test_prefilter_verdicts_are_not_counted_as_llm_verdicts(self):
+        emails = [make_email(1, "Can we meet tomorrow at 10?"), {**make_email(2, "Sale!"), "Precedence": "bulk"}]
+
+        with patch("prefilter.active", Prefilter()), patch("prefilter.labels_path", None):
+            verdicts, _, classified = classify_and_extract(emails, "Me", poll_interval=0)
+
+        self.assertEqual({k: v.is_meeting_request for k, v in verdicts.items()}, {"1": True, "2": False})
+        self.assertEqual(classified, {"1"})
+
+    def test_failed_requests_are_left_for_the_synchronous_path(self):
+        self.server.state["fail"].add("2")
+        requests = {str(i): [{"role": "user", "content": f"meet {i}"}] for i in range(1, 4)}
+
+        results = run_batch(requests, IsMeetingRequest, poll_interval=0)
+
+        self.assertEqual(set(results), {"1", "3"})
+
+    @patch("llm_batch.time.sleep")
+    def test_polls_until_batch_completes(self, mock_sleep):
+        llm_batch.run_batch({"1": [{"role": "user", "content": "meet?"}]}, IsMeetingRequest, poll_interval=5)
+        mock_sleep.assert_called_with(5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from llm_cache import LLMCache
+
+MESSAGES = [{"role": "system", "content": "Analyze the email."}, {"role": "user", "content": "Lunch on Friday?"}]
+
+
+class TestLLMCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "cache.sqlite3")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_key_depends_on_model_prompts_and_schema(self):
+        key = LLMCache.make_key("gpt-4o-mini", MESSAGES, {"type": "object"})
+        self.assertEqual(key, LLMCache.make_key("gpt-4o-mini", MESSAGES, {"type": "object"}))
+        self.assertNotEqual(key, LLMCache.make_key("gpt-4o", MESSAGES, {"type": "object"}))
+        self.assertNotEqual(key, LLMCache.make_key("gpt-4o-mini", MESSAGES[:1], {"type": "object"}))
+        self.assertNotEqual(key, LLMCache.make_key("gpt-4o-mini", MESSAGES, None))
+
+    def test_hit_and_miss_counters(self):
+        cache = LLMCache(self.path)
+        self.assertIsNone(cache.get("k"))
+        cache.put("k", '{"is_meeting_request": true}', tokens=120, latency=0.8)
+        self.assertEqual(cache.get("k"), '{"is_meeting_request": true}')
+        self.assertEqual(cache.stats["hits"], 1)
+        self.assertEqual(cache.stats["misses"], 1)
+        self.assertEqual(cache.stats["tokens_saved"], 120)
+        self.assertAlmostEqual(cache.stats["latency_saved"], 0.8)
+
+    def test_entries_persist_across_instances(self):
+        LLMCache(self.path).put("k", "value")
+        self.assertEqual(LLMCache(self.path).get("k"), "value")
+
+    def test_expired_entries_are_misses(self):
+        cache = LLMCache(self.path, ttl_seconds=60)
+        with patch("llm_cache.time.time", return_value=1000.0):
+            cache.put("k", "value")
+        with patch("llm_cache.time.time", return_value=1061.0):
+            self.assertIsNone(cache.get("k"))
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = LLMCache(self.path, max_bytes=10)
+        with patch("llm_cache.time.time", return_value=1.0):
+            cache.put("a", "aaaa")
+        with patch("llm_cache.time.time", return_value=2.0):
+            cache.put("b", "bbbb")
+        with patch("llm_cache.time.time", return_value=3.0):
+            cache.get("a")
+        with patch("llm_cache.time.time", return_value=4.0):
+            cache.put("c", "cccc")
+            self.assertIsNone(cache.get("b"))
+            self.assertEqual(cache.get("a"), "aaaa")
+            self.assertEqual(cache.get("c"), "cccc")
+
+    def test_hits_write_nothing_until_the_next_put(self):
+        cache = LLMCache(self.path)
+        with patch("llm_cache.time.time", return_value=1.0):
+            cache.put("a", "aaaa")
+        writes = cache.conn.total_changes
+
+        with patch("llm_cache.time.time", return_value=5.0):
+            for _ in range(3):
+                cache.get("a")
+
+        self.assertEqual(cache.conn.total_changes, writes)
+        with patch("llm_cache.time.time", return_value=6.0):
+            cache.put("b", "bb")
+        self.assertEqual(cache.conn.execute("SELECT accessed_at FROM entries WHERE key = 'a'").fetchone()[0], 5.0)
+        self.assertEqual(cache.size, 6)
+
+    def test_running_size_follows_replacements(self):
+        cache = LLMCache(self.path)
+        cache.put("a", "aaaa")
+        cache.put("a", "aa")
+
+        self.assertEqual(cache.size, 2)
+        self.assertEqual(LLMCache(self.path).size, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,20 +1,25 @@
+import os
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock
+import llm_calls
 from llm_calls import is_meeting_request, extract_meeting_details, compose_availability_email
 from schemas import IsMeetingRequest, MeetingDetails
 
 class TestLLMCalls(unittest.TestCase):
 
-    @patch('llm_calls.client.beta.chat.completions.parse')
-    def test_is_meeting_request(self, mock_parse):
+    @patch('llm_calls.client')
+    def test_is_meeting_request(self, mock_client):
+        mock_parse = mock_client.beta.chat.completions.parse
         mock_response = MagicMock()
         mock_response.choices[0].message.parsed = IsMeetingRequest(is_meeting_request=True)
         mock_parse.return_value = mock_response
         result = is_meeting_request("Test email content")
         self.assertTrue(result.is_meeting_request)
 
-    @patch('llm_calls.client.beta.chat.completions.parse')
-    def test_extract_meeting_details(self, mock_parse):
+    @patch('llm_calls.client')
+    def test_extract_meeting_details(self, mock_client):
+        mock_parse = mock_client.beta.chat.completions.parse
         mock_response = MagicMock()
         mock_response.choices[0].message.parsed = MeetingDetails(
             summary="Test Meeting",
@@ -31,13 +36,63 @@ class TestLLMCalls(unittest.TestCase):
         result = extract_meeting_details("Test email content", "Recipient", date_str)
         self.assertEqual(result.summary, "Test Meeting")
 
-    @patch('llm_calls.client.chat.completions.create')
-    def test_compose_availability_email(self, mock_create):
+    @patch('llm_calls.client')
+    def test_compose_availability_email(self, mock_client):
+        mock_create = mock_client.chat.completions.create
         mock_response = MagicMock()
         mock_response.choices[0].message.content = "Please provide your availability."
         mock_create.return_value = mock_response
         result = compose_availability_email("Test email content", "Recipient")
         self.assertEqual(result, "Please provide your availability.")
 
+    @patch('llm_calls.client')
+    def test_compose_availability_email_offers_slots(self, mock_client):
+        mock_create = mock_client.chat.completions.create
+        mock_create.return_value.choices[0].message.content = "Would Monday work?"
+        compose_availability_email("Test email content", "Recipient", ["Monday, March 11, 2:00 PM - 3:00 PM EDT"])
+        prompt = mock_create.call_args.kwargs["messages"][1]["content"]
+        self.assertIn("- Monday, March 11, 2:00 PM - 3:00 PM EDT", prompt)
+
+class TestLLMCallsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        llm_calls.enable_cache(os.path.join(self.tmpdir.name, "cache.sqlite3"))
+
+    def tearDown(self):
+        llm_calls.cache.close()
+        llm_calls.cache = None
+        self.tmpdir.cleanup()
+
+    @patch('llm_calls.client')
+    def test_repeated_request_is_served_from_cache(self, mock_client):
+        mock_parse = mock_client.beta.chat.completions.parse
+        mock_response = MagicMock()
+        mock_response.choices[0].message.parsed = IsMeetingRequest(is_meeting_request=True)
+        mock_response.usage.total_tokens = 42
+        mock_parse.return_value = mock_response
+
+        first = is_meeting_request("Test email content")
+        second = is_meeting_request("Test email content")
+
+        mock_parse.assert_called_once()
+        self.assertIsInstance(second, IsMeetingRequest)
+        self.assertEqual(first, second)
+        self.assertEqual(llm_calls.cache.stats["tokens_saved"], 42)
+
+    @patch('llm_calls.client')
+    def test_different_prompts_are_cached_separately(self, mock_client):
+        mock_create = mock_client.chat.completions.create
+        mock_response = MagicMock()
+        mock_response.choices[0].message.content = "Please provide your availability."
+        mock_response.usage.total_tokens = 10
+        mock_create.return_value = mock_response
+
+        compose_availability_email("Test email content", "Recipient")
+        compose_availability_email("Test email content", "Someone else")
+
+        self.assertEqual(mock_create.call_count, 2)
+        self.assertEqual(llm_calls.cache.stats["misses"], 2)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
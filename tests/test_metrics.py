@@ -0,0 +1,94 @@
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+import httplib2
+from googleapiclient.errors import HttpError
+import metrics
+from metrics import Histogram, count, span, timed_iter, record_usage, snapshot, to_prometheus
+from rate_limit import call
+
+
+def counter(name, **labels):
+    return metrics.counters.get((name, metrics.labels_key(labels)), 0)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_histogram_quantiles_use_bucket_bounds(self):
+        histogram = Histogram()
+        for value in [0.003] * 50 + [0.2] * 45 + [3.0] * 5:
+            histogram.observe(value)
+
+        self.assertEqual(histogram.quantile(0.5), 0.005)
+        self.assertEqual(histogram.quantile(0.95), 0.25)
+        self.assertEqual(histogram.quantile(1.0), 3.0)
+
+    def test_span_records_a_sample_per_block(self):
+        for _ in range(3):
+            with span("classify"):
+                pass
+
+        self.assertEqual(metrics.histograms[("stage_seconds", (("stage", "classify"),))].count, 3)
+
+    def test_timed_iter_times_each_item(self):
+        self.assertEqual(list(timed_iter("fetch", [{"Id": "1"}, {"Id": "2"}])), [{"Id": "1"}, {"Id": "2"}])
+        self.assertEqual(metrics.histograms[("stage_seconds", (("stage", "fetch"),))].count, 2)
+
+    def test_usage_is_read_from_objects_and_json(self):
+        record_usage(SimpleNamespace(prompt_tokens=100, completion_tokens=20, total_tokens=120))
+        record_usage({"prompt_tokens": 50, "completion_tokens": 5})
+        record_usage(None)
+
+        self.assertEqual(counter("openai_tokens_total", kind="prompt"), 150)
+        self.assertEqual(counter("openai_tokens_total", kind="completion"), 25)
+
+    @patch('rate_limit.time.sleep')
+    def test_calls_count_requests_errors_and_retries(self, _):
+        attempts = iter([HttpError(httplib2.Response({"status": 503}), b"unavailable"), "ok"])
+
+        def fn():
+            result = next(attempts)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        self.assertEqual(call(fn, [], "gmail messages.list", "gmail", "messages.list"), "ok")
+
+        self.assertEqual(counter("api_requests_total", api="gmail", method="messages.list"), 2)
+        self.assertEqual(counter("api_errors_total", api="gmail", method="messages.list", error="503"), 1)
+        self.assertEqual(counter("api_retries_total", api="gmail", method="messages.list"), 1)
+
+    def test_prometheus_text_format(self):
+        count("api_requests_total", 3, api="gmail", method="messages.get")
+        with span("fetch"):
+            pass
+        with patch.dict(metrics.constant_labels, {"worker": "0"}):
+            text = to_prometheus()
+
+        self.assertIn("# TYPE scheduler_api_requests_total counter", text)
+        self.assertIn('scheduler_api_requests_total{worker="0",api="gmail",method="messages.get"} 3', text)
+        self.assertIn('scheduler_stage_seconds_bucket{worker="0",stage="fetch",le="+Inf"} 1', text)
+        self.assertIn('scheduler_stage_seconds_count{worker="0",stage="fetch"} 1', text)
+
+    def test_export_writes_json_snapshot(self):
+        count("emails_total", outcome="skipped")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "metrics.json")
+            with patch('metrics.metrics_file', path):
+                metrics.export_metrics()
+            with open(path) as f:
+                exported = json.load(f)
+
+        self.assertEqual(exported, snapshot())
+        self.assertEqual(exported["counters"]["emails_total"], [{"labels": {"outcome": "skipped"}, "value": 1}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+from unittest.mock import patch
+import normalize
+from normalize import html_to_text, strip_quoted, strip_signature, strip_disclaimers, normalize_body, normalize_email, trim_to_budget, count_tokens, TRIM_MARKER
+
+REPLY = """Hi Sam,
+
+Tuesday at 3pm works for me. Let's use the small meeting room.
+
+Best,
+Alex
+Head of Operations | Example Corp
++1 555 0100
+
+CONFIDENTIALITY NOTICE: This email and any attachments are confidential and intended solely for the addressee.
+
+On Mon, Oct 9, 2023 at 9:12 AM Sam Smith <sam@example.com>
+wrote:
+> Could we meet next week to go over the budget?
+> Sam
+"""
+
+
+class TestStripping(unittest.TestCase):
+
+    def test_reply_is_reduced_to_the_new_text(self):
+        normalized = normalize_body(REPLY)
+
+        self.assertEqual(normalized.text, "Hi Sam,\n\nTuesday at 3pm works for me. Let's use the small meeting room.")
+        self.assertLess(normalized.tokens_after, normalized.tokens_before)
+
+    def test_outlook_reply_header_is_cut(self):
+        text = "Sounds good.\n\n-----Original Message-----\nFrom: Sam\nSent: Monday\nSubject: Budget\n\nCan we meet?"
+        self.assertEqual(strip_quoted(text).strip(), "Sounds good.")
+
+    def test_forwarded_message_is_kept(self):
+        text = ("Hi Sam, can you get this on my calendar?\n\n---------- Forwarded message ---------\n"
+                "From: Jane <jane@example.com>\nDate: Mon, Mar 4, 2024 at 9:00 AM\nSubject: Budget\n\n"
+                "Let's meet Tuesday March 12 at 2pm\n\nOn Sun, Mar 3, 2024 at 8:00 AM Alex wrote:\n> Lunch?")
+
+        normalized = normalize_body(text).text
+
+        self.assertIn("Let's meet Tuesday March 12 at 2pm", normalized)
+        self.assertNotIn("Lunch?", normalized)
+
+    def test_quoted_lines_are_dropped(self):
+        self.assertEqual(strip_quoted("> earlier\nNew text\n>> older"), "New text")
+
+    def test_signature_separator_and_mobile_footer(self):
+        self.assertEqual(strip_signature("See you then.\n-- \nAlex").strip(), "See you then.")
+        self.assertEqual(strip_signature("See you then.\n\nSent from my iPhone").strip(), "See you then.")
+
+    def test_thanks_in_the_middle_of_a_long_email_is_kept(self):
+        text = "Thanks!\n" + "\n".join(f"Point {i}" for i in range(20))
+        self.assertEqual(strip_signature(text), text)
+
+    def test_valediction_before_the_request_is_kept(self):
+        text = "Hi,\nThanks!\nCan we meet Tuesday at 3pm?\nAlex"
+        self.assertEqual(strip_signature(text), text)
+
+    def test_signature_block_after_valediction_is_dropped(self):
+        text = "Can we meet Tuesday?\n\nBest regards,\nAlex Smith\nHead of Sales\n+1 555 0100"
+        self.assertEqual(strip_signature(text).strip(), "Can we meet Tuesday?")
+
+    def test_disclaimer_paragraph_is_dropped(self):
+        text = "Meet at noon?\n\nIf you have received this email in error, please notify the sender."
+        self.assertEqual(strip_disclaimers(text), "Meet at noon?")
+
+    def test_body_that_is_only_quotes_is_kept(self):
+        self.assertEqual(normalize_body("> Can we meet Friday?").text, "> Can we meet Friday?")
+
+
+class TestHTMLToText(unittest.TestCase):
+
+    def test_block_elements_become_lines(self):
+        html = "<html><head><style>p {color: red}</style></head><body><p>Can we meet&nbsp;Friday?</p><div>At 10&amp;30</div></body></html>"
+        self.assertEqual(html_to_text(html), "Can we meet Friday?\n\nAt 10&30")
+
+    def test_gmail_quote_is_skipped(self):
+        html = '<div>Works for me.</div><div class="gmail_quote">On Mon Sam wrote:<blockquote>Lunch?</blockquote></div>'
+        self.assertEqual(html_to_text(html), "Works for me.")
+
+
+@patch('normalize.get_encoding', return_value=None)
+class TestTokenBudget(unittest.TestCase):
+
+    def test_estimate_is_four_characters_per_token(self, _):
+        self.assertEqual(count_tokens("a" * 9), 3)
+
+    def test_long_body_keeps_head_and_tail(self, _):
+        text = "start " + "filler " * 1000 + "end"
+
+        trimmed = trim_to_budget(text, 100)
+
+        self.assertTrue(trimmed.startswith("start"))
+        self.assertTrue(trimmed.endswith("end"))
+        self.assertIn(TRIM_MARKER, trimmed)
+        self.assertLessEqual(count_tokens(trimmed), 100 + count_tokens(TRIM_MARKER))
+
+    def test_zero_budget_keeps_the_body_whole(self, _):
+        text = "word " * 1000
+        self.assertEqual(trim_to_budget(text, 0), text)
+
+    def test_normalize_email_records_savings(self, _):
+        with patch.dict(normalize.stats, {"emails": 0, "tokens_before": 0, "tokens_after": 0}):
+            text = normalize_email({"Id": "1", "Body": REPLY})
+
+            self.assertEqual(normalize.stats["emails"], 1)
+            self.assertEqual(normalize.stats["tokens_after"], count_tokens(text))
+            self.assertGreater(normalize.stats["tokens_before"], normalize.stats["tokens_after"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import threading
+import unittest
+from unittest.mock import patch, MagicMock
+import llm_calls
+from oauth_utils import GoogleSession
+
+
+class TestGoogleSession(unittest.TestCase):
+
+    @patch('oauth_utils.authorized_http')
+    @patch('oauth_utils.build')
+    @patch('oauth_utils.load_credentials')
+    def test_credentials_load_once_and_services_are_cached(self, mock_load, mock_build, mock_http):
+        mock_build.side_effect = lambda name, version, http: MagicMock(name=name)
+        session = GoogleSession()
+
+        gmail = session.gmail()
+        calendar = session.calendar()
+
+        self.assertIs(session.gmail(), gmail)
+        self.assertIsNot(calendar, gmail)
+        mock_load.assert_called_once_with("token.json")
+        self.assertEqual(mock_build.call_count, 2)
+        # both services share the thread's transport
+        mock_http.assert_called_once_with(mock_load.return_value)
+
+    @patch('oauth_utils.authorized_http')
+    @patch('oauth_utils.build')
+    def test_each_thread_gets_its_own_transport_and_services(self, mock_build, mock_http):
+        mock_build.side_effect = lambda name, version, http: MagicMock(name=name)
+        mock_http.side_effect = lambda creds: MagicMock()
+        session = GoogleSession(creds=MagicMock())
+        services = []
+        threads = [threading.Thread(target=lambda: services.append(session.gmail())) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len({id(service) for service in services}), 3)
+        self.assertEqual(mock_http.call_count, 3)
+
+
+class TestLazyOpenAIClient(unittest.TestCase):
+
+    def test_client_is_created_on_first_use(self):
+        with patch('llm_calls.client', None), patch.dict('os.environ', {"OPENAI_API_KEY": "test"}):
+            client = llm_calls.get_client()
+            self.assertIs(llm_calls.get_client(), client)
+
+
+if __name__ == '__main__':
+    unittest.main()
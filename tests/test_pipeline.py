@@ -0,0 +1,111 @@
+import asyncio
+import unittest
+from unittest.mock import patch, MagicMock
+from pipeline import Pipeline
+from schemas import IsMeetingRequest
+from benchmarks.testing import MEETING_BODY, make_email, make_details
+
+
+class TestPipeline(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.services = MagicMock()
+        self.read_marker = MagicMock()
+        self.events = []
+
+    async def classify(self, text):
+        self.events.append(("classify", text))
+        await asyncio.sleep(0)
+        return IsMeetingRequest(is_meeting_request="tomorrow" in text)
+
+    async def extract(self, text, username, date):
+        await asyncio.sleep(0)
+        return make_details()
+
+    async def run_pipeline(self, emails, **kwargs):
+        pipeline = Pipeline("Me", self.services, self.read_marker, **kwargs)
+        return await pipeline.run(lambda before_checkpoint: iter(emails))
+
+    @patch('pipeline.create_calendar_event')
+    @patch('pipeline.extract_meeting_details_async')
+    @patch('pipeline.is_meeting_request_async')
+    async def test_each_email_is_acted_on_before_being_marked_read(self, mock_classify, mock_extract, mock_create):
+        mock_classify.side_effect = self.classify
+        mock_extract.side_effect = self.extract
+        mock_create.side_effect = lambda service, details, event_id: self.events.append(("create", details.attendees[-1])) or True
+        self.read_marker.add.side_effect = lambda id: self.events.append(("mark_read", id))
+
+        processed = await self.run_pipeline([make_email(i, MEETING_BODY if i % 2 == 0 else "Newsletter") for i in range(6)])
+
+        self.assertEqual(processed, 6)
+        self.assertEqual(mock_create.call_count, 3)
+        self.assertEqual(sorted(e[1] for e in self.events if e[0] == "mark_read"), [str(i) for i in range(6)])
+        for i in range(0, 6, 2):
+            created = self.events.index(("create", f"sender{i}@example.com"))
+            self.assertLess(created, self.events.index(("mark_read", str(i))))
+
+    @patch('pipeline.create_calendar_event')
+    @patch('pipeline.extract_meeting_details_async')
+    @patch('pipeline.is_meeting_request_async')
+    async def test_same_meeting_in_a_thread_is_created_once(self, mock_classify, mock_extract, mock_create):
+        mock_classify.side_effect = self.classify
+        mock_extract.side_effect = self.extract
+        mock_create.return_value = True
+        emails = [dict(make_email(i), ThreadId="thread-1") for i in (0, 2, 4)]
+
+        await self.run_pipeline(emails)
+
+        mock_create.assert_called_once()
+        self.assertEqual(self.read_marker.add.call_count, 3)
+
+    @patch('pipeline.create_calendar_event')
+    @patch('pipeline.extract_meeting_details_async')
+    @patch('pipeline.is_meeting_request_async')
+    async def test_repeat_is_left_unread_when_the_insert_fails(self, mock_classify, mock_extract, mock_create):
+        mock_classify.side_effect = self.classify
+        mock_extract.side_effect = self.extract
+        mock_create.return_value = False
+        emails = [dict(make_email(i), ThreadId="thread-1") for i in (0, 2)]
+
+        await self.run_pipeline(emails)
+
+        mock_create.assert_called_once()
+        self.read_marker.add.assert_not_called()
+
+    @patch('pipeline.is_meeting_request_async')
+    async def test_stage_concurrency_is_bounded(self, mock_classify):
+        active = 0
+        peak = 0
+
+        async def classify(text):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+            return IsMeetingRequest(is_meeting_request=False)
+
+        mock_classify.side_effect = classify
+
+        await self.run_pipeline([make_email(i) for i in range(20)], stage_concurrency={"classify": 3})
+
+        self.assertEqual(peak, 3)
+        self.assertEqual(self.read_marker.add.call_count, 20)
+
+    @patch('pipeline.is_meeting_request_async')
+    async def test_failed_email_is_not_marked_read(self, mock_classify):
+        async def classify(text):
+            if "Subject 1" in text:
+                raise RuntimeError("LLM unavailable")
+            return IsMeetingRequest(is_meeting_request=False)
+
+        mock_classify.side_effect = classify
+
+        processed = await self.run_pipeline([make_email(i) for i in range(3)])
+
+        self.assertEqual(processed, 3)
+        self.assertEqual(sorted(call.args[0] for call in self.read_marker.add.call_args_list), ["0", "2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
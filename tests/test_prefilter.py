@@ -0,0 +1,112 @@
+import os
+import random
+import tempfile
+import unittest
+import prefilter
+from prefilter import Prefilter, header_rule, extract_features, hash_features, evaluate, load_labels, SKIP, ASK_LLM
+from schemas import IsMeetingRequest
+from benchmarks.testing import make_email
+
+MEETING_BODIES = [
+    "Can we meet on {day} at {hour}pm to discuss the roadmap?",
+    "Are you free {day} for a quick call about the contract?",
+    "Let's schedule a meeting {day} morning to review the budget.",
+    "Would {day} at {hour} work for a sync with the team?",
+]
+OTHER_BODIES = [
+    "Your order #{hour}{hour} has shipped and will arrive {day}.",
+    "Here is the invoice for {day}. Thanks for your payment.",
+    "Great article this week: ten tips for better sleep on {day}.",
+    "Your password was changed on {day}. If this wasn't you, contact support.",
+]
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
+
+
+def make_corpus(n, seed=0):
+    rng = random.Random(seed)
+    emails, labels = [], []
+    for i in range(n):
+        meeting = i % 4 == 0
+        template = rng.choice(MEETING_BODIES if meeting else OTHER_BODIES)
+        emails.append(make_email(body=template.format(day=rng.choice(DAYS), hour=rng.randint(1, 11))))
+        labels.append(meeting)
+    return emails, labels
+
+
+class TestHeaderRules(unittest.TestCase):
+
+    def test_bulk_and_automated_mail_is_ruled_out(self):
+        self.assertEqual(header_rule(make_email(body="", **{"List-Unsubscribe": "<mailto:x@example.com>"})), "mailing-list")
+        self.assertEqual(header_rule(make_email(body="", Precedence="bulk")), "precedence")
+        self.assertEqual(header_rule(make_email(body="", **{"Auto-Submitted": "auto-generated"})), "auto-submitted")
+        self.assertEqual(header_rule(make_email(body="", From="Shop <no-reply@shop.example.com>")), "no-reply-sender")
+
+    def test_personal_mail_passes(self):
+        self.assertIsNone(header_rule(make_email(body="Lunch?", **{"Auto-Submitted": "no"})))
+
+    def test_hashing_is_stable_and_bounded(self):
+        features = extract_features(make_email(body="Can we meet tomorrow?"))
+        indices = hash_features(features, 1024)
+        self.assertTrue((indices < 1024).all())
+        self.assertEqual(indices.tolist(), hash_features(features, 1024).tolist())
+
+
+class TestPrefilterModel(unittest.TestCase):
+
+    def setUp(self):
+        emails, labels = make_corpus(200)
+        indices = [hash_features(extract_features(e)) for e in emails]
+        self.model = Prefilter(skip_below=0.2).fit(indices, labels)
+
+    def test_confident_non_meetings_skip_the_llm(self):
+        decision = self.model.decide(make_email(body="Your order #55 has shipped and will arrive Friday."))
+        self.assertEqual(decision.verdict, SKIP)
+
+    def test_meeting_requests_go_to_the_llm(self):
+        decision = self.model.decide(make_email(body="Can we meet on Thursday at 3pm to discuss the roadmap?"))
+        self.assertEqual(decision.verdict, ASK_LLM)
+
+    def test_model_round_trips_through_disk(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "model.npz")
+            self.model.save(path)
+            loaded = Prefilter.load(path, skip_below=0.2)
+        email_dict = make_email(body="Are you free Monday for a quick call about the contract?")
+        self.assertAlmostEqual(loaded.decide(email_dict).probability, self.model.decide(email_dict).probability)
+
+    def test_evaluate_reports_recall_on_held_out_labels(self):
+        emails, labels = make_corpus(80, seed=1)
+        records = [{"indices": hash_features(extract_features(e)), "rule": None, "label": label}
+                   for e, label in zip(emails, labels)]
+        report = evaluate(self.model, records)
+        self.assertEqual(report["meeting_recall"], 1.0)
+        self.assertGreater(report["llm_calls_avoided"], 0.5)
+
+
+class TestPrefilterWorkflow(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.labels = os.path.join(self.tmpdir.name, "labels.jsonl")
+        prefilter.enable_prefilter(os.path.join(self.tmpdir.name, "missing.npz"), self.labels)
+
+    def tearDown(self):
+        prefilter.active = None
+        self.tmpdir.cleanup()
+
+    def test_rules_apply_without_a_trained_model(self):
+        self.assertEqual(prefilter.prefilter_email(make_email(body="Sale!", Precedence="bulk")),
+                         IsMeetingRequest(is_meeting_request=False))
+        self.assertIsNone(prefilter.prefilter_email(make_email(body="Can we meet?")))
+
+    def test_llm_verdicts_are_recorded_without_email_text(self):
+        prefilter.record_verdict(make_email(body="Can we meet tomorrow?"), IsMeetingRequest(is_meeting_request=True))
+        with open(self.labels) as f:
+            self.assertNotIn("tomorrow", f.read())
+        records = load_labels(self.labels)
+        self.assertEqual(len(records), 1)
+        self.assertTrue(records[0]["label"])
+
+
+if __name__ == '__main__':
+    unittest.main()
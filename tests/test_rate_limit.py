@@ -0,0 +1,133 @@
+import asyncio
+import unittest
+from unittest.mock import patch, MagicMock
+import httplib2
+import httpx
+import openai
+from googleapiclient.errors import HttpError
+import rate_limit
+from rate_limit import TokenBucket, call, call_async, execute_batch, is_retryable, retry_after
+from benchmarks.testing import FakeBatch
+
+
+def http_error(status, content=b"error", **headers):
+    return HttpError(httplib2.Response({"status": status, **headers}), content)
+
+
+def openai_error(cls, status, **headers):
+    response = httpx.Response(status, headers=headers, request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+    return cls("error", response=response, body=None)
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    @patch('rate_limit.time.monotonic')
+    def test_reservations_wait_out_the_deficit(self, mock_monotonic):
+        mock_monotonic.return_value = 0
+        bucket = TokenBucket(rate=10, capacity=10)
+        self.assertEqual(bucket.reserve(10), 0)
+        self.assertAlmostEqual(bucket.reserve(5), 0.5)
+        mock_monotonic.return_value = 1
+        # one second refilled the 5-token deficit and 5 more
+        self.assertEqual(bucket.reserve(5), 0)
+
+    @patch('rate_limit.time.monotonic')
+    def test_pause_and_adjust(self, mock_monotonic):
+        mock_monotonic.return_value = 0
+        bucket = TokenBucket(rate=10, capacity=10)
+        bucket.pause(2)
+        self.assertAlmostEqual(bucket.reserve(1), 2.1)
+        bucket.adjust(100)
+        self.assertEqual(bucket.tokens, 10)
+
+
+class TestRetries(unittest.TestCase):
+
+    def test_throttling_and_transient_errors_are_retryable(self):
+        self.assertTrue(is_retryable(http_error(429)))
+        self.assertTrue(is_retryable(http_error(503)))
+        self.assertTrue(is_retryable(http_error(403, b'{"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}')))
+        self.assertFalse(is_retryable(http_error(403, b'{"error": {"errors": [{"reason": "forbidden"}]}}')))
+        self.assertFalse(is_retryable(http_error(404)))
+        self.assertTrue(is_retryable(openai_error(openai.RateLimitError, 429)))
+        self.assertFalse(is_retryable(openai_error(openai.BadRequestError, 400)))
+
+    def test_retry_after_header_is_read(self):
+        self.assertEqual(retry_after(http_error(429, **{"retry-after": "7"})), 7)
+        self.assertEqual(retry_after(openai_error(openai.RateLimitError, 429, **{"retry-after-ms": "1500"})), 1.5)
+        self.assertIsNone(retry_after(http_error(503)))
+
+    @patch('rate_limit.time.sleep')
+    def test_call_retries_honoring_retry_after(self, mock_sleep):
+        fn = MagicMock(side_effect=[http_error(429, **{"retry-after": "7"}), http_error(503), "ok"])
+        self.assertEqual(call(fn, [], "test"), "ok")
+        self.assertEqual(fn.call_count, 3)
+        self.assertGreaterEqual(mock_sleep.call_args_list[0].args[0], 7)
+
+    @patch('rate_limit.time.sleep')
+    def test_call_gives_up_after_max_retries(self, mock_sleep):
+        fn = MagicMock(side_effect=http_error(500))
+        with self.assertRaises(HttpError):
+            call(fn, [], "test")
+        self.assertEqual(fn.call_count, rate_limit.MAX_RETRIES + 1)
+
+    @patch('rate_limit.time.sleep')
+    def test_sends_are_only_retried_when_throttled(self, mock_sleep):
+        fn = MagicMock(side_effect=[http_error(429), "sent"])
+        self.assertEqual(call(fn, [], "test", "gmail", "messages.send"), "sent")
+
+        for error in (http_error(503), ConnectionError()):
+            fn = MagicMock(side_effect=[error, "sent twice"])
+            with self.assertRaises(type(error)):
+                call(fn, [], "test", "gmail", "messages.send")
+            fn.assert_called_once()
+
+    @patch('rate_limit.time.sleep')
+    def test_permanent_errors_are_raised_immediately(self, mock_sleep):
+        fn = MagicMock(side_effect=http_error(404))
+        with self.assertRaises(HttpError):
+            call(fn, [], "test")
+        fn.assert_called_once()
+        mock_sleep.assert_not_called()
+
+    @patch('rate_limit.asyncio.sleep')
+    def test_async_call_retries(self, mock_sleep):
+        responses = iter([openai_error(openai.RateLimitError, 429), "ok"])
+
+        async def fn():
+            response = next(responses)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        self.assertEqual(asyncio.run(call_async(fn, [], "test")), "ok")
+        mock_sleep.assert_called_once()
+
+
+class TestExecuteBatch(unittest.TestCase):
+
+    @patch('rate_limit.time.sleep')
+    def test_only_throttled_sub_requests_are_retried(self, mock_sleep):
+        failures = {"2": [http_error(429)], "3": [http_error(404)]}
+
+        def fail_once(request_id, request):
+            return failures[request_id].pop(0) if failures.get(request_id) else {"id": request_id}
+
+        batches = []
+        service = MagicMock()
+        service.new_batch_http_request.side_effect = lambda callback: batches.append(FakeBatch(callback, fail_once)) or batches[-1]
+        results = {}
+
+        execute_batch(service, [(str(i), object()) for i in range(1, 5)],
+                      lambda request_id, response, exception: results.setdefault(request_id, exception or response),
+                      "gmail", "messages.get")
+
+        self.assertEqual(len(batches), 2)
+        self.assertEqual([request_id for request_id, _ in batches[1].requests], ["2"])
+        self.assertEqual(results["2"], {"id": "2"})
+        self.assertIsInstance(results["3"], HttpError)
+        self.assertEqual(len(results), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+import journal
+import roster
+from roster import Account, load_roster, shard_accounts, run_account, run_shard, run_roster
+
+
+class TestRoster(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_roster(self, entries):
+        path = os.path.join(self.tmpdir.name, "roster.json")
+        with open(path, "w") as f:
+            json.dump(entries, f)
+        return path
+
+    def test_load_roster_gives_each_account_its_own_sync_state(self):
+        path = self.write_roster([{"name": "Alice", "token": "tokens/alice.json"},
+                                  {"name": "Bob", "token": "tokens/bob.json", "processed_label": "done"}])
+        self.assertEqual(load_roster(path), [
+            Account("Alice", "tokens/alice.json", "tokens/alice.sync_state.json"),
+            Account("Bob", "tokens/bob.json", "tokens/bob.sync_state.json", "done"),
+        ])
+
+    def test_duplicate_mailboxes_are_rejected(self):
+        path = self.write_roster([{"name": "Alice", "token": "alice.json"}, {"name": "Al", "token": "alice.json"}])
+        with self.assertRaises(ValueError):
+            load_roster(path)
+
+    def test_every_account_lands_in_exactly_one_shard(self):
+        accounts = [Account(f"user{i}", f"{i}.json", f"{i}.state") for i in range(7)]
+        shards = shard_accounts(accounts, 3)
+        self.assertEqual([len(shard) for shard in shards], [3, 2, 2])
+        self.assertEqual(sorted(a.name for shard in shards for a in shard), sorted(a.name for a in accounts))
+        self.assertEqual(len(shard_accounts(accounts[:2], 4)), 2)
+
+    def test_accounts_without_a_token_are_reported_by_the_pool(self):
+        accounts = [Account(f"user{i}", os.path.join(self.tmpdir.name, f"{i}.json"), f"{i}.state") for i in range(3)]
+        with patch("roster.install_stop_handlers"):
+            reports = run_roster(accounts, workers=2)
+        self.assertEqual(sorted(r["account"] for r in reports), ["user0", "user1", "user2"])
+        self.assertTrue(all("no token" in r["error"] for r in reports))
+
+
+class TestRunAccount(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.token = os.path.join(self.tmpdir.name, "alice.json")
+        open(self.token, "w").close()
+        self.account = Account("Alice", self.token, "alice.state")
+        roster.stop_event = threading.Event()
+        roster.sessions.clear()
+
+    def tearDown(self):
+        roster.stop_event = None
+        roster.sessions.clear()
+        journal.set_mailbox("")
+        self.tmpdir.cleanup()
+
+    @patch('roster.make_label_batcher')
+    @patch('roster.GoogleSession')
+    @patch('roster.process_emails')
+    def test_reports_throughput_and_lag(self, mock_process, mock_session, mock_batcher):
+        def process(username, calendar, gmail, read_marker, sync_state, stop, on_email, **options):
+            on_email({"Date": "Tue, 10 Oct 2023 09:00:00 -0400"})
+            on_email({"Date": "not a date"})
+            return 2
+
+        mock_process.side_effect = process
+
+        report = run_account(self.account, incremental=True)
+
+        self.assertEqual(report["processed"], 2)
+        self.assertIsNone(report["error"])
+        self.assertGreater(report["lag_max_seconds"], 0)
+        self.assertEqual(mock_process.call_args.kwargs["sync_state"], "alice.state")
+        self.assertTrue(mock_process.call_args.kwargs["incremental"])
+        mock_session.assert_called_once_with(token_file=self.token)
+        self.assertEqual(journal.mailbox, self.token)
+
+    @patch('roster.make_label_batcher')
+    @patch('roster.GoogleSession')
+    @patch('roster.process_emails')
+    def test_daemon_shard_reuses_sessions_until_stopped(self, mock_process, mock_session, mock_batcher):
+        passes = iter([3, 0])
+
+        def process(*args, **kwargs):
+            processed = next(passes)
+            if processed == 0:
+                roster.stop_event.set()
+            return processed
+
+        mock_process.side_effect = process
+
+        reports = run_shard([self.account], {}, daemon=True, min_interval=0, max_interval=0)
+
+        self.assertEqual(mock_process.call_count, 2)
+        mock_session.assert_called_once()
+        self.assertEqual([r["processed"] for r in reports], [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
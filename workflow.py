@@ -0,0 +1,236 @@
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional
+from availability import BusyIndex, propose_slots, record_event
+from calendar_utils import create_calendar_event, create_calendar_events, add_email_participants, event_id_for
+from gmail_utils import LabelUpdateBatcher, EmailRecord, mark_handled, send_reply_email, reply_was_sent, format_plaintext_email, format_email_date, iter_unread_emails, iter_new_emails, BATCH_SIZE, PAGE_SIZE, SYNC_STATE_FILE
+from llm_calls import is_meeting_request, extract_meeting_details, compose_availability_email
+import prefilter
+from prefilter import prefilter_email, record_verdict
+from llm_batch import classify_and_extract, POLL_INTERVAL_SECONDS
+from metrics import count, span, timed_iter
+from schemas import IsMeetingRequest
+from journal import lookup, resume, record, FETCHED, CLASSIFIED, EXTRACTED, SENDING, ACTED
+from invites import parse_invite, extract_locally, record_extraction, record_email, LLM
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# outcomes that leave the email unread for the next run
+ERROR_OUTCOMES = ("calendar_error", "reply_error")
+
+
+def likely_needs_body(email_dict: Dict[str, str]) -> bool:
+    """False for mail the prefilter's header rules will reject before anything reads its body."""
+    if prefilter.active is None:
+        return True
+    rule = prefilter.header_rule(email_dict)
+    if rule == "no-reply-sender":
+        # the prefilter lets invites from no-reply senders through, so it reads their calendar part
+        return not isinstance(email_dict, EmailRecord) or email_dict.may_have_calendar()
+    return rule is None
+
+def process_emails(username: str, calendar_service: Any, gmail_service: Any, read_marker: LabelUpdateBatcher,
+                   page_size: int = PAGE_SIZE, max_in_flight: int = BATCH_SIZE, incremental: bool = False,
+                   sync_state: str = SYNC_STATE_FILE, batch: bool = False,
+                   batch_poll_interval: float = POLL_INTERVAL_SECONDS, stop: Optional[threading.Event] = None,
+                   on_email: Optional[Callable[[Dict[str, str]], None]] = None,
+                   busy_index: Optional[BusyIndex] = None, collapse_threads: Optional[bool] = None) -> int:
+    """Run one pass over unread (or, with ``incremental``, newly added) mail and return how many emails were handled.
+
+    Setting ``stop`` ends the pass after the email currently being handled.
+    ``on_email`` is called with each email once it has been handled. Replies
+    to meeting requests without a time offer free slots from ``busy_index``,
+    which callers running several passes keep between them. With
+    ``collapse_threads``, only the newest unread message of each thread is
+    processed, with the earlier ones as context, and those are marked as read
+    along with it. It defaults to ``incremental``: a full scan would have to list
+    every page before handling its first email. Each email's progress is journaled, so one interrupted by a
+    crash resumes from its last completed stage. Calendar invites and emails
+    naming an explicit date and time are read without the LLM. Email bodies, extracted
+    details and replies are only logged at DEBUG level.
+    """
+    if busy_index is None:
+        busy_index = BusyIndex()
+    if collapse_threads is None:
+        collapse_threads = incremental
+    # emails left unread; incremental sync lists them again next run
+    failed = set()
+    if incremental:
+        logger.info('fetching emails added since the last sync')
+        email_dicts = iter_new_emails(gmail_service, sync_state, page_size=page_size, max_in_flight=max_in_flight,
+                                      collapse_threads=collapse_threads, failed=failed, needs_body=likely_needs_body)
+    else:
+        logger.info('fetching unread emails')
+        email_dicts = iter_unread_emails(gmail_service, page_size=page_size, max_in_flight=max_in_flight,
+                                         collapse_threads=collapse_threads, needs_body=likely_needs_body)
+    email_dicts = timed_iter("fetch", email_dicts)
+    verdicts, details, classified = {}, {}, set()
+    # emails the batch already ran through the prefilter; a second run would count them twice
+    prefiltered = set()
+    if batch:
+        email_dicts = list(email_dicts)
+        # emails an earlier run already classified are not sent again
+        unclassified = [email_dict for email_dict in email_dicts
+                        if (entry := lookup(email_dict['Id'])) is None or entry.verdict is None]
+        logger.info(f'running batch classification and extraction for {len(unclassified)} emails')
+        verdicts, details, classified = classify_and_extract(unclassified, username, poll_interval=batch_poll_interval)
+        prefiltered = {email_dict['Id'] for email_dict in unclassified}
+    # deterministic event ids already handled this run; repeats in a thread cost no Calendar write
+    scheduled_event_ids = set()
+    # in batch mode events are inserted together at the end, and their emails marked read after
+    pending_events = []
+    processed = 0
+    for email_dict in email_dicts:
+        if stop is not None and stop.is_set():
+            logger.info('stop requested. leaving remaining emails for the next run')
+            break
+        processed += 1
+        try:
+            logger.info(f"processing email {email_dict['Id']}...")
+            entry = resume(email_dict['Id'])
+            if entry is not None and entry.acted:
+                logger.info('email was already handled by an earlier run. marking it as read')
+                count("emails_total", outcome="resumed")
+                mark_handled(read_marker, email_dict)
+                continue
+            if entry is None:
+                record(email_dict['Id'], FETCHED, thread_id=email_dict.get('ThreadId'))
+
+            logger.info('determining if email contains meeting...')
+            used_llm = False
+            relevant_email = entry.verdict if entry is not None else None
+            if relevant_email is None:
+                relevant_email = verdicts.get(email_dict['Id'])
+                used_llm = email_dict['Id'] in classified
+            if relevant_email is None and email_dict['Id'] not in prefiltered:
+                relevant_email = prefilter_email(email_dict)
+            if relevant_email is None and parse_invite(email_dict) is not None:
+                logger.info('email carries a calendar invite')
+                relevant_email = IsMeetingRequest(is_meeting_request=True)
+            if relevant_email is None or relevant_email.is_meeting_request:
+                # the body is downloaded from here on; mail rejected by its headers alone never is
+                with span("normalize"):
+                    plaintext_email = format_plaintext_email(email_dict)
+                logger.debug(f'reconstructed email:\n{plaintext_email}')
+            if relevant_email is None:
+                used_llm = True
+                with span("classify"):
+                    relevant_email = is_meeting_request(plaintext_email)
+                record_verdict(email_dict, relevant_email)
+            record(email_dict['Id'], CLASSIFIED, verdict=relevant_email)
+            if relevant_email.is_meeting_request:
+                logger.info(f'meeting contains request')
+                logger.info('extracting meeting details...')
+                date_str = format_email_date(email_dict)
+                meeting_details = entry.details if entry is not None else None
+                if meeting_details is None:
+                    meeting_details = extract_locally(email_dict)
+                if meeting_details is None:
+                    used_llm = True
+                    record_extraction(LLM)
+                    meeting_details = details.get(email_dict['Id'])
+                if meeting_details is None:
+                    with span("extract"):
+                        meeting_details = extract_meeting_details(plaintext_email, username, date_str)
+                record(email_dict['Id'], EXTRACTED, details=meeting_details)
+                logger.debug(f'extracted meeting details: {meeting_details!r}')
+                if meeting_details.start_time is not None and meeting_details.date is not None:
+                    logger.info(f'meeting details contain a date and time: {meeting_details.date} {meeting_details.start_time}. creating calendar event...')
+                    add_email_participants(meeting_details, email_dict)
+                    event_id = event_id_for(email_dict, meeting_details)
+                    if batch:
+                        if event_id not in scheduled_event_ids:
+                            scheduled_event_ids.add(event_id)
+                            record_event(busy_index, meeting_details)
+                        # a repeat waits for its original's insert, and is left unread if that fails
+                        pending_events.append((meeting_details, event_id, email_dict))
+                        logger.info('queued calendar event')
+                        record_email(used_llm)
+                        continue
+                    elif event_id in scheduled_event_ids:
+                        logger.info('calendar event for this meeting was already created. skipping')
+                        outcome = "duplicate"
+                    else:
+                        scheduled_event_ids.add(event_id)
+                        with span("calendar"):
+                            created = create_calendar_event(calendar_service, meeting_details, event_id)
+                        if created:
+                            logger.info('created calendar event')
+                            record_event(busy_index, meeting_details)
+                        else:
+                            logger.error('could not create calendar event')
+                            # a later email about the same meeting may still create it
+                            scheduled_event_ids.discard(event_id)
+                        outcome = "scheduled" if created else "calendar_error"
+                else:
+                    logger.info('meeting details missing date and/or time details. composing followup email...')
+                    reply_message = entry.reply if entry is not None else None
+                    if reply_message is None:
+                        # only a new reply needs free times; a journaled one already offers them
+                        with span("availability"):
+                            slots = propose_slots(busy_index, calendar_service, meeting_details)
+                        used_llm = True
+                        with span("compose"):
+                            reply_message = compose_availability_email(plaintext_email, username, slots)
+                        record(email_dict['Id'], EXTRACTED, reply=reply_message)
+                    logger.debug(f'response email:\n{reply_message}')
+                    if entry is not None and entry.stage == SENDING and reply_was_sent(gmail_service, email_dict):
+                        logger.info('response email was sent before the previous run stopped')
+                        sent = True
+                    else:
+                        logger.info('sending response email...')
+                        record(email_dict['Id'], SENDING)
+                        with span("reply"):
+                            sent = send_reply_email(gmail_service, email_dict, reply_message)
+                        logger.info('sent_response_email')
+                    outcome = "replied" if sent else "reply_error"
+            else:
+                logger.info("email does not contain meeting request. skipping...")
+                outcome = "skipped"
+            record_email(used_llm)
+            count("emails_total", outcome=outcome)
+            if outcome in ERROR_OUTCOMES:
+                # kept below acted and left unread, so the next run tries again
+                logger.error(f"Error handling email {email_dict['Id']} ({outcome}). leaving it unread")
+                record(email_dict['Id'], EXTRACTED, outcome=outcome)
+                failed.add(email_dict['Id'])
+                failed.update(email_dict.get('Superseded', []))
+                continue
+            record(email_dict['Id'], ACTED, outcome=outcome)
+        except Exception as e:
+            # left unread, so the next run tries it again
+            logger.error(f"Error processing email {email_dict['Id']}: {e!r}. leaving it unread")
+            count("emails_total", outcome="failed")
+            failed.add(email_dict['Id'])
+            failed.update(email_dict.get('Superseded', []))
+            continue
+        logger.info("queueing email to be marked as read")
+        mark_handled(read_marker, email_dict)
+        if on_email is not None:
+            on_email(email_dict)
+        logger.info('====================')
+    if pending_events:
+        # each event is inserted once, with the details of the first email that asked for it
+        events = {}
+        for meeting_details, event_id, _ in pending_events:
+            events.setdefault(event_id, meeting_details)
+        with span("calendar"):
+            created = create_calendar_events(calendar_service, [(details, event_id) for event_id, details in events.items()])
+        settled = set()
+        for _, event_id, email_dict in pending_events:
+            if event_id not in created:
+                count("emails_total", outcome="calendar_error")
+                record(email_dict['Id'], EXTRACTED, outcome="calendar_error")
+                failed.add(email_dict['Id'])
+                failed.update(email_dict.get('Superseded', []))
+                continue
+            outcome = "duplicate" if event_id in settled else "scheduled"
+            settled.add(event_id)
+            count("emails_total", outcome=outcome)
+            record(email_dict['Id'], ACTED, outcome=outcome)
+            mark_handled(read_marker, email_dict)
+            if on_email is not None:
+                on_email(email_dict)
+    return processed